@@ -1,12 +1,47 @@
 import os
+import sys
+import time
 import shutil
+import weakref
+import threading
 from fcntl import lockf as lock_file
 from fcntl import LOCK_UN, LOCK_EX
 import struct
 from contextlib import contextmanager
+from cutout import stats
+from cutout import compression
 
 int_encoding = struct.Struct('<I')
 triple_encoding = struct.Struct('<III')
+## Set on the length in the index of a record stored compressed (see
+## `cutout.compression`):
+COMPRESSED = 1 << 31
+LENGTH_MASK = COMPRESSED - 1
+## Set on the positions `Database.read_with_positions` gives for
+## compressed records, which are the record's place in the index:
+INDEX_POSITION = 1 << 63
+
+## How extend() makes its writes durable:
+##   none: written to the OS, but never forced to disk
+##   batch: each extend() fdatasyncs the data and then the index
+##   group: like batch, but concurrent extend() calls on the same
+##          database (in one process) share a single pair of fdatasyncs
+DURABILITY_MODES = ('none', 'batch', 'group')
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+lock_append_wait = stats.registry.histogram(
+    'cutout_lock_append_wait_seconds',
+    'Time spent waiting for the append lock of a database file')
+write_lock_wait = stats.registry.histogram(
+    'cutout_write_lock_wait_seconds',
+    'Time spent waiting for other threads writing to the same database')
+group_appends = stats.registry.histogram(
+    'cutout_commit_group_appends',
+    'Appends written together by one write', unit='count')
+open_databases = stats.registry.gauge(
+    'cutout_open_databases',
+    'Database objects in this process that have not been closed', ('engine',))
 
 
 class ExpectationFailed(Exception):
@@ -17,13 +52,64 @@ class TruncatedFile(Exception):
     pass
 
 
+class DatabaseMoved(Exception):
+    """Raised by `Database.extend` when the database's files have been
+    renamed or replaced since it was opened (as when it is deprecated
+    for a hand off), so the records would go where no one reads them"""
+
+
+def check_not_moved(fp, filename):
+    """Raises `DatabaseMoved` unless `filename` is still the file open
+    as `fp`; called with the file locked, so a rename (which takes
+    ``lock_complete``) either happened before or waits until after"""
+    try:
+        current = os.stat(filename).st_ino
+    except OSError, e:
+        if e.errno != 2:
+            raise
+        current = None
+    if current != os.fstat(fp.fileno()).st_ino:
+        raise DatabaseMoved(filename)
+
+
+class Compressed(str):
+    """Data given to `Append` that is already compressed"""
+
+
 class Database(object):
+    """A database of records in a data file, with an index file of
+    (length, position, count) for each record.
+
+    With `compress` new records are compressed (see
+    `cutout.compression`), once the database has enough records to
+    train a dictionary from; compressed records are flagged in the
+    index (`COMPRESSED`), and are decompressed when they are read
+    whether or not `compress` is given."""
 
-    def __init__(self, data_filename, index_filename=None):
+    ## This engine keeps a separate index file (see `cutout.streamdb`
+    ## for one that doesn't):
+    has_index = True
+    ## The files can be copied between nodes as they are:
+    raw_files = True
+    ## Records can be stored compressed:
+    can_compress = True
+
+    def __init__(self, data_filename, index_filename=None, durability='none',
+                 recover=False, compress=False):
         if index_filename is None:
             index_filename = data_filename + '.index'
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Unknown durability %r (should be one of %s)'
+                             % (durability, ', '.join(DURABILITY_MODES)))
         self.index_filename = index_filename
         self.data_filename = data_filename
+        self.dictionary_filename = data_filename + '.dict'
+        ## The RecordCodec of the dictionary, once there is one (see
+        ## `_get_codec`):
+        self._codec = None
+        self.durability = durability
+        self.compress = compress
+        self._group = commit_group(index_filename)
         try:
             self.index_fp = open(index_filename, 'r+b')
         except IOError, e:
@@ -43,6 +129,71 @@ class Database(object):
                 lock_file(self.index_fp, LOCK_UN, 0, 0, os.SEEK_SET)
         fd = os.open(data_filename, os.O_RDWR | os.O_CREAT)
         self.data_fp = os.fdopen(fd, 'r+b')
+        note_open(self, 'cutout')
+        ## A process that crashed while writing (and was restarted
+        ## without a full recovery pass) leaves a torn tail; what was
+        ## repaired when opening is kept as `recovered`:
+        self.recovered = (0, 0)
+        if recover or self._torn():
+            self.recovered = self.recover()
+
+    def _torn(self):
+        """Cheaply checks if the end of the database looks like a
+        write was cut short: a partial index record, or a last record
+        that goes past the end of the data.  (A write that is under way
+        can look the same; `recover` waits for it, and then finds
+        nothing to repair.)"""
+        index_size = os.fstat(self.index_fp.fileno()).st_size
+        if index_size < 12 or index_size % 12:
+            return True
+        self.index_fp.seek(index_size - 12)
+        length, pos, count = triple_encoding.unpack(self.index_fp.read(12))
+        return pos + (length & LENGTH_MASK) > os.fstat(self.data_fp.fileno()).st_size
+
+    def recover(self):
+        """Repairs the end of the database after a crash.
+
+        Only the tail is checked: a partial index record is removed,
+        then index records that point past the end of the data file
+        are removed (working backward until one fits), and then any
+        data after the last indexed record is removed.  This takes
+        time proportional to the damage, not the size of the database.
+
+        Returns (index_records_removed, data_bytes_removed)."""
+        with lock_complete(self.index_fp):
+            self.index_fp.seek(0, os.SEEK_END)
+            index_size = self.index_fp.tell()
+            self.data_fp.seek(0, os.SEEK_END)
+            data_size = self.data_fp.tell()
+            removed = 0
+            if index_size < 12:
+                ## Not even the 0/0/0 record survived
+                removed = int(index_size > 0)
+                self.index_fp.seek(0)
+                self.index_fp.truncate()
+                self.index_fp.write(triple_encoding.pack(0, 0, 0))
+                self.index_fp.flush()
+                index_size = 12
+            good_size = index_size - index_size % 12
+            if good_size != index_size:
+                removed += 1
+            data_end = 0
+            while good_size > 12:
+                self.index_fp.seek(good_size - 12)
+                length, pos, count = triple_encoding.unpack(self.index_fp.read(12))
+                length &= LENGTH_MASK
+                if pos + length <= data_size:
+                    data_end = pos + length
+                    break
+                good_size -= 12
+                removed += 1
+            if good_size != index_size:
+                self.index_fp.seek(good_size)
+                self.index_fp.truncate()
+            if data_end != data_size:
+                self.data_fp.seek(data_end)
+                self.data_fp.truncate()
+            return removed, data_size - data_end
 
     def _read_last_count(self):
         """Reads the counter of the last item appended"""
@@ -61,79 +212,177 @@ class Database(object):
         last = self._read_last_count()
         if last <= seek_count:
             return
-        last_pos = self.index_fp.tell() / 12
-        # Let's guess where we should go...
-        ## FIXME: might be better to count back absolutely, instead of
-        ## using the range
-        guess = last_pos * seek_count / last
-        self.index_fp.seek(guess * 12 + 8)
+        records = self.index_fp.tell() / 12
+        ## The first record (0/0/0) has a count no greater than
+        ## seek_count and the last a count greater, so bisect between
+        ## them.  Counters are usually dense near the end, so first try
+        ## counting back from the end; after garbage collection there
+        ## are gaps, and the bisection finds the right place anyway.
         least = 0
-        greatest = last_pos
-        while 1:
-            chunk = self.index_fp.read(4)
-            if len(chunk) < 4:
-                return
-            count, = int_encoding.unpack(chunk)
-            if count == seek_count:
-                return
-            if seek_count > count:
-                least = guess
+        greatest = records - 1
+        guess = records - 1 - (last - seek_count)
+        probes = [guess, guess + 1]
+        while greatest - least > 1:
+            if probes:
+                index = probes.pop(0)
+                if not least < index < greatest:
+                    continue
             else:
-                greatest = guess
-            if greatest - least < 1:
-                # either we've bounded the target, or we've bounded an
-                # empty spot (meaning the target doesn't exist, but
-                # we're okay)
-                if greatest != guess:
-                    # We're not at the right place yet
-                    self.index_fp.seek(greatest * 12)
-                return
-            diff = seek_count - count
-            self.index_fp.seek(diff * 12 - 4, os.SEEK_CUR)
+                index = (least + greatest) / 2
+            self.index_fp.seek(index * 12 + 8)
+            count, = int_encoding.unpack(self.index_fp.read(4))
+            if count <= seek_count:
+                least = index
+            else:
+                greatest = index
+        self.index_fp.seek(greatest * 12)
 
     def extend(self, datas, expect_latest=None, expect_last_counter=None,
                with_counters=False):
         """Appends the data to the database, returning the integer
         counter for the first item in the data
         """
+        if self.compress:
+            datas = self._compress(datas, with_counters)
+        append = Append(datas, expect_latest, expect_last_counter, with_counters)
+        if self.durability == 'group':
+            self._group.commit(self, append)
+        else:
+            with self._group.locked():
+                self._write([append])
+        if append.error is not None:
+            raise append.error[0], append.error[1], append.error[2]
+        return append.result
+
+    def _compress(self, datas, with_counters):
+        """Returns `datas` with the records that compress well
+        replaced by `Compressed` data"""
+        datas = list(datas)
+        codec = self._get_codec()
+        if codec is None:
+            codec = self._train(datas, with_counters)
+            if codec is None:
+                return datas
+        result = []
+        for data in datas:
+            if with_counters:
+                count, data = data
+            compressed = codec.compress(data)
+            if compressed is not None:
+                data = Compressed(compressed)
+            result.append((count, data) if with_counters else data)
+        return result
+
+    def _train(self, datas, with_counters):
+        """Writes a dictionary trained on the latest records and the
+        new `datas` (if there are enough of them), returning its
+        codec or None"""
+        if with_counters:
+            datas = [data for count, data in datas]
+        length = self.length()
+        if length + len(datas) < compression.TRAIN_RECORDS:
+            return None
+        samples = [data for count, data in
+                   self.read(max(0, length - compression.SAMPLE_RECORDS))]
+        samples.extend(datas)
+        self._codec = compression.write_dictionary(
+            self.dictionary_filename, compression.train_dictionary(samples))
+        return self._codec
+
+    def _get_codec(self):
+        """Returns the codec of the database's dictionary, or None if
+        it doesn't have one yet.  A dictionary is never changed once
+        records have been compressed with it, so the codec is kept
+        until this database's files are replaced or moved (by
+        `overwrite` or `rename`); a database whose files are replaced
+        by others (as `cutout.sync.Storage.decode_db` does) is
+        reopened."""
+        if self._codec is None:
+            self._codec = compression.codec_for(self.dictionary_filename)
+        return self._codec
+
+    def _decompress(self, compressed):
+        codec = self._get_codec()
+        if codec is None:
+            raise IOError("Compressed record, but no dictionary for %s"
+                          % self.data_filename)
+        return codec.decompress(compressed)
+
+    def _write(self, appends):
+        """Writes all the appends in one ``lock_append`` window.
+
+        All the data is written (and with durability, synced) before
+        any of the index, so an index entry never points at data that
+        might not be on disk.  Each append gets its own result or
+        error; a failed expectation only fails that append."""
         with lock_append(self.index_fp):
+            try:
+                check_not_moved(self.index_fp, self.index_filename)
+            except DatabaseMoved:
+                for append in appends:
+                    append.error = sys.exc_info()
+                return
             count = self._read_last_count()
-            if expect_latest is not None and count > expect_latest:
-                raise ExpectationFailed
-            if expect_last_counter is not None and count != expect_last_counter:
-                raise ExpectationFailed
-            first_datas = None
-            self.index_fp.seek(0, os.SEEK_END)
             self.data_fp.seek(0, os.SEEK_END)
             pos = self.data_fp.tell()
-            for data in datas:
-                if with_counters:
-                    next_count, data = data
-                    assert next_count > count, "Bad next count: %r (should be greater than %r)" % (next_count, count)
-                    count = next_count
-                else:
-                    count += 1
-                if first_datas is None:
-                    first_datas = count
-                assert isinstance(data, str)
-                length = len(data)
-                self.data_fp.write(data)
-                self.index_fp.write(triple_encoding.pack(length, pos, count))
-                pos += length
-            return first_datas
-
-    def read(self, above, last=-1):
+            data_chunks = []
+            index_chunks = []
+            for append in appends:
+                try:
+                    count, records = append.prepare(count)
+                except:
+                    append.error = sys.exc_info()
+                    continue
+                for record_count, data in records:
+                    length = len(data)
+                    assert length < COMPRESSED, "Record too long: %i bytes" % length
+                    flags = COMPRESSED if isinstance(data, Compressed) else 0
+                    data_chunks.append(data)
+                    index_chunks.append(triple_encoding.pack(length | flags, pos, record_count))
+                    pos += length
+            if not index_chunks:
+                return
+            self.data_fp.write(''.join(data_chunks))
+            ## Other readers (and the lock) only see what has reached the OS:
+            self.data_fp.flush()
+            if self.durability != 'none':
+                fdatasync(self.data_fp.fileno())
+            self.index_fp.seek(0, os.SEEK_END)
+            self.index_fp.write(''.join(index_chunks))
+            self.index_fp.flush()
+            if self.durability != 'none':
+                fdatasync(self.index_fp.fileno())
+
+    def read(self, above, last=-1, max_bytes=None):
         """Yields items starting at `above` and until (and including)
-        `last` if it is given"""
+        `last` if it is given.
+
+        If `max_bytes` is given, stops before the data would add up to
+        more than that (but always yields at least one item)"""
+        for count, data, position in self._read(above, last, max_bytes):
+            yield count, data
+
+    def _read(self, above, last=-1, max_bytes=None):
+        """Yields ``(count, data, position)``, like `read_with_positions`"""
         assert isinstance(above, int)
         assert above >= 0
         self._seek_index(above)
         last_pos = None
+        total = 0
         while 1:
             chunk = self.index_fp.read(12)
             if not chunk or len(chunk) < 12:
                 break
             length, pos, count = triple_encoding.unpack(chunk)
+            compressed = length & COMPRESSED
+            length &= LENGTH_MASK
+            ## (the size of a compressed record is only known once it
+            ## has been decompressed)
+            first = last_pos is None
+            if not compressed:
+                total += length
+                if max_bytes is not None and total > max_bytes and not first:
+                    break
             assert count > above, "failed: count=%r > above=%r; chunk=%r; tell=%r; trip=%r" % (count, above, chunk, self.index_fp.tell(), [length, pos, count, self.index_filename, self.index_fp.seek(0) or self.index_fp.read(), self.data_fp.seek(0) or self.data_fp.read()])
             if last_pos is None:
                 self.data_fp.seek(pos)
@@ -147,10 +396,49 @@ class Database(object):
                 # But this must be the last complete record
                 break
             last_pos += length
-            yield count, data
+            if compressed:
+                index_pos = self.index_fp.tell() - 12
+                data = self._decompress(data)
+                total += len(data)
+                if max_bytes is not None and total > max_bytes and not first:
+                    break
+                yield count, data, INDEX_POSITION | index_pos
+            else:
+                yield count, data, pos
             if last > 0 and last <= count:
                 break
 
+    def read_with_positions(self, above):
+        """Like `read`, but yields ``(count, data, position)``, where
+        position is where the data starts in the data file (for use
+        with `read_at`), or for compressed records where the record is
+        in the index (with `INDEX_POSITION` set)"""
+        return self._read(above)
+
+    def read_at(self, position, length):
+        """Returns the data at a position given by `read_with_positions`"""
+        if position & INDEX_POSITION:
+            self.index_fp.seek(position & ~INDEX_POSITION)
+            chunk = self.index_fp.read(12)
+            if len(chunk) < 12:
+                raise TruncatedFile()
+            stored_length, position, count = triple_encoding.unpack(chunk)
+            if not stored_length & COMPRESSED:
+                raise TruncatedFile()
+            self.data_fp.seek(position)
+            stored = self.data_fp.read(stored_length & LENGTH_MASK)
+            if len(stored) < stored_length & LENGTH_MASK:
+                raise TruncatedFile()
+            data = self._decompress(stored)
+            if len(data) != length:
+                raise TruncatedFile()
+            return data
+        self.data_fp.seek(position)
+        data = self.data_fp.read(length)
+        if len(data) < length:
+            raise TruncatedFile()
+        return data
+
     def get_file_positions(self, until):
         """Return (index_position, database_position) where the
         position is the start of the record `until`, or whatever
@@ -205,19 +493,23 @@ class Database(object):
             chunk = self.index_fp.read(12)
             if not chunk:
                 break
-            length, pos, count = triple_encoding.unpack(chunk)
+            flagged_length, pos, count = triple_encoding.unpack(chunk)
+            ## Compressed records are copied as they are:
+            length = flagged_length & LENGTH_MASK
             if count in exclude_counts:
                 assert count != 0
                 self.data_fp.seek(length, os.SEEK_CUR)
                 continue
             assert self.data_fp.tell() == pos
-            index_fp.write(triple_encoding.pack(length, data_fp_pos, count))
+            index_fp.write(triple_encoding.pack(flagged_length, data_fp_pos, count))
             data = self.data_fp.read(length)
             assert len(data) == length
             data_fp.write(data)
             data_fp_pos += length
         data_fp.close()
         index_fp.close()
+        if os.path.exists(self.dictionary_filename):
+            shutil.copyfile(self.dictionary_filename, dest_filename + '.dict')
 
     def overwrite(self, data_filename, index_filename):
         """Overwrites this database with the given files"""
@@ -231,26 +523,186 @@ class Database(object):
             ## to pre-allocate space?  Readers would currently get
             ## confused.
             with open(index_filename, 'rb') as fp:
-                shutil.copyfile(fp, self.index_fp)
+                shutil.copyfileobj(fp, self.index_fp)
             with open(data_filename, 'rb') as fp:
-                shutil.copyfile(fp, self.data_fp)
+                shutil.copyfileobj(fp, self.data_fp)
+            self.index_fp.flush()
+            self.data_fp.flush()
+            if os.path.exists(data_filename + '.dict'):
+                with open(data_filename + '.dict', 'rb') as fp:
+                    self._codec = compression.write_dictionary(
+                        self.dictionary_filename, fp.read(), replace=True)
+            else:
+                self._codec = None
             ## FIXME: should I use any renames?
             ## I could truncate the old files to invalidate them, then
             ## rename both?
 
+    def rename(self, data_filename, index_filename=None):
+        """Moves the database files to new names"""
+        if index_filename is None:
+            index_filename = data_filename + '.index'
+        with lock_complete(self.index_fp):
+            os.rename(self.data_filename, data_filename)
+            os.rename(self.index_filename, index_filename)
+            if os.path.exists(self.dictionary_filename):
+                os.rename(self.dictionary_filename, data_filename + '.dict')
+        self.data_filename = data_filename
+        self.index_filename = index_filename
+        self.dictionary_filename = data_filename + '.dict'
+        self._codec = None
+
+    @staticmethod
+    def is_empty(data_filename, index_filename=None):
+        """True if the database at this filename has no items (or
+        doesn't exist), without opening it"""
+        if index_filename is None:
+            index_filename = data_filename + '.index'
+        return (not os.path.exists(index_filename)
+                or os.path.getsize(index_filename) == 12)
+
     def delete(self):
         self.close()
         os.unlink(self.index_filename)
         os.unlink(self.data_filename)
+        if os.path.exists(self.dictionary_filename):
+            os.unlink(self.dictionary_filename)
 
     def close(self):
+        note_closed(self, 'cutout')
         self.index_fp.close()
         self.data_fp.close()
 
 
+class Append(object):
+    """One call to `Database.extend`, waiting to be written"""
+
+    def __init__(self, datas, expect_latest, expect_last_counter, with_counters):
+        self.datas = datas
+        self.expect_latest = expect_latest
+        self.expect_last_counter = expect_last_counter
+        self.with_counters = with_counters
+        self.result = None
+        ## sys.exc_info() if this append failed:
+        self.error = None
+        self.done = False
+
+    def prepare(self, count):
+        """Given the last count in the database, checks the
+        expectations and returns the new last count and a list of
+        ``(count, data)`` records to write"""
+        if self.expect_latest is not None and count > self.expect_latest:
+            raise ExpectationFailed
+        if self.expect_last_counter is not None and count != self.expect_last_counter:
+            raise ExpectationFailed
+        records = []
+        for data in self.datas:
+            if self.with_counters:
+                next_count, data = data
+                assert next_count > count, "Bad next count: %r (should be greater than %r)" % (next_count, count)
+                count = next_count
+            else:
+                count += 1
+            if self.result is None:
+                self.result = count
+            assert isinstance(data, str)
+            records.append((count, data))
+        return count, records
+
+
+class CommitGroup(object):
+    """Coalesces concurrent `Database.extend` calls on one database.
+
+    The first thread to arrive becomes the leader and writes its
+    append along with any others that are waiting; appends that
+    arrive while it is writing wait, and are all written by the next
+    leader, with one pair of fdatasyncs.
+
+    Every database uses ``write_lock`` to keep threads in one process
+    from writing at the same time, which ``lockf`` (a per-process
+    lock) does not do."""
+
+    def __init__(self):
+        self.write_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.pending = []
+        self.leading = False
+
+    def commit(self, db, append):
+        with self.cond:
+            self.pending.append(append)
+            while not append.done:
+                if self.leading:
+                    self.cond.wait()
+                    continue
+                self.leading = True
+                appends, self.pending = self.pending, []
+                self.cond.release()
+                try:
+                    try:
+                        with self.locked():
+                            group_appends.observe(len(appends))
+                            db._write(appends)
+                    except:
+                        error = sys.exc_info()
+                        for other in appends:
+                            other.error = error
+                finally:
+                    self.cond.acquire()
+                    self.leading = False
+                    for other in appends:
+                        other.done = True
+                    self.cond.notify_all()
+
+    @contextmanager
+    def locked(self):
+        """Holds ``write_lock``, noting how long it took to get"""
+        start = time.time()
+        with self.write_lock:
+            write_lock_wait.observe(time.time() - start)
+            yield
+
+
+_commit_groups = weakref.WeakValueDictionary()
+_commit_groups_lock = threading.Lock()
+
+
+def commit_group(filename):
+    """Returns the process-wide `CommitGroup` for the database with
+    this index filename (kept only while some `Database` uses it)"""
+    filename = os.path.abspath(filename)
+    with _commit_groups_lock:
+        group = _commit_groups.get(filename)
+        if group is None:
+            group = _commit_groups[filename] = CommitGroup()
+        return group
+
+
+_open_databases = {}
+_open_databases_lock = threading.Lock()
+
+
+def note_open(db, engine):
+    """Counts `db` in the ``cutout_open_databases`` gauge until
+    `note_closed` is called (or it is garbage collected)"""
+    with _open_databases_lock:
+        dbs = _open_databases.get(engine)
+        if dbs is None:
+            dbs = _open_databases[engine] = weakref.WeakSet()
+            open_databases.labels(engine=engine).set_function(lambda: len(dbs))
+        dbs.add(db)
+
+
+def note_closed(db, engine):
+    with _open_databases_lock:
+        _open_databases[engine].discard(db)
+
+
 @contextmanager
 def lock_append(fp):
+    start = time.time()
     lock_file(fp, LOCK_EX, 0, 0, os.SEEK_END)
+    lock_append_wait.observe(time.time() - start)
     yield
     lock_file(fp, LOCK_UN, 0, 0, os.SEEK_END)
 
@@ -0,0 +1,141 @@
+"""Administrative commands for a node's data: ``cutout-admin``
+
+    cutout-admin --dir DIR COMMAND [ARGS]
+
+Commands:
+
+recover
+    Checks and repairs the tail of every database, for use after a
+    crash (before the node is started again).  ``cutout-server`` does
+    this itself when it finds the last shutdown wasn't clean.
+
+expire
+    Garbage collects every database that has expired records.  Each
+    database's expiry index tells whether anything in it has expired
+    without reading the database.
+
+lookup DOMAIN USERNAME BUCKET ID [TYPE]
+    Prints the latest record of one object, using the database's
+    object index (building or updating it as necessary).
+
+pack [DAYS]
+    Moves the databases that haven't been written for DAYS (default
+    30) into shared segment files (see `cutout.pack`), garbage
+    collecting them first, and removes segments that are no longer
+    used.  The node can keep running.
+
+unpack
+    Moves every packed database back to its own directory.
+"""
+import sys
+import time
+import optparse
+from cutout.sync import UserStorage
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] COMMAND [ARGS]',
+    description="Administers the databases of a Cut-Out node")
+
+parser.add_option('--dir', metavar='DIRECTORY', default='./data',
+                  help='Directory the node stores files in (default: %default)')
+parser.add_option('--engine', metavar='ENGINE', default='cutout',
+                  help='Database engine the node uses (default: %default)')
+
+commands = {}
+
+
+def command(func):
+    commands[func.__name__.replace('_', '-')] = func
+    return func
+
+
+@command
+def recover(storage, args):
+    """Checks and repairs the tail of every database"""
+    damaged = storage.recover_all()
+    for domain, username, bucket, damage in damaged:
+        for name, (records, data_bytes) in sorted(damage.items()):
+            print 'Repaired %s/%s/%s %s: removed %i index records and %i bytes of data' % (
+                domain, username, bucket, name, records, data_bytes)
+    print '%i databases repaired' % len(damaged)
+
+
+@command
+def expire(storage, args):
+    """Removes expired records from every database"""
+    now = time.time()
+    checked = collected = removed = 0
+    ## (packed databases were collected when they were packed)
+    for domain, username, bucket in storage.all_dbs(include_packed=False):
+        db = storage.for_user(domain, username, bucket)
+        ## (a database being migrated is copied as it is)
+        if db.is_deprecated or db.migrating_to:
+            continue
+        checked += 1
+        if not db.expiry.has_expired(db.db, now):
+            continue
+        to_remove = db.collect(expire_time=now)
+        collected += 1
+        removed += len(to_remove)
+        print 'Collected %s/%s/%s: removed %i records' % (
+            domain, username, bucket, len(to_remove))
+    print '%i databases checked, %i collected, %i records removed' % (
+        checked, collected, removed)
+
+
+@command
+def lookup(storage, args):
+    """Prints the latest record of an object"""
+    if len(args) not in (4, 5):
+        parser.error('Usage: lookup DOMAIN USERNAME BUCKET ID [TYPE]')
+    domain, username, bucket, id = args[:4]
+    type = args[4] if len(args) > 4 else None
+    db = storage.for_user(domain, username, bucket)
+    found = db.objects.get(db.db, type, id)
+    if found is None:
+        print 'No object %r (type %r) in %s/%s/%s' % (id, type, domain, username, bucket)
+        return 1
+    print '%i %s' % found
+
+
+@command
+def pack(storage, args):
+    """Packs the databases that haven't been written for a while"""
+    if len(args) > 1:
+        parser.error('Usage: pack [DAYS]')
+    try:
+        days = float(args[0]) if args else 30
+    except ValueError:
+        parser.error('DAYS must be a number: %r' % args[0])
+    checked = packed = 0
+    for domain, username, bucket in storage.all_dbs(include_packed=False):
+        checked += 1
+        if storage.pack(domain, username, bucket, idle=days * 24 * 60 * 60):
+            packed += 1
+    removed = storage.packs.compact()
+    print '%i databases checked, %i packed, %i unused segments removed' % (
+        checked, packed, len(removed))
+
+
+@command
+def unpack(storage, args):
+    """Unpacks every packed database"""
+    unpacked = 0
+    for key in storage.packs.keys():
+        domain, username, bucket = storage.packed_names(key)
+        if storage.unpack(domain, username, bucket):
+            unpacked += 1
+    removed = storage.packs.compact()
+    print '%i databases unpacked, %i segments removed' % (unpacked, len(removed))
+
+
+def main(args=None):
+    options, args = parser.parse_args(args)
+    if not args or args[0] not in commands:
+        parser.error('You must give a command (one of: %s)' % ', '.join(sorted(commands)))
+    storage = UserStorage(options.dir, engine=options.engine)
+    return commands[args[0]](storage, args[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""Serving syncclient.js: rendered once per base URL, compressed and
+cached
+
+The script has the URL of the server it was loaded from substituted
+into it, so there is one variant of it for each base URL.  Each
+variant is rendered once (optionally minified) and kept in memory
+along with its gzipped form and ETags; only the most recent
+`ScriptAsset.max_variants` base URLs are kept, so requests with made
+up Host headers can't use up memory.
+
+The file is checked for changes at most every `check_interval`
+seconds, and a change replaces all the variants.
+
+Responses carry an ETag (a matching ``If-None-Match`` gets a 304).
+The script's version is a hash of the file, and a request with
+``?v=VERSION`` (see `ScriptAsset.version`) for the current version is
+cached for a year; other requests must be revalidated.
+"""
+import os
+import re
+import time
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+from webob import Response
+
+## How long versioned responses may be cached:
+LONG_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class Variant(object):
+    """The script for one base URL"""
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = gzip_body(body)
+        digest = hashlib.md5(body).hexdigest()[:20]
+        self.etag = digest
+        self.gzipped_etag = digest + '-gz'
+
+
+class ScriptAsset(object):
+
+    check_interval = 1.0
+    max_variants = 64
+
+    def __init__(self, filename, render, minify=False):
+        self.filename = filename
+        ## A function of (source, base_url) that returns the script:
+        self.render = render
+        self.minify = minify
+        self._lock = threading.Lock()
+        self._variants = OrderedDict()
+        self._mtime = None
+        self._source = None
+        self.version = None
+        self._checked = 0
+
+    def _load(self):
+        """Reads the file if it has changed (checking at most every
+        `check_interval` seconds); returns the source"""
+        now = time.time()
+        if self._source is not None and now - self._checked < self.check_interval:
+            return self._source
+        with self._lock:
+            self._checked = now
+            mtime = os.stat(self.filename).st_mtime
+            if mtime != self._mtime or self._source is None:
+                with open(self.filename, 'rb') as fp:
+                    source = fp.read()
+                self._mtime = mtime
+                self._source = source
+                self.version = hashlib.md5(source).hexdigest()[:12]
+                self._variants.clear()
+            return self._source
+
+    def current_version(self):
+        self._load()
+        return self.version
+
+    def variant(self, base_url):
+        source = self._load()
+        with self._lock:
+            variant = self._variants.pop(base_url, None)
+            if variant is None:
+                body = self.render(source, base_url)
+                if self.minify:
+                    body = minify(body)
+                variant = Variant(body)
+            ## Most recently used last:
+            self._variants[base_url] = variant
+            while len(self._variants) > self.max_variants:
+                self._variants.popitem(last=False)
+            return variant
+
+    def response(self, req, base_url):
+        """Returns the response to a GET of the script"""
+        variant = self.variant(base_url)
+        if 'gzip' in req.accept_encoding:
+            body, etag = variant.gzipped, variant.gzipped_etag
+        else:
+            body, etag = variant.body, variant.etag
+        resp = Response(content_type='text/javascript', charset=None)
+        resp.etag = etag
+        resp.vary = ('Accept-Encoding',)
+        if req.GET.get('v') == self.version:
+            resp.cache_control = 'public, max-age=%i' % LONG_MAX_AGE
+        else:
+            resp.cache_control = 'no-cache'
+        if etag in req.if_none_match:
+            resp.status = 304
+            return resp
+        resp.body = body
+        if body is variant.gzipped:
+            resp.content_encoding = 'gzip'
+        return resp
+
+
+def gzip_body(body):
+    out = StringIO()
+    ## With no time or name, the same body always compresses the same:
+    zipper = gzip.GzipFile(filename='', mode='wb', fileobj=out, compresslevel=9, mtime=0)
+    zipper.write(body)
+    zipper.close()
+    return out.getvalue()
+
+
+_comment_line_re = re.compile(r'^\s*//.*$', re.M)
+_indent_re = re.compile(r'^[ \t]+', re.M)
+_blank_lines_re = re.compile(r'\n\s*\n+')
+
+
+def minify(script):
+    """A conservative minifier: removes indentation, whole-line ``//``
+    comments and blank lines.  It doesn't look inside the code, so it
+    can't break it (the script has no multi-line strings); gzip does
+    most of the rest."""
+    script = _comment_line_re.sub('', script)
+    script = _indent_re.sub('', script)
+    script = _blank_lines_re.sub('\n', script)
+    return script.strip() + '\n'
@@ -1,57 +1,272 @@
 """WSGI application that distributes sync requests to various nodes.
 """
 import os
+import time
+import threading
+import Queue
+from collections import OrderedDict, namedtuple
 from webob.dec import wsgify
 from webob import Request
+from webob import exc
 from hash_ring import HashRing
 import urllib
 import urlparse
 from cutout import sync
+from cutout import stats
+from cutout import timing
 from cutout.forwarder import forward
 
 
+## Query parameters that mark a GET as a management request, which
+## must always go to the master node:
+internal_params = set(['copy', 'paste', 'deprecate', 'delete',
+                       'backup-from-pos', 'position'])
+
+send_seconds = stats.registry.histogram(
+    'cutout_balancer_send_seconds',
+    'Time taken by nodes to respond to the balancer, by node', ('node',))
+send_errors = stats.registry.counter(
+    'cutout_balancer_send_errors_total',
+    'Requests to nodes that failed without a response, by node', ('node',))
+replica_probes = stats.registry.counter(
+    'cutout_balancer_replica_probes_total',
+    'Position probes of backup nodes, by whether the node could serve the read',
+    ('result',))
+hedged_requests = stats.registry.counter(
+    'cutout_balancer_hedged_total',
+    'GETs sent to a second node because the first was slow')
+
+
 class Application(object):
-    """Application to route requests to nodes, and backup nodes"""
+    """Application to route requests to nodes, and backup nodes
+
+    If `read_backups` is true then GET requests may be served by a
+    backup node, so long as that backup has caught up to everything
+    this balancer has seen written to the database.  If `hedge_after`
+    is given (in seconds) then a GET that hasn't been answered in that
+    time is also sent to a second (current) node, and whichever
+    answers first is used.
+    """
+
+    ## How long (in seconds) the positions learned from masters, and
+    ## from probes of backups, are trusted; after that backups are
+    ## probed again:
+    position_ttl = 600
+    replica_position_ttl = 60
+    ## How many databases positions are kept for (each):
+    max_positions = 100000
 
-    def __init__(self, preload=None, preload_dir=None, backups=1):
+    def __init__(self, preload=None, preload_dir=None, backups=1,
+                 read_backups=False, hedge_after=None, prefix=''):
         self.subnodes = {}
         self.basedir = preload_dir
         nodes = []
         if preload:
             for i in xrange(preload):
-                name = 'node-%03i' % i
+                name = '%snode-%03i' % (prefix, i)
                 dir = os.path.join(preload_dir, name)
                 app = sync.Application(dir=dir)
                 self.subnodes[name] = app
                 nodes.append(name)
         self.ring = HashRing(nodes)
         self.backups = backups
+        self.read_backups = read_backups
+        self.hedge_after = hedge_after
+        self.latency = NodeLatency()
+        ## The last position we know was written for each database path:
+        self.positions = PositionCache(self.max_positions, self.position_ttl)
+        ## The last position each (node, path) was probed at:
+        self.replica_positions = PositionCache(self.max_positions, self.replica_position_ttl)
 
     @wsgify
     def __call__(self, req):
+        """Routes the request, adding the request ID and timings (see
+        `cutout.timing`)"""
+        if 'cutout.balanced' in req.environ:
+            ## Sent to a subnode through the root, which is this app
+            return self.route(req)
+        req.environ['cutout.balanced'] = True
+        start = time.time()
+        ## Made now, so copies of the request share it:
+        timing.request_id(req.environ)
+        resp = None
+        try:
+            resp = self.route(req)
+            return resp
+        except exc.HTTPException, e:
+            resp = e
+            raise
+        finally:
+            timing.finish(req, resp, 'balancer', start)
+
+    def route(self, req):
+        if req.path_info == '/stats':
+            ## The nodes in this process share these stats
+            if not req.environ.get('cutout.internal'):
+                raise exc.HTTPForbidden('authorized only for internal')
+            return stats.response(req)
         first = req.path_info_peek()
         if first in self.subnodes:
             req.path_info_pop()
-            return self.subnodes[first]
+            return req.send(self.subnodes[first])
         path = req.path_info
+        if (req.method == 'GET' and (self.read_backups or self.hedge_after)
+            and '/+static' not in path and not internal_params.intersection(req.GET)):
+            return self.read(req, path)
         iterator = iter(self.ring.iterate_nodes(path))
         subnode_url = iterator.next()
-        subnode = SubNode(subnode_url)
         if self.backups and req.method == 'POST':
             backup_to = []
             for i in xrange(self.backups):
                 backup_to.append(iterator.next())
             req.headers['X-Backup-To'] = ', '.join(backup_to)
-        return req.send(subnode)
+        resp = self.send(req, subnode_url)
+        self.note_position(path, resp)
+        return resp
+
+    def send(self, req, node):
+        """Sends the request to the given node, keeping track of how
+        long the node took to respond"""
+        start = time.time()
+        try:
+            with timing.timings(req.environ).phase('send', desc=node):
+                return req.send(SubNode(node))
+        except:
+            send_errors.labels(node=node).inc()
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.latency.record(node, elapsed)
+            send_seconds.labels(node=node).observe(elapsed)
+
+    def note_position(self, path, resp):
+        """Remembers the position the master reported for the
+        database, which backups must reach before they serve reads.
+
+        If the master is behind what we knew, or has a new
+        collection_id, the database was deleted or reset, and what was
+        known about the backups' copies is forgotten too"""
+        position = resp.headers.get('X-Sync-Position')
+        if not position or resp.status_code >= 300:
+            return
+        position = int(position)
+        collection_id = resp.headers.get('X-Sync-Collection-Id')
+        known = self.positions.get(path)
+        if known is not None:
+            same_collection = (collection_id is None or known.collection_id is None
+                               or collection_id == known.collection_id)
+            if position >= known.position and same_collection:
+                self.positions.note(path, position, collection_id or known.collection_id)
+                return
+            for node in self.node_list(path)[1:]:
+                self.replica_positions.forget((node, path))
+        self.positions.note(path, position, collection_id)
+
+    def read(self, req, path):
+        """Serves a GET from the master or from any backup that is
+        current, preferring whichever node has been responding fastest,
+        and hedging slow requests if `hedge_after` is set"""
+        nodes = self.node_list(path)
+        master = nodes[0]
+        candidates = [master]
+        if self.read_backups:
+            try:
+                since = int(req.GET.get('since', 0))
+            except ValueError:
+                since = 0
+            known = self.positions.get(path)
+            needed = max(since, known.position if known else 0)
+            if needed:
+                ## Without knowing what has been written we can't know
+                ## if a backup is current, so it only gets used once
+                ## the master has told us a position.
+                collection_id = known.collection_id if known else None
+                for node in nodes[1:]:
+                    if self.replica_position(req, node, path, needed, collection_id) >= needed:
+                        candidates.append(node)
+        candidates = self.latency.order(candidates)
+        if self.hedge_after is None or len(candidates) < 2:
+            node = candidates[0]
+            resp = self.send(req, node)
+        else:
+            node, resp = self.hedged_send(req, candidates[:2])
+        if node == master:
+            self.note_position(path, resp)
+        return resp
+
+    def replica_position(self, req, node, path, needed, collection_id=None):
+        """Returns the position of the database on the given node,
+        probing the node if the last known position isn't enough (or
+        is for another collection_id, or is too old to trust)"""
+        key = (node, path)
+        known = self.replica_positions.get(key)
+        if (known is not None and known.position >= needed
+            and (collection_id is None or known.collection_id == collection_id)):
+            return known.position
+        probe = req.copy()
+        ## Not using probe.GET, which can be shared with req:
+        probe.query_string = '&'.join(filter(None, [req.query_string, 'position']))
+        resp = self.send(probe, node)
+        if resp.status_code != 200:
+            replica_probes.labels(result='failed').inc()
+            return 0
+        position = int(resp.headers.get('X-Sync-Position') or 0)
+        probed_collection_id = resp.headers.get('X-Sync-Collection-Id')
+        if collection_id is not None and probed_collection_id != collection_id:
+            ## The backup has a different database (from before a
+            ## reset, or not yet copied after one):
+            replica_probes.labels(result='behind').inc()
+            return 0
+        self.replica_positions.note(key, position, probed_collection_id)
+        replica_probes.labels(result='current' if position >= needed else 'behind').inc()
+        return position
+
+    def hedged_send(self, req, nodes):
+        """Sends the request to the first node, and if it hasn't
+        responded within `hedge_after` seconds, to the second node as
+        well.  Returns ``(node, resp)`` for the first response."""
+        results = Queue.Queue()
+
+        def run(node, node_req):
+            try:
+                results.put((node, self.send(node_req, node), None))
+            except Exception, e:
+                results.put((node, None, e))
+
+        started = 0
+        for node in nodes:
+            thread = threading.Thread(target=run, args=(node, req.copy()))
+            thread.daemon = True
+            thread.start()
+            started += 1
+            try:
+                node, resp, error = results.get(timeout=self.hedge_after)
+            except Queue.Empty:
+                if started < len(nodes):
+                    hedged_requests.inc()
+                continue
+            if error is None:
+                return node, resp
+            started -= 1
+        while started:
+            node, resp, error = results.get()
+            started -= 1
+            if error is None:
+                return node, resp
+        raise error
 
-    def add_node(self, url, create=False, root=None):
-        """Adds a new node, with the given url/name"""
+    def add_node(self, url, create=False, root=None, live=True):
+        """Adds a new node, with the given url/name
+
+        With `live` the databases that move to the node stay available
+        while they are copied (see `cutout.sync.Application.node_added`)
+        """
         if create:
             dir = os.path.join(self.basedir, url)
             app = sync.Application(dir=dir)
             self.subnodes[url] = app
         node = SubNode(url)
-        node.added(self.ring.nodes, backups=self.backups, root=root)
+        node.added(self.ring.nodes, backups=self.backups, root=root, live=live)
         self.ring = HashRing(self.ring.nodes + [url])
 
     def remove_node(self, url, root=None, force=False):
@@ -73,6 +288,71 @@ class Application(object):
         return nodes
 
 
+class KnownPosition(namedtuple('KnownPosition', 'position collection_id time')):
+    """A position noted in a `PositionCache`"""
+
+
+class PositionCache(object):
+    """The last known positions (and collection_ids) of databases,
+    keeping at most `max_entries` (dropping the least recently used)
+    and forgetting them after `ttl` seconds"""
+
+    def __init__(self, max_entries, ttl, timer=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the `KnownPosition` for the key, or None"""
+        with self._lock:
+            known = self._entries.pop(key, None)
+            if known is None or self.timer() - known.time > self.ttl:
+                return None
+            self._entries[key] = known
+            return known
+
+    def note(self, key, position, collection_id=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = KnownPosition(position, collection_id, self.timer())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class NodeLatency(object):
+    """Keeps a moving average of how long each node takes to respond"""
+
+    def __init__(self, weight=0.2):
+        self.weight = weight
+        self.averages = {}
+        self._lock = threading.Lock()
+
+    def record(self, node, seconds):
+        with self._lock:
+            if node not in self.averages:
+                self.averages[node] = seconds
+            else:
+                self.averages[node] += self.weight * (seconds - self.averages[node])
+
+    def get(self, node):
+        """The average response time for the node, or None if unknown"""
+        return self.averages.get(node)
+
+    def order(self, nodes):
+        """Returns the nodes, fastest first.  Nodes we haven't timed yet
+        come first, so that they get measured."""
+        return sorted(nodes, key=lambda node: self.averages.get(node, 0))
+
+
 class SubNode(object):
     """Represents one node."""
 
@@ -93,10 +373,11 @@ class SubNode(object):
         resp.headers['X-Node-Name'] = self.url
         return resp
 
-    def added(self, other_nodes, backups=0, root=None):
+    def added(self, other_nodes, backups=0, root=None, live=False):
         """Called when the node was added"""
         req = Request.blank(
-            self.url + '/node-added', json={'other': other_nodes, 'new': self.url, 'backups': backups})
+            self.url + '/node-added',
+            json={'other': other_nodes, 'new': self.url, 'backups': backups, 'live': live})
         print forward(req, root=root).body.strip()
 
     def remove(self, other_nodes, backups=0, root=None, force=False):
@@ -0,0 +1,384 @@
+"""Benchmarks for the storage layer: ``python -m cutout.benchmark DIR``
+
+Where `cutout.performance` runs a mixed workload and reports
+throughput, this measures each storage operation separately and
+reports latency percentiles (p50/p95/p99), over:
+
+* each database engine (see `cutout.sync.engines`)
+* several record sizes and database sizes
+* ``Database.extend``, reads from the tail, of a random range, and of
+  the whole database
+* `cutout.gc.collect`, and reads of the sparse database it leaves
+* ``Storage.encode_db`` and ``Storage.decode_db``
+* filtered GETs (``?include=TYPE``) through `cutout.sync.Application`
+* with the cutout engine, writes and reads of realistic app records
+  stored plain and compressed (see `cutout.compression`), along with
+  the size of each on disk
+
+Reads are run with a warm page cache and, where the platform allows
+dropping a file's pages (``posix_fadvise``), a cold one.
+
+``--json FILE`` saves the results, and ``--baseline FILE`` compares
+them with saved results, listing any case that got slower by more
+than ``--threshold`` and exiting with status 1 if there are any.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import ctypes
+import ctypes.util
+import optparse
+from cStringIO import StringIO
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from webob import Request
+from cutout import gc, streamdb
+from cutout import Database
+from cutout.performance import percentile
+from cutout.sync import engines, UserStorage, Application
+
+POSIX_FADV_DONTNEED = 4
+
+
+def _load_fadvise():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fadvise = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    return fadvise
+
+_fadvise = _load_fadvise()
+
+
+def can_drop_cache():
+    return _fadvise is not None
+
+
+def drop_cache(filenames):
+    """Evicts the files from the page cache (they are synced first, as
+    dirty pages can't be dropped), and forgets any in-memory indexes,
+    so the next read is like the first read after a restart"""
+    for filename in filenames:
+        if not filename or not os.path.exists(filename):
+            continue
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            _fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    with streamdb._indexes_lock:
+        streamdb._indexes.clear()
+
+
+def db_files(db):
+    return [db.data_filename, getattr(db, 'index_filename', None)]
+
+
+def timed(func, reps, before=None):
+    """Runs `func` `reps` times, returning the seconds each took
+    (not counting `before`, which is run before each)"""
+    latencies = []
+    for i in xrange(reps):
+        if before is not None:
+            before()
+        start = time.time()
+        func()
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def make_record(index, record_size, distinct):
+    """A record for object ``index % distinct``, so with `distinct`
+    less than the number of records some are superseded"""
+    item = {'id': str(index % distinct),
+            'type': 'small' if index % 4 else 'big',
+            'data': ''}
+    item['data'] = 'x' * max(0, record_size - len(json.dumps(item)))
+    return json.dumps(item)
+
+
+WORDS = ('the of and to in news recipe travel music weather sports video '
+         'photos home page blog review guide how best free new').split()
+SITES = ['www.%s.com' % name for name in
+         'example mozilla wikipedia github news cooking travelguide'.split()]
+
+
+def make_app_record(index):
+    """A record like those apps sync: bookmarks, history and tabs, with
+    the same keys each time but varied URLs, titles and times"""
+    rand = random.Random(index)
+    url = 'http://%s/%s' % (rand.choice(SITES),
+                            '/'.join(rand.sample(WORDS, rand.randint(1, 4))))
+    title = ' '.join(rand.sample(WORDS, rand.randint(2, 6))).title()
+    modified = 1330000000 + index * 37 + rand.randint(0, 30)
+    kind = index % 3
+    if kind == 0:
+        item = {'id': 'bookmark-%i' % index, 'type': 'bookmark', 'url': url,
+                'title': title, 'tags': rand.sample(WORDS, rand.randint(0, 3)),
+                'parent': 'folder-%i' % rand.randint(1, 5),
+                'added': modified, 'modified': modified}
+    elif kind == 1:
+        item = {'id': 'history-%i' % index, 'type': 'history', 'url': url,
+                'title': title, 'visits': [
+                    {'date': modified - rand.randint(0, 100000), 'transition': 1}
+                    for i in range(rand.randint(1, 3))]}
+    else:
+        item = {'id': 'tab-%i' % index, 'type': 'tab', 'url': url,
+                'title': title, 'device': 'device-%i' % rand.randint(1, 3),
+                'lastUsed': modified, 'pinned': rand.random() < 0.1}
+    return json.dumps(item)
+
+
+class Suite(object):
+
+    def __init__(self, dir, engine_names=None, record_sizes=(100, 1000, 10000),
+                 db_sizes=(1000, 10000), reps=50, cold=True, batch=5,
+                 compression=True):
+        self.dir = dir
+        self.engine_names = engine_names or sorted(engines)
+        self.record_sizes = record_sizes
+        self.db_sizes = db_sizes
+        self.reps = reps
+        self.cold = cold and can_drop_cache()
+        self.batch = batch
+        self.compression = compression and 'cutout' in self.engine_names
+        self.results = {}
+        ## {db_size: {'raw': bytes, 'plain': bytes, 'compressed': bytes, 'ratio': fraction}}
+        self.sizes = {}
+
+    def record(self, name, latencies):
+        self.results[name] = latencies
+
+    def run(self, progress=None):
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.makedirs(self.dir)
+        try:
+            for engine in self.engine_names:
+                for record_size in self.record_sizes:
+                    for db_size in self.db_sizes:
+                        prefix = '%s/%ib/%i' % (engine, record_size, db_size)
+                        if progress:
+                            progress(prefix)
+                        self.run_database(prefix, engine, record_size, db_size)
+                        self.run_storage(prefix, engine, record_size, db_size)
+            if self.compression:
+                for db_size in self.db_sizes:
+                    prefix = 'compression/%i' % db_size
+                    if progress:
+                        progress(prefix)
+                    self.run_compression(prefix, db_size)
+        finally:
+            shutil.rmtree(self.dir)
+        return summarize(self.results)
+
+    def read_cases(self, prefix, db):
+        length = db.length()
+        reps = self.reps
+        all_reps = max(3, reps / 10)
+        cases = [
+            ('read-tail', reps, lambda: list(db.read(max(0, length - 10)))),
+            ('read-range', reps, lambda: self._read_range(db, length)),
+            ('read-all', all_reps, lambda: list(db.read(0))),
+            ]
+        for name, count, func in cases:
+            self.record('%s/%s/warm' % (prefix, name), timed(func, count))
+            if self.cold:
+                self.record('%s/%s/cold' % (prefix, name),
+                            timed(func, count, lambda: drop_cache(db_files(db))))
+
+    def _read_range(self, db, length):
+        start = random.randint(0, max(0, length - 20))
+        return list(db.read(start, start + 20))
+
+    def run_database(self, prefix, engine, record_size, db_size):
+        filename = os.path.join(self.dir, 'db-' + prefix.replace('/', '-'))
+        db = engines[engine](filename)
+        db.clear()
+        ## Half of the objects have a later version, for gc to remove:
+        records = [make_record(i, record_size, db_size / 2) for i in xrange(db_size)]
+        batches = [records[i:i + self.batch] for i in xrange(0, db_size, self.batch)]
+        batches.reverse()
+        self.record(prefix + '/extend', timed(lambda: db.extend(batches.pop()), len(batches)))
+        self.read_cases(prefix, db)
+        start = time.time()
+        gc.collect(db, expire_time=0)
+        self.record(prefix + '/gc.collect', [time.time() - start])
+        self.read_cases(prefix + '/after-gc', db)
+        db.delete()
+
+    def run_storage(self, prefix, engine, record_size, db_size):
+        storage = UserStorage(os.path.join(self.dir, 'storage'), engine=engine)
+        name = prefix.replace('/', '-')
+        source = storage.for_user('bench', 'user', name)
+        source.collection_id
+        for i in xrange(0, db_size, 100):
+            source.extend([make_record(j, record_size, db_size)
+                           for j in xrange(i, min(i + 100, db_size))])
+        reps = max(3, self.reps / 10)
+        encoded = []
+        self.record(prefix + '/encode_db',
+                    timed(lambda: encoded.append(''.join(source.encode_db())), reps))
+        dest = storage.for_user('bench', 'user', name + '-copy')
+        self.record(prefix + '/decode_db',
+                    timed(lambda: dest.decode_db(StringIO(encoded[0])), reps))
+        app = Application(storage=storage)
+        path = '/bench/user/%s?since=1&include=big' % name
+
+        def filtered_get():
+            req = Request.blank(path)
+            req.environ['cutout.internal'] = True
+            resp = req.get_response(app)
+            assert resp.status_code == 200, resp
+        self.record(prefix + '/filtered-get/warm', timed(filtered_get, reps))
+        if self.cold:
+            self.record(prefix + '/filtered-get/cold', timed(
+                filtered_get, reps, lambda: drop_cache(db_files(source.db))))
+
+
+    def run_compression(self, prefix, db_size):
+        records = [make_app_record(i) for i in xrange(db_size)]
+        sizes = self.sizes[db_size] = {'raw': sum(len(data) for data in records)}
+        for name, compress in ('plain', False), ('compressed', True):
+            filename = os.path.join(self.dir, 'db-%s-%s' % (prefix.replace('/', '-'), name))
+            db = Database(filename, compress=compress)
+            db.clear()
+            batches = [records[i:i + self.batch] for i in xrange(0, db_size, self.batch)]
+            batches.reverse()
+            self.record('%s/%s/extend' % (prefix, name),
+                        timed(lambda: db.extend(batches.pop()), len(batches)))
+            self.read_cases('%s/%s' % (prefix, name), db)
+            sizes[name] = os.path.getsize(db.data_filename)
+            if os.path.exists(db.dictionary_filename):
+                sizes[name] += os.path.getsize(db.dictionary_filename)
+            db.delete()
+        sizes['ratio'] = float(sizes['compressed']) / sizes['plain']
+
+
+def summarize(results):
+    """Turns ``{name: [seconds, ...]}`` into ``{name: {n, mean, p50,
+    p95, p99}}``, in milliseconds"""
+    summary = {}
+    for name, latencies in results.items():
+        summary[name] = {
+            'n': len(latencies),
+            'mean': 1000 * sum(latencies) / len(latencies),
+            'p50': 1000 * percentile(latencies, 50),
+            'p95': 1000 * percentile(latencies, 95),
+            'p99': 1000 * percentile(latencies, 99),
+            }
+    return summary
+
+
+def compare(summary, baseline, threshold=0.2, min_ms=0.1, stat='p50'):
+    """Returns ``[(name, baseline_ms, current_ms)]`` for the cases
+    that are more than `threshold` (a fraction) slower than in the
+    baseline.  Differences under `min_ms` are treated as noise."""
+    regressions = []
+    for name in sorted(summary):
+        if name not in baseline:
+            continue
+        before = baseline[name][stat]
+        after = summary[name][stat]
+        if after - before > min_ms and after > before * (1 + threshold):
+            regressions.append((name, before, after))
+    return regressions
+
+
+def print_sizes(sizes, out=sys.stdout):
+    out.write('%10s %12s %12s %12s %6s\n' % ('records', 'raw', 'plain', 'compressed', 'ratio'))
+    for db_size in sorted(sizes):
+        size = sizes[db_size]
+        out.write('%10i %12i %12i %12i %6.3f\n' % (
+            db_size, size['raw'], size['plain'], size['compressed'], size['ratio']))
+
+
+def print_summary(summary, out=sys.stdout):
+    width = max([len(name) for name in summary] + [4])
+    out.write('%-*s %6s %10s %10s %10s\n' % (width, 'case', 'n', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name in sorted(summary):
+        stats = summary[name]
+        out.write('%-*s %6i %10.3f %10.3f %10.3f\n' % (
+            width, name, stats['n'], stats['p50'], stats['p95'], stats['p99']))
+
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] DIR',
+    description="Benchmarks the storage layer, using DIR for scratch files (it is removed afterwards)")
+
+parser.add_option('--engine', metavar='ENGINE', action='append',
+                  help='Engine to benchmark (may be repeated; default: all of %s)' % ', '.join(sorted(engines)))
+parser.add_option('--record-size', metavar='BYTES', type='int', action='append',
+                  help='Record size (may be repeated; default: 100, 1000 and 10000)')
+parser.add_option('--db-size', metavar='RECORDS', type='int', action='append',
+                  help='Database size (may be repeated; default: 1000 and 10000)')
+parser.add_option('--reps', metavar='COUNT', type='int', default=50,
+                  help='Repetitions of each read (default: %default)')
+parser.add_option('--quick', action='store_true',
+                  help='Only small records and databases, for a quick check')
+parser.add_option('--warm-only', action='store_true',
+                  help='Skip the cold page cache cases')
+parser.add_option('--no-compression', action='store_true',
+                  help='Skip the plain and compressed app record cases')
+parser.add_option('--json', metavar='FILE',
+                  help='Write the results as JSON to FILE')
+parser.add_option('--baseline', metavar='FILE',
+                  help='Compare with results saved with --json')
+parser.add_option('--threshold', metavar='FRACTION', type='float', default=0.2,
+                  help='With --baseline, how much slower (p50) counts as a regression (default: %default)')
+
+
+def main(args=None):
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('You must give a scratch directory')
+    record_sizes = options.record_size or ((100,) if options.quick else (100, 1000, 10000))
+    db_sizes = options.db_size or ((1000,) if options.quick else (1000, 10000))
+    suite = Suite(args[0], engine_names=options.engine, record_sizes=record_sizes,
+                  db_sizes=db_sizes, reps=options.reps, cold=not options.warm_only,
+                  compression=not options.no_compression)
+    if not options.warm_only and not suite.cold:
+        print 'Cannot drop the page cache on this platform; only warm cases are run'
+
+    def progress(prefix):
+        sys.stdout.write('\r%-40s' % prefix)
+        sys.stdout.flush()
+    summary = suite.run(progress)
+    sys.stdout.write('\r%-40s\r' % '')
+    print_summary(summary)
+    if suite.sizes:
+        print
+        print_sizes(suite.sizes)
+    if options.json:
+        with open(options.json, 'wb') as fp:
+            fp.write(json.dumps({
+                'time': time.time(),
+                'platform': sys.platform,
+                'cold': suite.cold,
+                'results': summary,
+                'compression': suite.sizes}, indent=2, sort_keys=True))
+        print 'Wrote %s' % options.json
+    if options.baseline:
+        with open(options.baseline, 'rb') as fp:
+            baseline = json.loads(fp.read())['results']
+        regressions = compare(summary, baseline, options.threshold)
+        for name, before, after in regressions:
+            print 'REGRESSION %s: p50 %.3fms -> %.3fms (+%i%%)' % (
+                name, before, after, 100 * (after - before) / before)
+        if regressions:
+            return 1
+        print 'No regressions against %s' % options.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
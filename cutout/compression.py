@@ -0,0 +1,168 @@
+"""Compression of single records, with a dictionary trained on each
+database
+
+Records are small and mostly alike (the same keys, types and
+formatting), so compressing each one on its own gains little; what
+they have in common with the other records of the database is what
+makes them compressible.  Each database that compresses its records
+gets a dictionary (see `train_dictionary`) of what its records
+repeat most, kept next to its data file (``DATA.dict``) and
+never changed once written.
+
+This zlib has no preset dictionaries (``zdict``), so `RecordCodec`
+gets the same effect by compressing the dictionary first: a raw
+deflate stream is primed with the dictionary and sync-flushed, and
+each record is compressed with a copy of the primed compressor, so it
+can refer back to anything in the dictionary.  A record's compressed
+form is only what the copy writes after the priming; it is
+decompressed with a copy of a decompressor that has read the primed
+output.
+"""
+import os
+import zlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+## The largest dictionary trained (deflate can refer back 32KB, and
+## the record itself needs some of that):
+DICTIONARY_SIZE = 16 * 1024
+## A database gets a dictionary once it has this many records:
+TRAIN_RECORDS = 32
+## The records read to train a dictionary:
+SAMPLE_RECORDS = 256
+## Records shorter than this are not compressed:
+MIN_LENGTH = 32
+LEVEL = 6
+
+
+def fragments(data):
+    """Splits a record into the pieces dictionaries are made of: for
+    JSON, each ``"key":value`` and the punctuation around it"""
+    pieces = data.split(',"')
+    return [pieces[0]] + [',"' + piece for piece in pieces[1:]]
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """Returns a dictionary for records like `samples`: the latest
+    samples as they are (which have the prefixes and words that
+    records share, even where whole fragments differ), followed by
+    the fragments that appear in more than one sample.  The most
+    common fragments come last, where they are cheapest to refer
+    to."""
+    common = common_fragments(samples, size / 2)
+    whole = []
+    total = len(common)
+    for data in reversed(samples):
+        if total + len(data) > size:
+            break
+        whole.append(data)
+        total += len(data)
+    whole.reverse()
+    return ''.join(whole) + common
+
+
+def common_fragments(samples, size):
+    """The fragments (see `fragments`) that appear in more than one
+    sample, up to `size` bytes, the most common last"""
+    counts = {}
+    for data in samples:
+        for fragment in set(fragments(data)):
+            counts[fragment] = counts.get(fragment, 0) + 1
+    common = [(count * len(fragment), fragment)
+              for fragment, count in counts.items() if count > 1]
+    common.sort(reverse=True)
+    chosen = []
+    total = 0
+    for score, fragment in common:
+        if total + len(fragment) > size:
+            continue
+        chosen.append(fragment)
+        total += len(fragment)
+    chosen.reverse()
+    return ''.join(chosen)
+
+
+class RecordCodec(object):
+    """Compresses and decompresses records using one dictionary"""
+
+    def __init__(self, dictionary, level=LEVEL):
+        self.dictionary = dictionary
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        primed = self._compressor.compress(dictionary)
+        primed += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._decompressor.decompress(primed)
+
+    def compress(self, data):
+        """Returns the compressed record, or None if compressing it
+        doesn't make it smaller"""
+        if len(data) < MIN_LENGTH:
+            return None
+        compressor = self._compressor.copy()
+        compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+        if len(compressed) >= len(data):
+            return None
+        return compressed
+
+    def decompress(self, compressed):
+        decompressor = self._decompressor.copy()
+        return decompressor.decompress(compressed) + decompressor.flush()
+
+
+## Codecs are kept (by the dictionary file's identity) for up to this
+## many dictionaries:
+max_cached_codecs = 1000
+_codecs = OrderedDict()
+_codecs_lock = threading.Lock()
+
+
+def codec_for(filename):
+    """Returns the `RecordCodec` for the dictionary file, or None if
+    there isn't one"""
+    try:
+        stat = os.stat(filename)
+    except OSError, e:
+        if e.errno != 2:
+            raise
+        return None
+    key = (os.path.abspath(filename), stat.st_ino, stat.st_size, stat.st_mtime)
+    with _codecs_lock:
+        codec = _codecs.pop(key, None)
+        if codec is not None:
+            _codecs[key] = codec
+            return codec
+    with open(filename, 'rb') as fp:
+        codec = RecordCodec(fp.read())
+    with _codecs_lock:
+        _codecs[key] = codec
+        while len(_codecs) > max_cached_codecs:
+            _codecs.popitem(last=False)
+    return codec
+
+
+def write_dictionary(filename, dictionary, replace=False):
+    """Writes a dictionary file.  Unless `replace` is true an existing
+    dictionary is kept (it may already have been used), and whichever
+    one is in the file is returned as a `RecordCodec`"""
+    ## Unique to this writer, as other threads (or processes) may be
+    ## writing a dictionary for the same database:
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename) or '.',
+        prefix=os.path.basename(filename) + '.tmp-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(dictionary)
+    try:
+        if replace:
+            os.rename(tmp_filename, filename)
+        else:
+            try:
+                os.link(tmp_filename, filename)
+            except OSError, e:
+                if e.errno != 17:
+                    raise
+    finally:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+    ## The dictionary that won, read back from the file:
+    return codec_for(filename)
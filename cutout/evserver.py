@@ -0,0 +1,596 @@
+"""An event-loop HTTP server for running the sync application.
+
+All connection I/O happens in one thread using non-blocking sockets,
+so idle keep-alive connections and slow uploads or downloads cost a
+file descriptor and a little memory, not a thread.  Once a request
+has been completely received (the body is spooled to memory, or to a
+temporary file if it is large) it is handed to a bounded pool of
+worker threads that call the WSGI application.  The response is
+streamed back as the application produces it.
+
+Concurrency limits:
+
+`max_connections`: the most open connections; when reached we stop
+accepting new connections until some close.
+
+`threads`: the number of requests the application is running at
+once.
+
+`max_pending`: the number of complete requests that may wait for a
+worker; beyond that requests get an immediate ``503`` with
+``Retry-After``.
+
+Request bodies must have a ``Content-Length`` (chunked uploads get
+``411 Length Required``).  Responses without a ``Content-Length`` are
+sent with chunked encoding to HTTP/1.1 clients.
+"""
+import os
+import sys
+import errno
+import socket
+import select
+import threading
+import time
+import tempfile
+import traceback
+import urllib
+import Queue
+from cStringIO import StringIO
+
+status_reasons = {
+    400: 'Bad Request',
+    411: 'Length Required',
+    413: 'Request Entity Too Large',
+    431: 'Request Header Fields Too Large',
+    503: 'Service Unavailable',
+    }
+
+
+class Poller(object):
+    """Uses epoll when available, otherwise select()"""
+
+    def __init__(self):
+        self.epoll = getattr(select, 'epoll', None) and select.epoll()
+        self.fds = {}
+
+    def register(self, fd, read, write):
+        mask = (read, write)
+        if self.fds.get(fd) == mask:
+            return
+        if self.epoll:
+            events = (read and select.EPOLLIN) | (write and select.EPOLLOUT)
+            if fd in self.fds:
+                self.epoll.modify(fd, events)
+            else:
+                self.epoll.register(fd, events)
+        self.fds[fd] = mask
+
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+            if self.epoll:
+                self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """Returns a list of (fd, readable, writable)"""
+        try:
+            return self._poll(timeout)
+        except (IOError, OSError, select.error), e:
+            ## Interrupted by a signal, like SIGTERM asking us to shut down
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+    def _poll(self, timeout):
+        if self.epoll:
+            result = []
+            for fd, events in self.epoll.poll(timeout):
+                result.append((fd, bool(events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR)),
+                               bool(events & select.EPOLLOUT)))
+            return result
+        readers = [fd for fd, (read, write) in self.fds.iteritems() if read]
+        writers = [fd for fd, (read, write) in self.fds.iteritems() if write]
+        readable, writable, ignore = select.select(readers, writers, [], timeout)
+        writable = set(writable)
+        result = [(fd, True, fd in writable) for fd in readable]
+        result.extend((fd, False, True) for fd in writable if fd not in readable)
+        return result
+
+
+class Connection(object):
+    """The state of one client connection"""
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.version = 'HTTP/1.0'
+        self.requests = 0
+        self.last_active = time.time()
+        self.lock = threading.Lock()
+        self.drained = threading.Condition(self.lock)
+        self.reset()
+
+    def reset(self):
+        self.inbuf = ''
+        self.headers = None
+        self.environ = None
+        self.body = None
+        self.body_left = 0
+        ## Output written by a worker, read by the loop:
+        self.out = []
+        self.out_size = 0
+        self.out_done = False
+        self.busy = False
+        self.keep_alive = False
+        self.closed = False
+
+    @property
+    def wants_write(self):
+        return bool(self.out)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def push(self, data, done=False):
+        """Called by a worker to queue output.  Blocks while too much
+        output is waiting for a slow client."""
+        with self.lock:
+            while (self.out_size > self.server.max_output and not self.closed):
+                self.drained.wait(1)
+            if self.closed:
+                return
+            if data:
+                self.out.append(data)
+                self.out_size += len(data)
+            if done:
+                self.out_done = True
+        self.server.wake(self)
+
+
+class Server(object):
+    """Serves a WSGI application; see the module docstring for the
+    concurrency limits"""
+
+    def __init__(self, app, host='127.0.0.1', port=8088, sock=None,
+                 threads=10, max_connections=5000, max_pending=100,
+                 max_requests=None, max_header_size=64 * 1024,
+                 max_body_size=None, spool_size=1024 * 1024,
+                 max_output=1024 * 1024, idle_timeout=300, stop_grace=2):
+        self.app = app
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, port))
+            sock.listen(1024)
+        sock.setblocking(0)
+        self.sock = sock
+        self.sock_fd = sock.fileno()
+        self.host, self.port = sock.getsockname()[:2]
+        self.threads = threads
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.max_requests = max_requests
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.spool_size = spool_size
+        self.max_output = max_output
+        self.idle_timeout = idle_timeout
+        self.stop_grace = stop_grace
+        self.connections = {}
+        self.poller = Poller()
+        self.jobs = Queue.Queue()
+        self.pending = 0
+        self.requests_handled = 0
+        self.running = False
+        self.stopping = False
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in self._wake_read, self._wake_write:
+            set_nonblocking(fd)
+        self._pending_lock = threading.Lock()
+        ## Connections whose polling needs to be updated:
+        self.dirty = set()
+        self._dirty_lock = threading.Lock()
+        self.workers = []
+
+    def wake(self, conn=None):
+        """Wakes up the loop, from a worker thread"""
+        if conn is not None:
+            with self._dirty_lock:
+                self.dirty.add(conn)
+        try:
+            os.write(self._wake_write, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def serve_forever(self):
+        self.running = True
+        for i in xrange(self.threads):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.poller.register(self._wake_read, True, False)
+        self.poller.register(self.sock_fd, True, False)
+        last_sweep = time.time()
+        try:
+            while self.running:
+                if self.stopping and not self.connections:
+                    break
+                self.update_accepting()
+                for fd, readable, writable in self.poller.poll(1):
+                    if fd == self._wake_read:
+                        self.read_wake()
+                    elif self.sock is not None and fd == self.sock_fd:
+                        self.accept()
+                    elif fd in self.connections:
+                        conn = self.connections[fd]
+                        if readable:
+                            self.handle_read(conn)
+                        if writable and not conn.closed:
+                            self.handle_write(conn)
+                        self.dirty.add(conn)
+                with self._dirty_lock:
+                    dirty, self.dirty = self.dirty, set()
+                for conn in dirty:
+                    self.update_poll(conn)
+                now = time.time()
+                if now - last_sweep > 1:
+                    self.close_idle(now)
+                    last_sweep = now
+        finally:
+            for i in xrange(self.threads):
+                self.jobs.put(None)
+            self.running = False
+
+    def shutdown(self):
+        """Stops accepting connections, finishes any requests in
+        progress, and then returns from serve_forever"""
+        self.stopping = True
+        self.wake()
+
+    def update_accepting(self):
+        if self.max_requests and self.requests_handled >= self.max_requests:
+            self.stopping = True
+        if self.stopping:
+            if self.sock is not None:
+                ## Anything already queued on the socket would be lost
+                ## when it is closed, so we take those first:
+                self.accept()
+                self.poller.unregister(self.sock_fd)
+                self.sock.close()
+                self.sock = None
+            now = time.time()
+            for conn in self.connections.values():
+                ## Connections that haven't sent their first request
+                ## yet get a moment to do so:
+                if (not conn.busy and not conn.out and not conn.inbuf
+                    and (conn.requests or now - conn.last_active > self.stop_grace)):
+                    self.close(conn)
+        elif len(self.connections) >= self.max_connections:
+            self.poller.unregister(self.sock_fd)
+        else:
+            self.poller.register(self.sock_fd, True, False)
+
+    def read_wake(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def accept(self):
+        while len(self.connections) < self.max_connections:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(0)
+            conn = Connection(self, sock, addr)
+            self.connections[sock.fileno()] = conn
+            self.poller.register(sock.fileno(), True, False)
+
+    def update_poll(self, conn):
+        if conn.closed:
+            return
+        with conn.lock:
+            wants_write = conn.wants_write
+            finished = conn.out_done and not conn.out
+        if finished:
+            self.finish_response(conn)
+            if conn.closed:
+                return
+            wants_write = False
+        ## We don't read the next request until this response is done:
+        self.poller.register(conn.fileno(), not conn.busy, wants_write)
+
+    def close_idle(self, now):
+        for conn in self.connections.values():
+            if not conn.busy and now - conn.last_active > self.idle_timeout:
+                self.close(conn)
+
+    def close(self, conn):
+        with conn.lock:
+            conn.closed = True
+            conn.drained.notify_all()
+        fd = conn.fileno()
+        self.poller.unregister(fd)
+        self.connections.pop(fd, None)
+        if conn.body is not None:
+            conn.body.close()
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+
+    def handle_read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.close(conn)
+            return
+        if not data:
+            self.close(conn)
+            return
+        conn.last_active = time.time()
+        if conn.busy:
+            ## Pipelined data, keep it until the current response is done
+            conn.inbuf += data
+            return
+        conn.inbuf += data
+        self.process_input(conn)
+
+    def process_input(self, conn):
+        if conn.environ is None:
+            end = conn.inbuf.find('\r\n\r\n')
+            if end == -1:
+                if len(conn.inbuf) > self.max_header_size:
+                    self.error(conn, 431)
+                return
+            head, conn.inbuf = conn.inbuf[:end], conn.inbuf[end + 4:]
+            try:
+                environ = self.make_environ(conn, head)
+            except ValueError:
+                self.error(conn, 400)
+                return
+            if environ.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+                self.error(conn, 411)
+                return
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                self.error(conn, 400)
+                return
+            if self.max_body_size is not None and length > self.max_body_size:
+                self.error(conn, 413)
+                return
+            conn.environ = environ
+            conn.body_left = length
+            if length > self.spool_size:
+                conn.body = tempfile.TemporaryFile()
+            else:
+                conn.body = StringIO()
+            if environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+                conn.out.append('HTTP/1.1 100 Continue\r\n\r\n')
+        if conn.body_left:
+            chunk = conn.inbuf[:conn.body_left]
+            conn.inbuf = conn.inbuf[len(chunk):]
+            conn.body.write(chunk)
+            conn.body_left -= len(chunk)
+        if not conn.body_left:
+            self.dispatch(conn)
+
+    def make_environ(self, conn, head):
+        lines = head.split('\r\n')
+        method, path, version = lines[0].split(' ', 2)
+        if not version.startswith('HTTP/'):
+            raise ValueError('Bad version: %r' % version)
+        if '?' in path:
+            path, query = path.split('?', 1)
+        else:
+            query = ''
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': conn.addr[0] if conn.addr else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            }
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+                environ[name] = value
+            else:
+                key = 'HTTP_' + name
+                if key in environ:
+                    value = environ[key] + ',' + value
+                environ[key] = value
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        conn.version = version
+        if version == 'HTTP/1.1':
+            conn.keep_alive = connection != 'close'
+        else:
+            conn.keep_alive = connection == 'keep-alive'
+        return environ
+
+    def dispatch(self, conn):
+        conn.busy = True
+        conn.body.seek(0)
+        conn.environ['wsgi.input'] = conn.body
+        with self._pending_lock:
+            if self.pending >= self.threads + self.max_pending:
+                busy = True
+            else:
+                busy = False
+                self.pending += 1
+        if busy:
+            conn.busy = False
+            self.error(conn, 503, headers=[('Retry-After', '10')])
+            return
+        self.jobs.put(conn)
+
+    def error(self, conn, status, headers=()):
+        body = '%s %s' % (status, status_reasons[status])
+        lines = ['HTTP/1.1 %s' % body,
+                 'Content-Type: text/plain',
+                 'Content-Length: %i' % len(body),
+                 'Connection: close']
+        lines.extend('%s: %s' % header for header in headers)
+        conn.keep_alive = False
+        conn.out.append('\r\n'.join(lines) + '\r\n\r\n' + body)
+        conn.out_done = True
+        conn.busy = True
+
+    def handle_write(self, conn):
+        with conn.lock:
+            data = ''.join(conn.out)
+            conn.out = []
+            conn.out_size = 0
+        if not data:
+            return
+        try:
+            sent = conn.sock.send(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self.close(conn)
+                return
+        conn.last_active = time.time()
+        with conn.lock:
+            if sent < len(data):
+                rest = data[sent:]
+                conn.out.insert(0, rest)
+                conn.out_size += len(rest)
+            conn.drained.notify_all()
+
+    def finish_response(self, conn):
+        """Called in the loop once the worker has pushed the complete
+        response and it has all been sent"""
+        if conn.body is not None:
+            conn.body.close()
+        conn.requests += 1
+        if not conn.keep_alive or self.stopping:
+            self.close(conn)
+            return
+        leftover = conn.inbuf
+        conn.reset()
+        if leftover:
+            conn.inbuf = leftover
+            self.process_input(conn)
+
+    def work(self):
+        while 1:
+            conn = self.jobs.get()
+            if conn is None:
+                return
+            try:
+                self.run_app(conn)
+            finally:
+                with self._pending_lock:
+                    self.pending -= 1
+                    self.requests_handled += 1
+
+    def run_app(self, conn):
+        environ = conn.environ
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response['status'] = status
+            response['headers'] = headers
+            return lambda data: send(data)
+
+        def send(data):
+            if not response.get('sent'):
+                send_headers()
+            if not data:
+                return
+            if response['chunked']:
+                data = '%x\r\n%s\r\n' % (len(data), data)
+            conn.push(data)
+
+        def send_headers():
+            response['sent'] = True
+            headers = response['headers']
+            names = set(name.lower() for name, value in headers)
+            chunked = False
+            if 'content-length' not in names:
+                if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                    chunked = True
+                    headers = headers + [('Transfer-Encoding', 'chunked')]
+                else:
+                    conn.keep_alive = False
+            if not conn.keep_alive:
+                headers = headers + [('Connection', 'close')]
+            elif conn.version == 'HTTP/1.0':
+                headers = headers + [('Connection', 'keep-alive')]
+            response['chunked'] = chunked
+            lines = ['HTTP/1.1 %s' % response['status']]
+            lines.extend('%s: %s' % header for header in headers)
+            conn.push('\r\n'.join(lines) + '\r\n\r\n')
+
+        failed = False
+        try:
+            app_iter = self.app(environ, start_response)
+            try:
+                for data in app_iter:
+                    send(data)
+                    if conn.closed:
+                        break
+                if not response.get('sent'):
+                    send_headers()
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        except Exception:
+            traceback.print_exc()
+            if not response.get('sent'):
+                response['status'] = '500 Internal Server Error'
+                response['headers'] = [('Content-Type', 'text/plain'), ('Content-Length', '21')]
+                send('Internal Server Error')
+            else:
+                ## Without the final chunk the client can tell the
+                ## response was cut off
+                failed = True
+                conn.keep_alive = False
+        if response.get('chunked') and not failed:
+            conn.push('0\r\n\r\n', done=True)
+        else:
+            conn.push('', done=True)
+
+
+def set_nonblocking(fd):
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def serve(app, host='127.0.0.1', port=8088, **kw):
+    """Serves the application until interrupted"""
+    server = Server(app, host=host, port=port, **kw)
+    print 'serving on http://%s:%s' % (server.host, server.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
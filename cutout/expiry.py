@@ -0,0 +1,248 @@
+"""An index of the records in a database that expire
+
+Records can have an ``expire`` time, after which garbage collection
+removes them.  Finding them otherwise means parsing every record of
+every database, even when nothing has expired.  An `ExpiryIndex`
+keeps, next to the database, the ``(expire, count)`` of just the
+records that have an expire time, ordered by time, with the earliest
+time in the header; `ExpiryIndex.next_expiry` is then one small read,
+and `ExpiryIndex.expired` reads only the entries that have expired.
+
+Like `cutout.objindex.ObjectIndex` it records the last counter it has
+seen and catches up with the log when used, and starts over when the
+log gets shorter.  Writes of records that expire add them with
+`ExpiryIndex.add` (other writes don't touch the index); an index that
+is behind, or was never built, catches up when garbage collection or
+``cutout-admin expire`` next uses it, not in a request.  New entries are appended unsorted after the sorted
+ones, and merged in once there are enough of them.
+"""
+import os
+import struct
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from cutout import lock_complete
+
+## magic, last synced count, data file size, sorted entries, all entries, earliest expire
+header_encoding = struct.Struct('<4sQQIId')
+## expire, count
+entry_encoding = struct.Struct('<dQ')
+MAGIC = 'CEXP'
+## Records without an expire time are skipped without parsing them:
+expire_marker = '"expire"'
+
+
+def record_expire(data):
+    """Returns the expire time of the encoded record, or None"""
+    if expire_marker not in data:
+        return None
+    return json.loads(data).get('expire') or None
+
+
+class ExpiryIndex(object):
+
+    ## The unsorted entries are merged in when there are more than
+    ## this, or more than 1/8 as many as are sorted:
+    min_merge = 64
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _lock(self):
+        """Returns a file to lock while changing the index"""
+        return open(self.filename + '.lock', 'ab')
+
+    def _read_header(self, fp):
+        header = fp.read(header_encoding.size)
+        if len(header) < header_encoding.size:
+            return 0, 0, 0, 0, None
+        magic, synced, data_size, sorted_entries, entries, earliest = header_encoding.unpack(header)
+        if not entries:
+            earliest = None
+        return synced, data_size, sorted_entries, entries, earliest
+
+    def _write(self, entries, synced, data_size, sorted_entries=None):
+        """Writes a new index file, with `entries` (a list of ``(expire,
+        count)``) of which the first `sorted_entries` are in order"""
+        if sorted_entries is None:
+            entries = sorted(entries)
+            sorted_entries = len(entries)
+        earliest = min(entries)[0] if entries else 0
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(header_encoding.pack(
+                MAGIC, synced, data_size, sorted_entries, len(entries), earliest))
+            fp.write(''.join(entry_encoding.pack(*entry) for entry in entries))
+        os.rename(tmp_filename, self.filename)
+
+    def _entries(self, fp, start, end):
+        fp.seek(header_encoding.size + start * entry_encoding.size)
+        data = fp.read((end - start) * entry_encoding.size)
+        return [entry_encoding.unpack_from(data, offset)
+                for offset in xrange(0, len(data), entry_encoding.size)]
+
+    def _open(self):
+        try:
+            return open(self.filename, 'rb')
+        except IOError, e:
+            if e.errno != 2:
+                raise
+            return None
+
+    def sync(self, db):
+        """Adds any expiring records appended to `db` since the index
+        was last used"""
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                self._sync(db)
+
+    def _sync(self, db):
+        fp = self._open()
+        if fp is None:
+            header = 0, 0, 0, 0, None
+        else:
+            header = self._read_header(fp)
+        synced, data_size, sorted_entries, entries, earliest = header
+        length = db.length()
+        size = os.path.getsize(db.data_filename) if os.path.exists(db.data_filename) else 0
+        if fp is not None and synced == length and data_size <= size:
+            fp.close()
+            return
+        rewrite = fp is None
+        if synced > length or data_size > size:
+            ## The database was rewritten
+            synced = sorted_entries = entries = 0
+            earliest = None
+            rewrite = True
+        new = []
+        for count, data in db.read(synced):
+            expire = record_expire(data)
+            if expire is not None:
+                new.append((expire, count))
+            synced = count
+        self._store(fp, new, synced, size, sorted_entries, entries, earliest, rewrite)
+
+    def add(self, db, records):
+        """Adds the expiring ones of `records` (``(count, data)`` just
+        appended to `db`) without reading the log.  If the index isn't
+        up to date with everything before them (another write got in
+        first, or it was never built) this leaves it as it is, for
+        `sync` to catch up.
+
+        Records that don't expire are left for `sync` too, so most
+        writes don't touch the index (or create it) at all."""
+        new = []
+        for count, data in records:
+            expire = record_expire(data)
+            if expire is not None:
+                new.append((expire, count))
+        if not new:
+            return
+        ## A new database is indexed from the start, but others are
+        ## left for `sync` to build (without making a lock file):
+        if records[0][0] != 1 and not os.path.exists(self.filename):
+            return
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                fp = self._open()
+                if fp is None:
+                    header = 0, 0, 0, 0, None
+                else:
+                    header = self._read_header(fp)
+                synced, data_size, sorted_entries, entries, earliest = header
+                if synced != records[0][0] - 1:
+                    if fp is not None:
+                        fp.close()
+                    return
+                self._store(fp, new, records[-1][0], os.path.getsize(db.data_filename),
+                            sorted_entries, entries, earliest, rewrite=fp is None)
+
+    def _store(self, fp, new, synced, size, sorted_entries, entries, earliest, rewrite):
+        """Adds the `new` entries to the index open as `fp` (which is
+        closed), noting it is synced to `synced`.  The index is
+        rewritten if `rewrite` or there are enough unsorted entries."""
+        if entries + len(new) - sorted_entries > max(self.min_merge, sorted_entries / 8):
+            rewrite = True
+        if rewrite:
+            existing = self._entries(fp, 0, entries) if fp is not None and entries else []
+            if fp is not None:
+                fp.close()
+            self._write(existing + new, synced, size)
+            return
+        fp.close()
+        if new:
+            earliest = min([expire for expire, count in new]
+                           + ([earliest] if earliest is not None else []))
+        with open(self.filename, 'r+b') as fp:
+            fp.seek(header_encoding.size + entries * entry_encoding.size)
+            fp.write(''.join(entry_encoding.pack(*entry) for entry in new))
+            fp.seek(0)
+            fp.write(header_encoding.pack(
+                MAGIC, synced, size, sorted_entries, entries + len(new), earliest or 0))
+
+    def next_expiry(self, db):
+        """Returns the earliest expire time of any record, or None"""
+        self.sync(db)
+        fp = self._open()
+        if fp is None:
+            return None
+        with fp:
+            return self._read_header(fp)[4]
+
+    def has_expired(self, db, now):
+        """True if any record has expired by `now`"""
+        earliest = self.next_expiry(db)
+        return earliest is not None and earliest < now
+
+    def expired(self, db, now):
+        """Returns the set of counts of records that have expired by
+        `now`"""
+        self.sync(db)
+        fp = self._open()
+        if fp is None:
+            return set()
+        with fp:
+            synced, data_size, sorted_entries, entries, earliest = self._read_header(fp)
+            if earliest is None or earliest >= now:
+                return set()
+            result = set()
+            ## The sorted entries are read until one hasn't expired:
+            chunk = 256
+            for start in xrange(0, sorted_entries, chunk):
+                done = False
+                for expire, count in self._entries(fp, start, min(start + chunk, sorted_entries)):
+                    if expire >= now:
+                        done = True
+                        break
+                    result.add(count)
+                if done:
+                    break
+            for expire, count in self._entries(fp, sorted_entries, entries):
+                if expire < now:
+                    result.add(count)
+            return result
+
+    def remove(self, db, counts):
+        """Forgets the records with the given counts, after they have
+        been removed from `db` (by garbage collection)"""
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                fp = self._open()
+                if fp is None:
+                    return
+                with fp:
+                    synced, data_size, sorted_entries, entries, earliest = self._read_header(fp)
+                    kept = [entry for entry in self._entries(fp, 0, entries)
+                            if entry[1] not in counts]
+                ## If the last records were removed the log is now
+                ## shorter, but that doesn't mean it was replaced:
+                self._write(kept, min(synced, db.length()),
+                            os.path.getsize(db.data_filename))
+
+    def clear(self):
+        """Removes the index, so it will be rebuilt when next used"""
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                if os.path.exists(self.filename):
+                    os.unlink(self.filename)
@@ -1,6 +1,7 @@
 from webob.dec import wsgify
 import urllib
 import urlparse
+from cutout import timing
 
 
 @wsgify.middleware
@@ -9,9 +10,33 @@ def rooted(req, app):
     return app
 
 
+def inherit(new_req, req, hop):
+    """Makes `new_req` an internal request made while handling
+    `req`: it is sent to the same root application, carries the same
+    request ID, and the timings in its response are added to those of
+    `req` as the phase `hop` (see `cutout.timing`)"""
+    new_req.environ['cutout.root'] = req.environ.get('cutout.root')
+    new_req.headers[timing.REQUEST_ID_HEADER] = timing.request_id(req.environ)
+    new_req.environ['cutout.parent'] = (timing.timings(req.environ), hop)
+    return new_req
+
+
 def forward(req, new_req=None, root=None):
     if new_req is None:
         new_req = req
+    ## Popped so that anything passing this environ on doesn't add the
+    ## same hop again:
+    parent = new_req.environ.pop('cutout.parent', None)
+    if parent is None:
+        return _forward(req, new_req, root)
+    timings, hop = parent
+    with timings.phase(hop, desc=new_req.path_info.strip('/').split('/', 1)[0]):
+        resp = _forward(req, new_req, root)
+    timings.merge(resp.headers.get('Server-Timing'), hop)
+    return resp
+
+
+def _forward(req, new_req, root):
     if root is not None:
         return new_req.send(root)
     root = root_url = None
@@ -5,29 +5,83 @@ import simplejson as json
 import tempfile
 
 
-def find_to_remove(db, expire_time=None, start=0):
+def find_to_remove(db, expire_time=None, start=0, objects=None, expiry=None):
     """Finds objects that should be deleted, and returns a set of the
-    counts of those objects"""
-    seen = {}
-    to_remove = set()
+    counts of those objects
+
+    If the database's `cutout.objindex.ObjectIndex` is given it is used
+    to tell which records have been superseded, instead of keeping
+    track of every object seen (the record's object is kept, without
+    its data, until the lookups are done).
+    If its `cutout.expiry.ExpiryIndex` is given, expired records are
+    found with that."""
     if expire_time is None:
         expire_time = time.time()
+    expired = None
+    if expiry is not None and expire_time:
+        expired = expiry.expired(db, expire_time)
+    if objects is not None:
+        return _find_with_index(db, expire_time, start, objects, expired)
+    seen = {}
+    to_remove = set()
     for count, item in db.read(start):
         parsed = json.loads(item)
         id = (parsed['id'], parsed.get('type'))
         if id in seen:
             to_remove.add(seen[id])
-        if expire_time and parsed['expire'] and parsed['expire'] < expire_time:
+        if _is_expired(count, parsed, expire_time, expired):
             to_remove.add(count)
             continue
         seen[id] = count
     return to_remove
 
 
-def collect(db, expire_time=None, start=0):
+def _is_expired(count, parsed, expire_time, expired):
+    if expired is not None:
+        return count in expired
+    return bool(expire_time and parsed.get('expire') and parsed['expire'] < expire_time)
+
+
+def _find_with_index(db, expire_time, start, objects, expired):
+    to_remove = set()
+    ## Lookups read from the database as well (moving its file
+    ## positions), so the records are all read before any lookup:
+    candidates = []
+    for count, item in db.read(start):
+        parsed = json.loads(item)
+        if _is_expired(count, parsed, expire_time, expired):
+            to_remove.add(count)
+        else:
+            candidates.append((count, parsed.get('type'), parsed['id']))
+    for count, type, id in candidates:
+        if _is_superseded(db, objects, count, type, id):
+            to_remove.add(count)
+    return to_remove
+
+
+def _is_superseded(db, objects, count, type, id):
+    latest = objects.lookup(db, type, id)
+    if latest is None or latest[0] == count:
+        return False
+    ## Only a hash is indexed, so make sure it really is a later
+    ## version of this object:
+    found = objects.get(db, type, id)
+    return found is not None and found[0] != count
+
+
+def collect(db, expire_time=None, start=0, snapshot=None, objects=None, expiry=None):
     """Finds the objects that should be removed, and removes them from
-    the database"""
-    to_remove = find_to_remove(db, expire_time, start)
+    the database.
+
+    If the database's `cutout.snapshot.Snapshot` is given, it records
+    that the database has been compacted (and drops the removed
+    records it has, which can be expired ones); if its
+    `cutout.objindex.ObjectIndex` is given, it is used to find
+    superseded records and then reset.  A given
+    `cutout.expiry.ExpiryIndex` is used to find expired records, and
+    kept up to date."""
+    last = db.length()
+    to_remove = find_to_remove(db, expire_time, start, objects, expiry)
     dest_dir = tempfile.mkdtemp()
     try:
         dest_fn = os.path.join(dest_dir, 'temp.db')
@@ -36,3 +90,10 @@ def collect(db, expire_time=None, start=0):
         db.overwrite(dest_fn, dest_fn_index)
     finally:
         shutil.rmtree(dest_dir)
+    if snapshot is not None and to_remove:
+        snapshot.note_compaction(last, removed=to_remove)
+    if objects is not None and to_remove:
+        objects.clear()
+    if expiry is not None and to_remove:
+        expiry.remove(db, to_remove)
+    return to_remove
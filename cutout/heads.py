@@ -0,0 +1,245 @@
+"""A table of the head of every database, shared by all the processes
+of a node
+
+Most GETs are polls from clients that are already up to date.  To
+answer those without opening anything, `HeadTable` keeps the
+collection_id and last counter of each database (see `Head`) in a
+file that every process maps into memory.  `cutout.sync.Storage`
+keeps it up to date:
+
+* `extend` marks the database as being written (so it isn't trusted
+  in the meantime) and notes the new last counter afterwards;
+* anything that replaces the database (`clear`, `decode_db`,
+  `deprecate`, `recover`, a new collection_id) invalidates its entry,
+  bumping its generation;
+* a GET that reads the database notes what it saw, which fills in
+  entries after a restart or an invalidation.
+
+A note only counts if the entry's generation is still the one the
+`Storage` saw when it was created, so a note can't undo a
+replacement that happened while it was being made; and the counter
+only ever goes up within a generation.  If a process dies in the
+middle of a write the entry stays marked as being written, and is
+never trusted again until the table is cleared (`UserStorage.start_running`
+does that), so the worst a crash does is make that database's polls
+slower.
+
+The file is a header followed by fixed-size slots, using open
+addressing with linear probing on a hash of the database's directory;
+slots are never freed (until the table is cleared), and a database
+whose slots are all taken just isn't cached.  Writers lock the slot
+(with ``lockf``, and a thread lock in the process) and bump its
+sequence number before and after writing it; readers don't lock, but
+read the slot again if the sequence number was odd or changed.
+"""
+import os
+import mmap
+import struct
+import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from fcntl import lockf as lock_file
+from fcntl import LOCK_UN, LOCK_EX
+
+## magic, slot count, flags
+header_encoding = struct.Struct('<4sII52x')
+## sequence, generation, hash of the key, last counter, writers,
+## flags, collection_id length, collection_id
+slot_encoding = struct.Struct('<II16sQHBB28s')
+MAGIC = 'CHED'
+MAX_COLLECTION_ID = 28
+## The number of slots probed for a key:
+MAX_PROBE = 16
+## How many times a reader retries a slot being written:
+READ_RETRIES = 100
+
+## Header flags:
+DISABLED = 1
+## Slot flags: the counter and collection_id aren't known
+UNKNOWN = 1
+
+EMPTY_KEY = '\0' * 16
+
+
+class Head(namedtuple('Head', 'generation collection_id counter known')):
+    """What the table knows of a database.  Only when `known` can the
+    collection_id and counter be trusted"""
+
+
+class HeadTable(object):
+
+    def __init__(self, filename, slots=1 << 16):
+        self.filename = filename
+        ## (an existing file keeps its own size)
+        self.slots = slots
+        self._lock = threading.Lock()
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        self.fp = os.fdopen(fd, 'r+b')
+        lock_file(self.fp, LOCK_EX, 0, 0, os.SEEK_SET)
+        try:
+            header = self.fp.read(header_encoding.size)
+            if len(header) == header_encoding.size and header[:4] == MAGIC:
+                magic, self.slots, flags = header_encoding.unpack(header)
+            else:
+                self.fp.seek(0)
+                self.fp.truncate(header_encoding.size + self.slots * slot_encoding.size)
+                self.fp.write(header_encoding.pack(MAGIC, self.slots, 0))
+                self.fp.flush()
+        finally:
+            lock_file(self.fp, LOCK_UN, 0, 0, os.SEEK_SET)
+        self.map = mmap.mmap(self.fp.fileno(), 0)
+
+    def close(self):
+        self.map.close()
+        self.fp.close()
+
+    def _offset(self, slot):
+        return header_encoding.size + slot * slot_encoding.size
+
+    def _probe(self, key):
+        """Returns the hash of `key` and the slots it may be in"""
+        digest = hashlib.md5(key).digest()
+        start = struct.unpack('<I', digest[:4])[0] % self.slots
+        return digest, [(start + i) % self.slots for i in range(MAX_PROBE)]
+
+    def _read_slot(self, slot):
+        """Reads a slot consistently, or returns None if it keeps
+        changing"""
+        offset = self._offset(slot)
+        end = offset + slot_encoding.size
+        for i in xrange(READ_RETRIES):
+            data = self.map[offset:end]
+            sequence = int_from(data)
+            if sequence & 1:
+                continue
+            if int_from(self.map[offset:offset + 4]) == sequence:
+                return slot_encoding.unpack(data)
+        return None
+
+    def get(self, key):
+        """Returns the `Head` of the database `key`, or None if it
+        isn't in the table"""
+        digest, slots = self._probe(key)
+        for slot in slots:
+            values = self._read_slot(slot)
+            if values is None:
+                return None
+            sequence, generation, hash, counter, writers, flags, length, collection_id = values
+            if hash == digest:
+                return Head(generation, collection_id[:length], counter,
+                            not writers and not flags & UNKNOWN)
+            if hash == EMPTY_KEY:
+                return None
+        return None
+
+    @contextmanager
+    def _slot(self, key):
+        """Locks and yields the slot for `key` (claiming one if
+        necessary) and its current values, or None if there is no
+        room; the values yielded are written back"""
+        digest, slots = self._probe(key)
+        with self._lock:
+            for slot in slots:
+                offset = self._offset(slot)
+                lock_file(self.fp, LOCK_EX, slot_encoding.size, offset, os.SEEK_SET)
+                try:
+                    values = list(slot_encoding.unpack(self.map[offset:offset + slot_encoding.size]))
+                    if values[2] == EMPTY_KEY:
+                        values = [values[0], 0, digest, 0, 0, UNKNOWN, 0, '']
+                    elif values[2] != digest:
+                        continue
+                    sequence = values[0]
+                    yield values
+                    self.map[offset:offset + 4] = struct.pack('<I', sequence + 1)
+                    values[0] = sequence + 2
+                    data = slot_encoding.pack(*values)
+                    self.map[offset + 4:offset + slot_encoding.size] = data[4:]
+                    self.map[offset:offset + 4] = data[:4]
+                    return
+                finally:
+                    lock_file(self.fp, LOCK_UN, slot_encoding.size, offset, os.SEEK_SET)
+            yield None
+
+    def invalidate(self, key):
+        """Notes that the database `key` has been replaced"""
+        with self._slot(key) as values:
+            if values is not None:
+                values[1] = (values[1] + 1) & 0xffffffff
+                values[5] |= UNKNOWN
+
+    def note(self, key, generation, collection_id, counter):
+        """Notes the head of the database `key`, as seen while its
+        entry had the given `generation`"""
+        if len(collection_id) > MAX_COLLECTION_ID:
+            return
+        with self._slot(key) as values:
+            if values is None or values[1] != generation:
+                return
+            if values[5] & UNKNOWN or values[7][:values[6]] != collection_id:
+                values[5] &= ~UNKNOWN
+                values[3] = counter
+            else:
+                values[3] = max(values[3], counter)
+            values[6] = len(collection_id)
+            values[7] = collection_id
+
+    @contextmanager
+    def writing(self, key):
+        """Marks the database `key` as being written for the ``with``
+        block; if the block fails the entry is invalidated"""
+        with self._slot(key) as values:
+            if values is not None:
+                values[4] += 1
+        try:
+            yield
+        except:
+            self.invalidate(key)
+            raise
+        finally:
+            with self._slot(key) as values:
+                if values is not None and values[4]:
+                    values[4] -= 1
+
+    @property
+    def disabled(self):
+        return bool(header_encoding.unpack(self.map[:header_encoding.size])[2] & DISABLED)
+
+    def disable(self):
+        with self._lock:
+            lock_file(self.fp, LOCK_EX, header_encoding.size, 0, os.SEEK_SET)
+            try:
+                self.map[:header_encoding.size] = header_encoding.pack(MAGIC, self.slots, DISABLED)
+            finally:
+                lock_file(self.fp, LOCK_UN, header_encoding.size, 0, os.SEEK_SET)
+
+    def clear(self, disabled=False):
+        """Forgets every database (for when the databases may have
+        been changed without the table)"""
+        with self._lock:
+            lock_file(self.fp, LOCK_EX, 0, 0, os.SEEK_SET)
+            try:
+                size = len(self.map) - header_encoding.size
+                self.map[header_encoding.size:] = '\0' * size
+                self.map[:header_encoding.size] = header_encoding.pack(
+                    MAGIC, self.slots, DISABLED if disabled else 0)
+            finally:
+                lock_file(self.fp, LOCK_UN, 0, 0, os.SEEK_SET)
+
+
+def int_from(data):
+    return struct.unpack('<I', data[:4])[0]
+
+
+## One table per file in each process:
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def open_table(filename):
+    """Returns the process's `HeadTable` for the file"""
+    with _tables_lock:
+        table = _tables.get(filename)
+        if table is None:
+            table = _tables[filename] = HeadTable(filename)
+        return table
@@ -0,0 +1,227 @@
+"""A persistent index of the latest record of each object
+
+The database itself can only be read in counter order, so finding one
+object means reading the whole log.  An `ObjectIndex` is a hash table
+in a file next to the database, mapping a hash of (type, id) to the
+counter, position and length of the latest record for that object, so
+it can be read with one seek.
+
+The index records the last counter it has seen, and catches up with
+the log (reading only the new records) whenever it is used; storage
+that keeps it up to date on every write does the same.  If the
+database gets shorter (as after garbage collection) the index is
+rebuilt from the start.
+
+The file is a header followed by slots, using open addressing with
+linear probing; when it gets half full it is rewritten at twice the
+size.  All access happens while holding a lock on a separate
+``.lock`` file, since the index file itself is replaced when it grows.
+"""
+import os
+import mmap
+import struct
+import hashlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from cutout import lock_complete, TruncatedFile
+
+## magic, capacity (in slots), used slots, last synced count, data file size
+header_encoding = struct.Struct('<4sIIQQ4x')
+## hash of (type, id), count, position, length
+slot_encoding = struct.Struct('<QIQI')
+MAGIC = 'COBJ'
+
+
+def object_hash(type, id):
+    """A non-zero 64-bit hash of the object's type and id"""
+    if isinstance(type, unicode):
+        type = type.encode('utf8')
+    if isinstance(id, unicode):
+        id = id.encode('utf8')
+    digest = hashlib.md5((type or '') + '\000' + id).digest()
+    return struct.unpack('<Q', digest[:8])[0] or 1
+
+
+def record_key(data):
+    """Returns (type, id) for an encoded record"""
+    item = json.loads(data)
+    return item.get('type') or '', item['id']
+
+
+class ObjectIndex(object):
+
+    initial_capacity = 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_filename = filename + '.lock'
+        self.fp = None
+        self.map = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.fp.close()
+            self.map = self.fp = None
+
+    def clear(self):
+        """Removes the index, so it will be rebuilt when next used"""
+        with self._lock():
+            self.close()
+            if os.path.exists(self.filename):
+                os.unlink(self.filename)
+
+    def _lock(self):
+        return _Locked(self.lock_filename)
+
+    def _open(self):
+        """(Re)opens the index file, creating it if necessary.  Must
+        be called with the lock held."""
+        if self.fp is not None:
+            if (os.path.exists(self.filename)
+                and os.stat(self.filename).st_ino == os.fstat(self.fp.fileno()).st_ino):
+                return
+            ## The file was replaced by another process
+            self.close()
+        if not os.path.exists(self.filename) or not os.path.getsize(self.filename):
+            self._write_table(self.initial_capacity, [], 0, 0)
+        self.fp = open(self.filename, 'r+b')
+        self.map = mmap.mmap(self.fp.fileno(), 0)
+
+    def _write_table(self, capacity, slots, synced, data_size):
+        """Writes a new index file with the given slots, replacing
+        any existing file"""
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            fp.truncate(header_encoding.size + capacity * slot_encoding.size)
+        with open(tmp_filename, 'r+b') as fp:
+            table = mmap.mmap(fp.fileno(), 0)
+            header_encoding.pack_into(table, 0, MAGIC, capacity, 0, synced, data_size)
+            used = 0
+            for slot in slots:
+                if self._insert(table, capacity, slot):
+                    used += 1
+            header_encoding.pack_into(table, 0, MAGIC, capacity, used, synced, data_size)
+            table.close()
+        os.rename(tmp_filename, self.filename)
+        self.close()
+
+    @staticmethod
+    def _insert(table, capacity, slot):
+        """Puts the slot in the table, returning True if it used a
+        new slot (rather than replacing one for the same object)"""
+        mask = capacity - 1
+        index = slot[0] & mask
+        while 1:
+            offset = header_encoding.size + index * slot_encoding.size
+            existing = slot_encoding.unpack_from(table, offset)[0]
+            if existing == 0 or existing == slot[0]:
+                slot_encoding.pack_into(table, offset, *slot)
+                return existing == 0
+            index = (index + 1) & mask
+
+    def _slots(self):
+        magic, capacity, used, synced, data_size = header_encoding.unpack_from(self.map, 0)
+        for index in xrange(capacity):
+            slot = slot_encoding.unpack_from(
+                self.map, header_encoding.size + index * slot_encoding.size)
+            if slot[0]:
+                yield slot
+
+    def _sync(self, db):
+        """Catches up with the database; must be called with the lock held"""
+        self._open()
+        magic, capacity, used, synced, data_size = header_encoding.unpack_from(self.map, 0)
+        length = db.length()
+        size = os.path.getsize(db.data_filename)
+        if synced == length and data_size <= size:
+            return
+        if synced > length or data_size > size:
+            ## The database was rewritten
+            self._write_table(self.initial_capacity, [], 0, 0)
+            self._open()
+            capacity, used, synced = self.initial_capacity, 0, 0
+        for count, data, pos in db.read_with_positions(synced):
+            if (used + 1) * 2 > capacity:
+                slots = list(self._slots())
+                capacity *= 2
+                self._write_table(capacity, slots, synced, size)
+                self._open()
+            type, id = record_key(data)
+            if self._insert(self.map, capacity, (object_hash(type, id), count, pos, len(data))):
+                used += 1
+            synced = count
+        header_encoding.pack_into(self.map, 0, MAGIC, capacity, used, synced, size)
+
+    def sync(self, db):
+        """Adds any records appended to `db` since the index was last
+        used"""
+        with self._lock():
+            self._sync(db)
+
+    def lookup(self, db, type, id):
+        """Returns (count, position, length) of the latest record for
+        the object, or None.  Because only hashes are kept, this might
+        (very rarely) be the record of a different object; `get`
+        checks for that."""
+        with self._lock():
+            self._sync(db)
+            capacity = header_encoding.unpack_from(self.map, 0)[1]
+            hash = object_hash(type, id)
+            index = hash & (capacity - 1)
+            while 1:
+                slot = slot_encoding.unpack_from(
+                    self.map, header_encoding.size + index * slot_encoding.size)
+                if slot[0] == 0:
+                    return None
+                if slot[0] == hash:
+                    return slot[1:]
+                index = (index + 1) & (capacity - 1)
+
+    def get(self, db, type, id):
+        """Returns (count, data) of the latest record for the object,
+        or None"""
+        type = type or ''
+        for attempt in range(2):
+            found = self.lookup(db, type, id)
+            if found is None:
+                return None
+            count, pos, length = found
+            try:
+                data = db.read_at(pos, length)
+                if record_key(data) == (type, id):
+                    return count, data
+            except (ValueError, KeyError, TruncatedFile, IOError):
+                pass
+            except Exception, e:
+                ## Such as cutout.streamdb.CorruptRecord:
+                if e.__class__.__name__ != 'CorruptRecord':
+                    raise
+            ## The database was rewritten in a way we didn't notice
+            self.clear()
+        ## Two objects with the same hash; fall back to a scan
+        result = None
+        for count, data in db.read(0):
+            if record_key(data) == (type, id):
+                result = count, data
+        return result
+
+
+class _Locked(object):
+    """Holds the index's lock file, locked"""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        self.fp = open(self.filename, 'ab')
+        self.locked = lock_complete(self.fp)
+        self.locked.__enter__()
+
+    def __exit__(self, *args):
+        try:
+            self.locked.__exit__(*args)
+        finally:
+            self.fp.close()
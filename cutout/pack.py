@@ -0,0 +1,317 @@
+"""Packed storage for small databases that aren't being used
+
+Each database normally has a directory of its own, holding the data
+and index files, the collection_id and secret, and the indexes kept
+alongside them (see `cutout.sync.Storage`).  A node with millions of
+small buckets that are rarely touched spends most of its inodes and
+dentry cache on them.  `PackStore` keeps such databases in a few large
+segment files instead:
+
+* ``packs/segment-NNNNNN`` hold databases back to back, each as
+  `cutout.sync.Storage.encode_db` gives it (the ``?copy`` format), so
+  unpacking one is just `cutout.sync.Storage.decode_db`;
+* ``packs/index`` is a log of JSON lines: ``[key, segment, offset,
+  length, position, collection_id]`` when a database is packed, and
+  ``[key]`` when it is unpacked again.  Each process keeps the live
+  entries in memory, and reads whatever has been added to the log
+  since it last looked before using them.
+
+GETs of a packed database are answered from its entry (see
+`PackedDatabase`); anything else unpacks it first (see
+`cutout.sync.UserStorage.for_user`).  Databases are garbage collected
+as they are packed, so a packed database only has the latest record
+of each object.
+
+Packing and unpacking hold the lock on the index file, so a database
+is never packed and unpacked at the same time.  Segments are only
+appended to; `PackStore.compact` rewrites the index with just the
+live entries, and removes the segments none of them are in.
+"""
+import os
+import re
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from cutout import int_encoding, triple_encoding, COMPRESSED, LENGTH_MASK
+from fcntl import lockf as lock_file
+from fcntl import LOCK_UN, LOCK_EX
+from cutout import streamdb
+from cutout.compression import RecordCodec
+from cutout.snapshot import object_key, page
+
+
+class PackEntry(namedtuple('PackEntry', 'segment offset length position collection_id')):
+    """Where a packed database is, and its last counter and
+    collection_id"""
+
+
+segment_re = re.compile(r'^segment-(\d+)$')
+
+
+class PackStore(object):
+
+    ## A new segment is started once the last one is this big:
+    max_segment_bytes = 64 * 1024 * 1024
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.index_filename = os.path.join(dir, 'index')
+        self._lock = threading.RLock()
+        ## {key: PackEntry}, as of _read_to bytes into the index
+        ## (with the inode _index_ino):
+        self._entries = {}
+        self._read_to = 0
+        self._index_ino = None
+
+    def _refresh(self):
+        """Reads any entries added to the index since it was last read"""
+        ## Most of the time nothing has changed, which a stat shows
+        ## without opening the index:
+        try:
+            stat = os.stat(self.index_filename)
+        except OSError, e:
+            if e.errno != 2:
+                raise
+            stat = None
+        if stat is None or stat.st_ino != self._index_ino or stat.st_size > self._read_to:
+            self._read_index()
+
+    def _read_index(self):
+        try:
+            fp = open(self.index_filename, 'rb')
+        except IOError, e:
+            if e.errno != 2:
+                raise
+            self._entries = {}
+            self._read_to = 0
+            self._index_ino = None
+            return
+        with fp:
+            stat = os.fstat(fp.fileno())
+            if stat.st_ino != self._index_ino:
+                ## It has been compacted:
+                self._entries = {}
+                self._read_to = 0
+                self._index_ino = stat.st_ino
+            if stat.st_size <= self._read_to:
+                return
+            fp.seek(self._read_to)
+            data = fp.read(stat.st_size - self._read_to)
+        ## Only whole lines (a line may still be being written):
+        end = data.rfind('\n') + 1
+        for line in data[:end].splitlines():
+            entry = json.loads(line)
+            key = str(entry[0])
+            if len(entry) == 1:
+                self._entries.pop(key, None)
+            else:
+                segment, offset, length, position, collection_id = entry[1:]
+                self._entries[key] = PackEntry(
+                    str(segment), offset, length, position, str(collection_id))
+        self._read_to += end
+
+    def get(self, key):
+        """Returns the `PackEntry` of a packed database, or None"""
+        with self._lock:
+            self._refresh()
+            return self._entries.get(key)
+
+    def keys(self):
+        with self._lock:
+            self._refresh()
+            return self._entries.keys()
+
+    def read(self, entry):
+        """Returns the encoded database in an entry"""
+        with open(os.path.join(self.dir, entry.segment), 'rb') as fp:
+            fp.seek(entry.offset)
+            encoded = fp.read(entry.length)
+        if len(encoded) < entry.length:
+            raise IOError('Segment %s is truncated' % entry.segment)
+        return encoded
+
+    def read_key(self, key):
+        """Returns ``(entry, encoded)`` for a packed database, or
+        ``(None, None)``.  If its segment has been removed by
+        `compact` (in another process) since the entry was read, the
+        index is read again, as the database has been moved or
+        unpacked."""
+        while True:
+            entry = self.get(key)
+            if entry is None:
+                return None, None
+            try:
+                return entry, self.read(entry)
+            except IOError, e:
+                if e.errno != 2:
+                    raise
+                with self._lock:
+                    self._refresh()
+                    if self._entries.get(key) == entry:
+                        raise
+
+    def open(self, key):
+        """Returns a `PackedDatabase` for a packed database, or None"""
+        entry, encoded = self.read_key(key)
+        if entry is None:
+            return None
+        return PackedDatabase(entry, encoded)
+
+    @contextmanager
+    def locked(self):
+        """Holds the lock for changing the packs (across processes)"""
+        with self._lock:
+            if not os.path.exists(self.dir):
+                try:
+                    os.makedirs(self.dir)
+                except OSError, e:
+                    if e.errno != 17:
+                        raise
+            while True:
+                lock_fp = open(self.index_filename, 'ab')
+                lock_file(lock_fp, LOCK_EX, 0, 0, os.SEEK_SET)
+                ## The index may have been compacted (replaced) while
+                ## we waited:
+                if os.fstat(lock_fp.fileno()).st_ino == os.stat(self.index_filename).st_ino:
+                    break
+                lock_file(lock_fp, LOCK_UN, 0, 0, os.SEEK_SET)
+                lock_fp.close()
+            try:
+                self._refresh()
+                yield
+            finally:
+                lock_file(lock_fp, LOCK_UN, 0, 0, os.SEEK_SET)
+                lock_fp.close()
+
+    def _segments(self):
+        """The names of the segments, oldest first"""
+        names = [name for name in os.listdir(self.dir) if segment_re.match(name)]
+        names.sort(key=lambda name: int(segment_re.match(name).group(1)))
+        return names
+
+    def _append_index(self, entry):
+        with open(self.index_filename, 'ab') as fp:
+            fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._refresh()
+
+    def add(self, key, encoded, position, collection_id):
+        """Adds an encoded database (from `cutout.sync.Storage.encode_db`)
+        to the last segment, and to the index.  Both are synced to disk
+        before this returns, so the database's own files can then be
+        removed.  Must be called in `locked`."""
+        segments = self._segments()
+        if segments and os.path.getsize(os.path.join(self.dir, segments[-1])) < self.max_segment_bytes:
+            segment = segments[-1]
+        else:
+            number = int(segment_re.match(segments[-1]).group(1)) + 1 if segments else 1
+            segment = 'segment-%06i' % number
+        with open(os.path.join(self.dir, segment), 'ab') as fp:
+            fp.seek(0, os.SEEK_END)
+            offset = fp.tell()
+            fp.write(encoded)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self._append_index([key, segment, offset, len(encoded), position, collection_id])
+
+    def remove(self, key):
+        """Notes that a database has been unpacked.  Must be called in
+        `locked`."""
+        self._append_index([key])
+
+    def compact(self):
+        """Rewrites the index with only the live entries, and removes
+        segments that have none.  Returns the names of the segments
+        removed."""
+        with self.locked():
+            tmp_filename = self.index_filename + '.tmp'
+            with open(tmp_filename, 'wb') as fp:
+                for key, entry in sorted(self._entries.items()):
+                    fp.write(json.dumps([key] + list(entry)) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_filename, self.index_filename)
+            used = set(entry.segment for entry in self._entries.values())
+            removed = [name for name in self._segments() if name not in used]
+            for name in removed:
+                os.unlink(os.path.join(self.dir, name))
+            return removed
+
+
+def decode_parts(encoded):
+    """Splits an encoded database into ``(collection_id,
+    collection_secret, index, data, dictionary)`` (the dictionary is
+    None if there isn't one)"""
+    parts = []
+    pos = 0
+    while pos < len(encoded) and len(parts) < 5:
+        (length,) = int_encoding.unpack_from(encoded, pos)
+        pos += 4
+        parts.append(encoded[pos:pos + length])
+        pos += length
+    if len(parts) < 4:
+        raise ValueError('Truncated encoded database')
+    if len(parts) == 4:
+        parts.append(None)
+    return tuple(parts)
+
+
+def index_records(index, data, dictionary=None):
+    """Yields the ``(count, data)`` records of a `cutout.Database`,
+    given the contents of its index and data files"""
+    codec = None
+    for pos in xrange(0, len(index) - 11, 12):
+        length, data_pos, count = triple_encoding.unpack_from(index, pos)
+        if not count:
+            ## (the index starts with an empty record)
+            continue
+        record = data[data_pos:data_pos + (length & LENGTH_MASK)]
+        if length & COMPRESSED:
+            if codec is None:
+                codec = RecordCodec(dictionary)
+            record = codec.decompress(record)
+        yield count, record
+
+
+class PackedDatabase(object):
+    """A packed database, read-only, with all its records in memory
+    (packed databases are small)"""
+
+    def __init__(self, entry, encoded):
+        self.entry = entry
+        self.collection_id, collection_secret, index, data, dictionary = decode_parts(encoded)
+        if index:
+            self.records = list(index_records(index, data, dictionary))
+        else:
+            ## Engines without raw files are encoded in the streamdb format:
+            self.records = list(streamdb.decode_records(data))
+
+    @property
+    def position(self):
+        return self.entry.position
+
+    def read(self, since, max_bytes=None, limit=None):
+        """Returns ``([(count, data)], complete)`` for the records after
+        `since`, like `cutout.snapshot.Snapshot.read` (as the database
+        was collected when it was packed, every record is the latest of
+        its object, and only deleted objects are left out for
+        ``since=0``).  Stops, with `complete` false, before the data
+        would add up to more than `max_bytes` or there are more than
+        `limit` records."""
+        records = ((count, data) for count, data in self.records
+                   if count > since and (since or not object_key(data)[1]))
+        return page(records, max_bytes=max_bytes, limit=limit)
+
+    def get_object(self, type, id):
+        """Returns ``(count, data)`` of the latest record of an object,
+        or None"""
+        for count, data in reversed(self.records):
+            item = json.loads(data)
+            if item['id'] == id and item.get('type') == type:
+                return count, data
+        return None
@@ -3,9 +3,10 @@ import string
 import os
 import sys
 import time
-from cutout import Database
+import threading
+from cutout import Database, DURABILITY_MODES
 from cutout.streamdb import Database as StreamDatabase
-from cutout.sql import MySQLStorage
+from cutout.sql import SQLiteDatabase
 
 DATA = string.ascii_letters
 
@@ -32,6 +33,38 @@ class Counter(object):
                 count, name, total, (count / total))
 
 
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run_writers(db_loader, writers, reps, batch=5):
+    """Runs `writers` threads, each doing `reps` extends of `batch`
+    items to the same database (each thread with its own `Database`
+    object, as concurrent requests would have).  Returns (items
+    written, seconds, [latency of each extend])"""
+    latencies = []
+
+    def writer():
+        db = db_loader('writers')
+        for i in xrange(reps):
+            start = time.time()
+            db.extend([DATA] * batch)
+            latencies.append(time.time() - start)
+        db.close()
+
+    db_loader('writers').clear()
+    threads = [threading.Thread(target=writer) for i in xrange(writers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return writers * reps * batch, time.time() - start, latencies
+
+
 class Runner(object):
 
     def __init__(self, db_count, read_portion, large_read_portion,
@@ -163,12 +196,74 @@ parser.add_option(
     action='store_true',
     help="Use the cutout.streamdb database instead of cutout.Database")
 
+parser.add_option(
+    '--sqlite',
+    action='store_true',
+    help="Use the SQLite database (cutout.sql.SQLiteDatabase) instead of cutout.Database")
+
+parser.add_option(
+    '--compare',
+    action='store_true',
+    help="Run the same test against cutout.Database, cutout.streamdb and SQLite, one after the other")
+
+parser.add_option(
+    '--durability',
+    help='Durability for cutout.Database: %s, or "all" to compare them with --writers (default: %%default)' % ', '.join(DURABILITY_MODES),
+    metavar='MODE',
+    default='none')
+
+parser.add_option(
+    '--writers',
+    help='Instead of the mixed test, run this many threads writing concurrently to one database, and report throughput and latency',
+    metavar='THREADS',
+    type='int')
+
 parser.add_option(
     '--profile',
     action='store_true',
     help="Use the profiler, print output after running")
 
 
+def run_engine(options, loader):
+    if options.writers:
+        if options.durability == 'all':
+            modes = DURABILITY_MODES
+        else:
+            modes = [options.durability]
+        for mode in modes:
+            count, total, latencies = run_writers(
+                lambda name: loader(name, mode), options.writers, options.reps)
+            print '%-6s %i items in %.1f seconds (%i/second), latency p50 %.1fms p99 %.1fms' % (
+                mode, count, total, count / total,
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+        return
+
+    runner = Runner(db_count=options.db_count,
+                    read_portion=options.read,
+                    large_read_portion=options.large_read,
+                    db_loader=lambda name: loader(name, options.durability))
+
+    runner.preload(options.preload)
+    if options.profile:
+        import cProfile
+        cProfile.runctx('runner.run_many(options.reps, options.times)',
+                        globals(), locals())
+    else:
+        runner.run_many(options.reps, options.times)
+    runner.counter.summarize()
+
+
+def file_loader(dir, DatabaseConstructor):
+    if not os.path.exists(dir):
+        print 'Creating %s' % dir
+        os.makedirs(dir)
+
+    def loader(name, durability):
+        return DatabaseConstructor(os.path.join(dir, name + '.db'),
+                                   durability=durability)
+    return loader
+
+
 def main():
     options, args = parser.parse_args()
     if options.mysql:
@@ -177,32 +272,26 @@ def main():
             name, value = arg.split('=', 1)
             kw[name] = value
         kw['db'] = args[0]
-        loader = MySQLStorage(**kw)
+        from cutout.sql import MySQLStorage
+        storage = MySQLStorage(**kw)
+        run_engine(options, lambda name, durability: storage(name))
+    elif options.compare:
+        for name, DatabaseConstructor in [('cutout.Database', Database),
+                                          ('cutout.streamdb', StreamDatabase),
+                                          ('sqlite', SQLiteDatabase)]:
+            print '== %s' % name
+            ## Both engines see the same sequence of operations:
+            random.seed(0)
+            run_engine(options, file_loader(os.path.join(args[0], name),
+                                            DatabaseConstructor))
     else:
-        dir = args[0]
-        if not os.path.exists(dir):
-            print 'Creating %s' % dir
-            os.makedirs(dir)
         if options.stream:
             DatabaseConstructor = StreamDatabase
+        elif options.sqlite:
+            DatabaseConstructor = SQLiteDatabase
         else:
             DatabaseConstructor = Database
-
-        def loader(name):
-            return DatabaseConstructor(os.path.join(dir, name + '.db'))
-
-    runner = Runner(db_count=options.db_count,
-                    read_portion=options.read,
-                    large_read_portion=options.large_read,
-                    db_loader=loader)
-
-    runner.preload(options.preload)
-    if options.profile:
-        import cProfile
-        cProfile.run('runner.run_many(options.reps, options.times)')
-    else:
-        runner.run_many(options.reps, options.times)
-    runner.counter.summarize()
+        run_engine(options, file_loader(args[0], DatabaseConstructor))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+"""Poll interval hints: how long clients should wait before their next
+GET
+
+GETs of a database carry an ``X-Sync-Poll-Time`` header (in seconds),
+which `Sync.Scheduler` in syncclient.js uses as its polling period
+(adding some jitter, so clients told the same thing don't poll in
+step).  This lets the server shed polling load without returning
+errors.
+
+The hint starts from how recently the bucket changed: a bucket written
+in the last `PollHints.active_window` seconds is polled every
+`PollHints.active_period` seconds, going up to `PollHints.idle_period`
+as it goes quiet.  Then as the server gets busy the hint is stretched
+towards `PollHints.max_period`.  Load is the larger of the requests
+in progress in this process (against `PollHints.busy_requests`) and
+the system load average per CPU; below `PollHints.idle_load` it has no
+effect.
+
+Changes and requests are noted per process: with several worker
+processes a worker that didn't see a write treats the bucket as idle,
+which only means those clients poll a little less promptly.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from multiprocessing import cpu_count
+
+
+class PollHints(object):
+
+    ## Periods in seconds:
+    active_period = 30
+    idle_period = 5 * 60
+    max_period = 60 * 60
+    ## A bucket that changed this recently is polled at active_period:
+    active_window = 10 * 60
+    ## Requests in progress that count as fully loaded:
+    busy_requests = 32
+    ## Below this load the period isn't stretched:
+    idle_load = 0.5
+    ## The load average is read at most this often:
+    load_interval = 1.0
+    ## How many buckets' change times are remembered:
+    max_buckets = 10000
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self._lock = threading.Lock()
+        self._changed = OrderedDict()
+        self.in_progress = 0
+        self._cpus = cpu_count()
+        self._system_load = 0.0
+        self._load_checked = 0
+
+    def started(self):
+        """Called when a request starts"""
+        with self._lock:
+            self.in_progress += 1
+
+    def finished(self):
+        with self._lock:
+            self.in_progress -= 1
+
+    def note_change(self, key):
+        """Notes that the bucket `key` was written"""
+        with self._lock:
+            self._changed.pop(key, None)
+            self._changed[key] = self.timer()
+            while len(self._changed) > self.max_buckets:
+                self._changed.popitem(last=False)
+
+    def system_load(self):
+        """The 1-minute load average per CPU (checked at most every
+        `load_interval` seconds)"""
+        now = self.timer()
+        if now - self._load_checked >= self.load_interval:
+            self._load_checked = now
+            try:
+                self._system_load = os.getloadavg()[0] / self._cpus
+            except OSError:
+                self._system_load = 0.0
+        return self._system_load
+
+    def load(self):
+        """How loaded the server is, where 1 is fully loaded"""
+        return max(float(self.in_progress) / self.busy_requests, self.system_load())
+
+    def base_period(self, key):
+        """The period for the bucket `key` ignoring load: active_period
+        just after a change, going up to idle_period at the end of
+        active_window"""
+        changed = self._changed.get(key)
+        if changed is None:
+            return self.idle_period
+        age = self.timer() - changed
+        if age >= self.active_window:
+            return self.idle_period
+        fraction = max(age, 0) / float(self.active_window)
+        return self.active_period + (self.idle_period - self.active_period) * fraction
+
+    def poll_time(self, key):
+        """The whole number of seconds a client should wait before
+        polling the bucket `key` again"""
+        period = self.base_period(key)
+        busy = (self.load() - self.idle_load) / (1 - self.idle_load)
+        if busy > 0:
+            period += (self.max_period - period) * min(busy, 1)
+        return int(round(period))
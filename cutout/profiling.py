@@ -0,0 +1,269 @@
+"""WSGI middleware that profiles some of the requests to a running app
+
+`Profiler` wraps `cutout.sync.Application` (or
+`cutout.balancer.Application`), and when it is turned on runs some of
+the requests under ``cProfile``, adding up the profiles in memory.
+It is controlled with internal requests to ``/profile``:
+
+``POST /profile?sample=0.01``
+    Profiles 1% of requests.  ``&route=post`` (which may be repeated)
+    also profiles every request for that route (as named in
+    ``cutout.route`` by `cutout.sync.Application`), and ``&user=NAME``
+    every request for that user.  Each POST replaces the settings.
+
+``POST /profile?stop``
+    Stops profiling (the profiles collected so far are kept);
+    ``?reset`` throws them away.
+
+``GET /profile``
+    The settings and the number of requests profiled, as JSON.
+
+``GET /profile?format=text``
+    The profile as `pstats` prints it (``&sort=cumulative&limit=50``).
+
+``GET /profile?format=pstats``
+    The profile in the `marshal` format of ``pstats.Stats.dump_stats``,
+    to be loaded with ``pstats.Stats(filename)`` (or snakeviz, etc).
+
+``GET /profile?format=collapsed``
+    The profile as "collapsed stacks" (``a;b;c microseconds``) for
+    ``flamegraph.pl``.  cProfile only records who called whom, so the
+    stacks are rebuilt from the call graph, dividing each function's
+    time among its callers in proportion to the time they spent in it.
+
+A route is only known once the request has been handled, so while
+profiling a route every request is profiled, and only those for the
+route are kept.  Only the call to the application is profiled, not
+the iteration of a streamed response body.
+
+When profiling is off each request costs one attribute check.  Like
+`cutout.stats`, this is per process: with ``cutout-server`` each
+worker is turned on (and reports) separately, so use ``--profile-sample``
+to start all the workers profiling.
+"""
+import time
+import random
+import marshal
+import cProfile
+import pstats
+import threading
+from cStringIO import StringIO
+from webob import Request, Response
+from webob import exc
+
+
+class Profiler(object):
+
+    def __init__(self, app, sample=0, routes=(), users=(), path='/profile'):
+        self.app = app
+        self.path = path
+        self._lock = threading.Lock()
+        self.reset()
+        self.configure(sample, routes, users)
+
+    def configure(self, sample=0, routes=(), users=()):
+        self.sample = float(sample)
+        self.routes = frozenset(routes)
+        self.users = frozenset(users)
+        ## The one thing checked on every request:
+        self.enabled = bool(self.sample or self.routes or self.users)
+
+    def reset(self):
+        with self._lock:
+            ## A pstats.Stats, once anything is profiled:
+            self.stats = None
+            self.requests = 0
+            self.route_counts = {}
+            self.started = time.time()
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return self.control(environ, start_response)
+        if not self.enabled:
+            return self.app(environ, start_response)
+        ## With routes we can't tell until after the request:
+        if not self.routes and not self.chosen(environ):
+            return self.app(environ, start_response)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self.app, environ, start_response)
+        finally:
+            route = environ.get('cutout.route')
+            if not self.routes or route in self.routes or self.chosen(environ):
+                self.add(profile, route)
+
+    def chosen(self, environ):
+        """True if the request is sampled, or is for one of the users"""
+        if self.sample and random.random() < self.sample:
+            return True
+        return bool(self.users) and self.username(environ) in self.users
+
+    def username(self, environ):
+        """The username in the path (``/domain/username/bucket``), or
+        the authenticated user"""
+        parts = environ.get('PATH_INFO', '').split('/')
+        if len(parts) > 3:
+            return parts[2]
+        remote_user = environ.get('REMOTE_USER')
+        if remote_user:
+            return remote_user.split('/', 1)[0]
+        return None
+
+    def add(self, profile, route):
+        profile.create_stats()
+        if not profile.stats:
+            return
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.requests += 1
+            self.route_counts[route] = self.route_counts.get(route, 0) + 1
+
+    def control(self, environ, start_response):
+        req = Request(environ)
+        try:
+            resp = self.respond(req)
+        except exc.HTTPException, e:
+            resp = e
+        return resp(environ, start_response)
+
+    def respond(self, req):
+        """Responds to ``/profile`` (internal only)"""
+        if not req.environ.get('cutout.internal'):
+            raise exc.HTTPForbidden('authorized only for internal')
+        if req.method == 'POST':
+            if 'reset' in req.GET:
+                self.reset()
+            elif 'stop' in req.GET:
+                self.configure()
+            else:
+                try:
+                    sample = float(req.GET.get('sample', 0))
+                except ValueError:
+                    raise exc.HTTPBadRequest('Bad value sample=%s' % req.GET['sample'])
+                if not 0 <= sample <= 1:
+                    raise exc.HTTPBadRequest('sample must be between 0 and 1')
+                self.configure(sample, req.GET.getall('route'), req.GET.getall('user'))
+        format = req.GET.get('format')
+        if req.method == 'POST' or not format:
+            return Response(json=self.status())
+        if format == 'text':
+            try:
+                limit = int(req.GET.get('limit', 50))
+            except ValueError:
+                raise exc.HTTPBadRequest('Bad value limit=%s' % req.GET['limit'])
+            return Response(self.text(req.GET.get('sort', 'cumulative'), limit),
+                            content_type='text/plain')
+        if format == 'pstats':
+            resp = Response(self.dump(), content_type='application/octet-stream')
+            resp.content_disposition = 'attachment; filename="cutout.pstats"'
+            return resp
+        if format == 'collapsed':
+            return Response(''.join('%s %i\n' % (stack, value) for stack, value in self.collapsed()),
+                            content_type='text/plain')
+        raise exc.HTTPBadRequest('Unknown format=%s (should be text, pstats or collapsed)' % format)
+
+    def status(self):
+        return {
+            'enabled': self.enabled,
+            'sample': self.sample,
+            'routes': sorted(self.routes),
+            'users': sorted(self.users),
+            'requests': self.requests,
+            'route_counts': dict((str(route), count) for route, count in self.route_counts.items()),
+            'since': self.started,
+            }
+
+    def _stats(self):
+        """A copy of the stats collected so far, or None"""
+        with self._lock:
+            if self.stats is None:
+                return None
+            ## Stats.add replaces entries rather than changing them, so
+            ## a shallow copy is enough:
+            raw = dict(self.stats.stats)
+        return pstats.Stats(_RawStats(raw))
+
+    def text(self, sort='cumulative', limit=50):
+        stats = self._stats()
+        if stats is None:
+            return 'Nothing has been profiled\n'
+        out = StringIO()
+        stats.stream = out
+        try:
+            stats.sort_stats(sort)
+        except KeyError:
+            raise exc.HTTPBadRequest('Bad value sort=%s' % sort)
+        out.write('%i requests\n' % self.requests)
+        stats.print_stats(limit)
+        return out.getvalue()
+
+    def dump(self):
+        stats = self._stats()
+        return marshal.dumps(stats.stats if stats is not None else {})
+
+    def collapsed(self, min_seconds=1e-6):
+        """Returns ``[(stack, microseconds)]``, the time spent in each
+        stack of functions (outermost first, separated by ``;``)"""
+        stats = self._stats()
+        if stats is None:
+            return []
+        return collapse(stats.stats, min_seconds)
+
+
+class _RawStats(object):
+    """Stats data that `pstats.Stats` can load, like a profile"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def function_name(func):
+    filename, line, name = func
+    if filename == '~':
+        ## A builtin, like "<method 'read' of 'file' objects>"
+        return name
+    return '%s:%i:%s' % (filename.rsplit('/', 1)[-1], line, name)
+
+
+def collapse(raw, min_seconds=1e-6):
+    """Turns pstats data (``{func: (cc, nc, tottime, cumtime,
+    callers)}``) into collapsed stacks, as described in the module"""
+    calls = {}
+    roots = []
+    for func, (cc, nc, tottime, cumtime, callers) in raw.items():
+        known_callers = [caller for caller in callers if caller in raw]
+        if not known_callers:
+            roots.append(func)
+        for caller in known_callers:
+            edge = callers[caller]
+            ## Each edge is (cc, nc, tottime, cumtime) of func when
+            ## called from caller:
+            calls.setdefault(caller, []).append((func, edge[3]))
+    totals = {}
+
+    def walk(func, stack, seconds):
+        cumtime = raw[func][3]
+        if not cumtime:
+            return
+        share = min(1.0, seconds / cumtime)
+        stack = stack + (func,)
+        own = raw[func][2] * share
+        if own >= min_seconds:
+            key = ';'.join(function_name(f) for f in stack)
+            totals[key] = totals.get(key, 0) + own
+        for callee, edge_cumtime in calls.get(func, ()):
+            callee_seconds = edge_cumtime * share
+            if callee in stack or callee_seconds < min_seconds:
+                ## Recursion is folded into the outermost call
+                continue
+            walk(callee, stack, callee_seconds)
+
+    for func in roots:
+        walk(func, (), raw[func][3])
+    return sorted((stack, int(seconds * 1000000)) for stack, seconds in totals.items())
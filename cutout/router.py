@@ -0,0 +1,173 @@
+"""WSGI application that shards requests over pools of nodes.
+
+Every user (domain and username) belongs to one of a fixed number of
+shards, and a shard table assigns each shard to a pool.  Inside a pool
+a `cutout.balancer.Application` does the consistent hashing and
+backups.  Because shards never move on their own, adding or removing
+a node only rearranges databases among the nodes of that one pool;
+moving load between pools is done a whole shard at a time with
+`Application.migrate_shard`.
+"""
+import os
+import urllib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from webob.dec import wsgify
+from webob import Request, Response
+from cutout import balancer
+from cutout.sync import shard_number
+from cutout.forwarder import forward
+
+
+class ShardTable(object):
+    """Maps each shard to a pool, optionally saved in a JSON file.
+
+    The number of shards is fixed when the table is created, and
+    should be much larger than the number of pools you ever expect to
+    have.
+    """
+
+    def __init__(self, pools, shards=1024, filename=None):
+        self.filename = filename
+        self.shards = shards
+        self.pools = None
+        ## Shards being moved, {shard: new_pool}:
+        self.migrating = {}
+        if filename and os.path.exists(filename):
+            with open(filename, 'rb') as fp:
+                data = json.load(fp)
+            self.shards = data['shards']
+            self.pools = data['pools']
+        else:
+            pools = sorted(pools)
+            self.pools = [pools[i % len(pools)] for i in xrange(shards)]
+            self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            json.dump({'shards': self.shards, 'pools': self.pools}, fp)
+        os.rename(tmp_filename, self.filename)
+
+    def shard_for(self, domain, username):
+        return shard_number(domain, username, self.shards)
+
+    def pool_for(self, domain, username):
+        return self.pools[self.shard_for(domain, username)]
+
+    def assign(self, shard, pool):
+        self.pools[shard] = pool
+        self.save()
+
+    def shards_in(self, pool):
+        return [shard for shard, name in enumerate(self.pools) if name == pool]
+
+
+class Application(object):
+    """Application to route requests to pools, by shard
+
+    `pools` is a dictionary of pool names to balancers.  Node names
+    must be unique across all pools.
+    """
+
+    def __init__(self, pools=None, table=None, preload=None,
+                 preload_dir=None, backups=1, shards=1024):
+        if pools is None:
+            pools = {}
+        if preload:
+            pool_count, node_count = preload
+            for i in xrange(pool_count):
+                name = 'pool-%02i' % i
+                pools[name] = balancer.Application(
+                    preload=node_count, preload_dir=preload_dir,
+                    backups=backups, prefix=name + '-')
+        self.pools = pools
+        if table is None:
+            table = ShardTable(pools.keys(), shards=shards)
+        self.table = table
+
+    @wsgify
+    def __call__(self, req):
+        first = req.path_info_peek()
+        for pool in self.pools.itervalues():
+            if first in pool.subnodes:
+                return pool
+        domain, username = self.split_path(req.path_info)
+        if domain is None:
+            return Response(status=404, body='Not a valid URL: %r' % req.path_info)
+        shard = self.table.shard_for(domain, username)
+        if shard in self.table.migrating and req.method != 'GET':
+            return Response(status=503, retry_after=10, body='Data in transit')
+        return self.pools[self.table.pools[shard]]
+
+    def split_path(self, path):
+        parts = path.lstrip('/').split('/')
+        if len(parts) < 3 or not parts[0] or not parts[1]:
+            return None, None
+        return parts[0], parts[1]
+
+    def pool_of_node(self, node):
+        for name, pool in self.pools.iteritems():
+            if node in pool.ring.nodes:
+                return name, pool
+        raise KeyError(node)
+
+    def add_node(self, pool, url, create=False, root=None):
+        """Adds a node to the given pool; only nodes in that pool are
+        asked to give up databases"""
+        self.pools[pool].add_node(url, create=create, root=root)
+
+    def remove_node(self, url, root=None, force=False):
+        """Removes a node from whatever pool it is in"""
+        name, pool = self.pool_of_node(url)
+        pool.remove_node(url, root=root, force=force)
+
+    def migrate_shard(self, shard, new_pool, root=None):
+        """Moves every database in the shard to `new_pool`
+
+        Writes to the shard are refused (with a 503) while the copy
+        happens, reads continue to be served from the old pool.  Once
+        everything is copied to the master and backups in the new pool
+        the shard table is updated and the old copies are deleted.
+        """
+        old_pool = self.table.pools[shard]
+        if old_pool == new_pool:
+            return
+        old = self.pools[old_pool]
+        new = self.pools[new_pool]
+        self.table.migrating[shard] = new_pool
+        try:
+            databases = []
+            for node in old.ring.nodes:
+                req = Request.blank(
+                    '/' + node + '/query-shard', method='POST',
+                    json={'other': old.ring.nodes, 'name': node, 'shards': self.table.shards,
+                          'shard': shard, 'backups': old.backups})
+                resp = forward(req, root=root)
+                assert resp.status_code == 200, str(resp)
+                for db_data in resp.json['databases']:
+                    databases.append((node, db_data['path']))
+            for node, path in databases:
+                print 'Copying database %s from %s to %s' % (path, node, new_pool)
+                quoted = urllib.quote(path)
+                resp = forward(Request.blank('/' + node + quoted + '?copy'), root=root)
+                assert resp.status_code == 200, str(resp)
+                for new_node in new.node_list(path):
+                    send = Request.blank('/' + new_node + quoted + '?paste',
+                                         method='POST', body=resp.body)
+                    sent = forward(send, root=root)
+                    assert sent.status_code == 201, str(sent)
+                    print '  copied %i bytes to %s' % (len(resp.body), new_node)
+            self.table.assign(shard, new_pool)
+        finally:
+            del self.table.migrating[shard]
+        for node, path in databases:
+            for old_node in old.node_list(path):
+                resp = forward(Request.blank('/' + old_node + urllib.quote(path) + '?delete'),
+                               root=root)
+                assert resp.status_code < 300, str(resp)
+        print 'Moved shard %i from %s to %s' % (shard, old_pool, new_pool)
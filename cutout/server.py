@@ -0,0 +1,291 @@
+"""The production server: ``cutout-server``
+
+This runs several worker processes, each serving the sync application
+with `cutout.evserver`.  Each worker opens its own listening socket
+with ``SO_REUSEPORT`` so the kernel spreads connections among them
+(where ``SO_REUSEPORT`` isn't available the master opens the socket
+and the workers share it).  Because the databases coordinate with
+``fcntl`` locks, any number of processes can share a data directory.
+
+The master process:
+
+* starts a new worker whenever one exits, whether it crashed or
+  reached ``--max-requests``;
+* on ``SIGHUP`` starts a new set of workers and gracefully stops the
+  old ones (the application code is only imported in the workers, so
+  this picks up new code and configuration);
+* on ``SIGTERM`` or ``SIGINT`` gracefully stops all workers and exits.
+
+On a clean exit the master leaves a marker in the data directory; if
+the marker is missing at startup the last server crashed, and the
+tail of every database is checked and repaired before any worker
+starts.
+
+Workers stop gracefully by closing their listening socket and
+finishing the requests they have in progress.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import optparse
+import threading
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       {'linux2': 15, 'darwin': 0x200}.get(sys.platform))
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS]',
+    description="Serves The Cut-Out sync server with several worker processes")
+
+parser.add_option('-H', '--host', metavar='HOST', default='127.0.0.1',
+                  help='Host (interface) to serve on; 0.0.0.0 means serve publicly')
+parser.add_option('-p', '--port', metavar='PORT', default=8088, type='int',
+                  help='Port to serve on (default: %default)')
+parser.add_option('--dir', metavar='DIRECTORY', default='./data',
+                  help='Directory to store files in (default: %default)')
+parser.add_option('--workers', metavar='COUNT', type='int', default=None,
+                  help='Number of worker processes (default: number of CPUs)')
+parser.add_option('--threads', metavar='COUNT', type='int', default=10,
+                  help='Requests each worker runs at once (default: %default)')
+parser.add_option('--max-connections', metavar='COUNT', type='int', default=5000,
+                  help='Connections each worker keeps open (default: %default)')
+parser.add_option('--max-requests', metavar='COUNT', type='int', default=None,
+                  help='Restart each worker after it has handled this many requests')
+parser.add_option('--durability', metavar='MODE', default='none',
+                  help='How writes are synced to disk: none, batch or group (default: %default)')
+parser.add_option('--engine', metavar='ENGINE', default='cutout',
+                  help='Database engine: cutout (data and index files), stream (one file) or sqlite (default: %default)')
+parser.add_option('--object-index', action='store_true',
+                  help='Update the (type, id) object index on every write, rather than when it is next used')
+parser.add_option('--compress', action='store_true',
+                  help='Store records compressed, with a dictionary trained on each database (cutout engine only)')
+parser.add_option('--max-response-bytes', metavar='BYTES', type='int', default=4 * 1024 * 1024,
+                  help='The most object data one GET returns (default: %default)')
+parser.add_option('--max-post-bytes', metavar='BYTES', type='int', default=16 * 1024 * 1024,
+                  help='The largest POST body accepted (default: %default)')
+parser.add_option('--include-syncclient', action='store_true',
+                  help='Serve /syncclient.js')
+parser.add_option('--minify-syncclient', action='store_true',
+                  help='Strip comments and indentation from /syncclient.js')
+parser.add_option('--profile-sample', metavar='FRACTION', type='float', default=0,
+                  help='Profile this fraction of requests from the start (see cutout.profiling; '
+                  'profiling can also be turned on later with POST /profile)')
+parser.add_option('--request-log', metavar='FILE',
+                  help='Log a JSON line for every request, with its ID and phase timings, to FILE (- for stderr)')
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def supports_reuse_port():
+    if SO_REUSEPORT is None:
+        return False
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def make_socket(host, port, reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+
+def make_app(options):
+    """Creates the application; only called in the workers"""
+    from cutout.sync import Application
+    from cutout.profiling import Profiler
+    if options.request_log:
+        import logging
+        from cutout import timing
+        if options.request_log == '-':
+            handler = logging.StreamHandler()
+        else:
+            handler = logging.FileHandler(options.request_log)
+        timing.log.addHandler(handler)
+        timing.log.setLevel(logging.INFO)
+    app = Application(dir=options.dir, include_syncclient=options.include_syncclient,
+                      durability=options.durability, engine=options.engine,
+                      max_response_bytes=options.max_response_bytes,
+                      object_index=options.object_index,
+                      compress=options.compress,
+                      max_post_bytes=options.max_post_bytes,
+                      minify_syncclient=options.minify_syncclient)
+    return Profiler(app, sample=options.profile_sample)
+
+
+class Master(object):
+    """Starts and watches over the worker processes"""
+
+    ## A worker that dies sooner than this after starting is treated
+    ## as crashing, and restarts are slowed down:
+    min_lifetime = 1.0
+
+    def __init__(self, options, app_factory=make_app):
+        self.options = options
+        self.app_factory = app_factory
+        self.worker_count = options.workers or cpu_count()
+        self.shared_sock = None
+        if not supports_reuse_port():
+            self.shared_sock = make_socket(options.host, options.port, False)
+        ## pid: start time
+        self.workers = {}
+        self.retiring = set()
+        self.stopping = False
+        self.reloading = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        for i in xrange(self.worker_count):
+            self.spawn()
+        while self.workers:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if self.stopping:
+                continue
+            if os.WIFSIGNALED(status) or os.WEXITSTATUS(status):
+                print >> sys.stderr, 'Worker %i died (status %i), restarting' % (pid, status)
+                if time.time() - started < self.min_lifetime:
+                    time.sleep(self.min_lifetime)
+            self.spawn()
+
+    def check_storage(self):
+        """Repairs the databases if the last server didn't shut down
+        cleanly.  This runs in a child process, so the master never
+        imports the application code."""
+        pid = os.fork()
+        if not pid:
+            try:
+                from cutout.sync import UserStorage
+                storage = UserStorage(self.options.dir, engine=self.options.engine)
+                if not storage.start_running():
+                    damaged = storage.recover_all()
+                    print 'Last shutdown was not clean; repaired %i databases' % len(damaged)
+                    sys.stdout.flush()
+            except:
+                import traceback
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        pid, status = os.waitpid(pid, 0)
+        if status:
+            raise Exception('Could not check the databases in %s' % self.options.dir)
+
+    def mark_clean_shutdown(self):
+        from cutout.sync import UserStorage
+        UserStorage(self.options.dir).mark_clean_shutdown()
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.workers:
+            self.signal_worker(pid, signal.SIGTERM)
+
+    def reload(self):
+        """Starts new workers, then gracefully stops the old ones"""
+        old = [pid for pid in self.workers if pid not in self.retiring]
+        for i in xrange(self.worker_count):
+            self.spawn()
+        for pid in old:
+            self.retiring.add(pid)
+            self.signal_worker(pid, signal.SIGTERM)
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return pid
+        try:
+            self.run_worker()
+        except:
+            import traceback
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    def run_worker(self):
+        ## Until the server is ready SIGTERM just kills the worker:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        for signum in signal.SIGHUP, signal.SIGINT:
+            signal.signal(signum, signal.SIG_IGN)
+        from cutout.evserver import Server
+        if self.shared_sock is not None:
+            sock = self.shared_sock
+        else:
+            sock = make_socket(self.options.host, self.options.port, True)
+        server = Server(self.app_factory(self.options), sock=sock,
+                        threads=self.options.threads,
+                        max_connections=self.options.max_connections,
+                        max_requests=self.options.max_requests)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        watcher = threading.Thread(target=self.watch_master, args=(server,))
+        watcher.daemon = True
+        watcher.start()
+        server.serve_forever()
+
+    def watch_master(self, server):
+        """Stops the worker if the master goes away without telling us"""
+        master = os.getppid()
+        while os.getppid() == master:
+            time.sleep(1)
+        server.shutdown()
+
+
+def main(args=None):
+    options, args = parser.parse_args(args)
+    master = Master(options)
+    master.check_storage()
+    print 'serving on http://%s:%s with %i workers' % (
+        options.host, options.port, master.worker_count)
+    ## Don't let the workers inherit anything unwritten:
+    sys.stdout.flush()
+    master.run()
+    if master.stopping:
+        master.mark_clean_shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Latest-state snapshots of a database, for initial sync
+
+A client starting from ``since=0`` only needs the latest version of
+each object, not every version that has ever been posted, and it
+doesn't need tombstones for objects it never had.  A `Snapshot` keeps,
+next to the database, a second database holding just the latest record
+for each (id, type), in counter order, up to some position in the log.
+Reads combine the snapshot with the log after that position, so an
+initial sync is proportional to the live objects.
+
+The snapshot is brought up to date when a read finds the log has
+grown more than `Snapshot.max_lag` records past it.  It is written
+to a new file named for its position, then ``snapshot.json`` is
+replaced to point to it, so readers never see a partial snapshot.
+The previous snapshot is kept until the next one is written, for
+readers that are still using it.
+
+``snapshot.json`` also records the compaction point: after
+`cutout.gc` removes superseded records, clients asking for changes
+since an earlier counter are served from the snapshot as well.
+"""
+import os
+import shutil
+import tempfile
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from cutout import Database, lock_complete
+
+
+def object_key(data):
+    item = json.loads(data)
+    return (item['id'], item.get('type')), item.get('deleted')
+
+
+def page(records, max_bytes=None, limit=None):
+    """Returns ``([(count, data)], complete)`` for the first of the
+    `records`, stopping (with `complete` false) before the data would
+    add up to more than `max_bytes` (but with at least one record), or
+    there would be more than `limit` records.  At most one record more
+    than is returned is read from `records`."""
+    result = []
+    total = 0
+    for count, data in records:
+        if limit and len(result) >= limit:
+            return result, False
+        total += len(data)
+        if max_bytes is not None and total > max_bytes and result:
+            return result, False
+        result.append((count, data))
+    return result, True
+
+
+class Snapshot(object):
+
+    ## How far (in records) the log may get ahead of the snapshot
+    ## before a read rewrites the snapshot:
+    max_lag = 1000
+
+    def __init__(self, dir, engine_class=Database):
+        self.dir = dir
+        self.engine_class = engine_class
+        self.meta_filename = os.path.join(dir, 'snapshot.json')
+
+    def read_meta(self):
+        """Returns the snapshot metadata: ``position`` (the last log
+        counter included in the snapshot), ``name`` (of its database
+        file, or None), ``previous`` (the name of the snapshot before
+        it) and ``compacted`` (counters up to this may have been removed
+        from the log)"""
+        try:
+            with open(self.meta_filename, 'rb') as fp:
+                return json.loads(fp.read())
+        except IOError, e:
+            if e.errno != 2:
+                raise
+            return {'position': 0, 'name': None, 'previous': None, 'compacted': 0}
+
+    def write_meta(self, meta):
+        tmp_filename = self.meta_filename + '.tmp'
+        with open(tmp_filename, 'wb') as fp:
+            fp.write(json.dumps(meta))
+        os.rename(tmp_filename, self.meta_filename)
+
+    @property
+    def compacted(self):
+        return self.read_meta()['compacted']
+
+    def _lock(self):
+        """Returns a file to lock while changing the snapshot"""
+        return open(os.path.join(self.dir, 'snapshot.lock'), 'ab')
+
+    def note_compaction(self, count, removed=()):
+        """Records that records up to `count` may have been removed
+        from the log.  The `removed` counts (such as expired records)
+        are taken out of the snapshot as well."""
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                meta = self.read_meta()
+                if removed and meta['name']:
+                    self._remove(meta['name'], set(removed))
+                meta['compacted'] = max(meta['compacted'], count)
+                self.write_meta(meta)
+
+    def _remove(self, name, counts):
+        """Removes records from one of the snapshot's databases"""
+        db = self._open(name)
+        dest_dir = tempfile.mkdtemp()
+        try:
+            dest_fn = os.path.join(dest_dir, 'temp.db')
+            dest_fn_index = os.path.join(dest_dir, 'temp.db.index')
+            db.copy(counts, dest_fn, dest_fn_index)
+            db.overwrite(dest_fn, dest_fn_index)
+        finally:
+            db.close()
+            shutil.rmtree(dest_dir)
+
+    def _open(self, name):
+        return self.engine_class(os.path.join(self.dir, name))
+
+    def _records(self, meta):
+        """Yields the (count, data) records in the snapshot"""
+        if not meta['name']:
+            return
+        if not os.path.exists(os.path.join(self.dir, meta['name'])):
+            ## Replaced twice since we read the metadata
+            meta.update(self.read_meta())
+        db = self._open(meta['name'])
+        try:
+            for record in db.read(0):
+                yield record
+        finally:
+            db.close()
+
+    def update(self, db):
+        """Brings the snapshot up to date with the log `db`"""
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                meta = self.read_meta()
+                position = meta['position']
+                latest = {}
+                if db.length() >= position:
+                    for count, data in self._records(meta):
+                        latest[object_key(data)[0]] = (count, data)
+                else:
+                    ## The log was replaced
+                    position = 0
+                for count, data in db.read(position):
+                    latest[object_key(data)[0]] = (count, data)
+                    position = count
+                if position == meta['position']:
+                    return
+                name = 'snapshot-%i' % position
+                new_db = self._open(name)
+                new_db.clear()
+                new_db.extend(sorted(latest.values()), with_counters=True)
+                new_db.close()
+                old_name = meta['previous']
+                meta.update(position=position, name=name, previous=meta['name'])
+                self.write_meta(meta)
+                if old_name:
+                    self._open(old_name).delete()
+
+    def clear(self):
+        """Removes the snapshot, for when the log is replaced"""
+        with self._lock() as lock_fp:
+            with lock_complete(lock_fp):
+                meta = self.read_meta()
+                for name in meta['name'], meta['previous']:
+                    if name:
+                        self._open(name).delete()
+                if os.path.exists(self.meta_filename):
+                    os.unlink(self.meta_filename)
+
+    def read(self, db, since=0, max_bytes=None, limit=None):
+        """Returns ``([(count, data)], complete)`` with the latest
+        record of each object changed after `since`, in counter order,
+        much like ``db.read(since)`` would after a perfect garbage
+        collection.  When `since` is 0 deleted objects are left out.
+
+        Stops, with `complete` false, before the data would add up to
+        more than `max_bytes` or there are more than `limit` records
+        (see `page`)"""
+        meta = self.read_meta()
+        length = db.length()
+        if length - meta['position'] > self.max_lag or length < meta['position']:
+            self.update(db)
+            meta = self.read_meta()
+        ## The log after the snapshot; only the last version of each
+        ## object in it is used:
+        tail = []
+        last_in_tail = {}
+        for count, data in db.read(meta['position']):
+            key, deleted = object_key(data)
+            last_in_tail[key] = count
+            tail.append((count, data, key, deleted))
+
+        def latest():
+            for count, data in self._records(meta):
+                if count > since:
+                    key, deleted = object_key(data)
+                    if key not in last_in_tail:
+                        yield count, data, deleted
+            for count, data, key, deleted in tail:
+                if count > since and last_in_tail[key] == count:
+                    yield count, data, deleted
+
+        records = ((count, data) for count, data, deleted in latest()
+                   if since or not deleted)
+        return page(records, max_bytes=max_bytes, limit=limit)
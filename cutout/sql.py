@@ -1,9 +1,260 @@
-import MySQLdb
+"""Database engines kept in SQL databases
+
+`SQLiteDatabase` is an engine for `cutout.sync.Storage` (``--engine
+sqlite``): each database is one SQLite file, in WAL mode, with a table
+of ``(count, data)`` rows.  Extends are one transaction with one
+``executemany``, and reads step through a cursor rather than loading
+the rows.
+
+SQLite files can't be copied between nodes as they are being written,
+so ``Storage.encode_db`` sends an SQLite database in the format of
+`cutout.streamdb` (see `SQLiteDatabase.export_stream`), and nodes
+using either engine can read it.
+
+`MySQLStorage` keeps every database in one MySQL table, and is used
+by `cutout.performance` (``--mysql``).  MySQLdb is only imported when
+it is used.  It is not an engine for `cutout.sync.Storage`: its
+counters are the table's shared auto-increment ids, so they aren't
+consecutive within a database and can't be given (``with_counters``)
+when databases are copied between nodes, and a database is a scope in
+a shared server rather than a file that can be renamed, copied or
+overwritten.  It is only a comparison point for benchmarks.
+"""
+import os
+import sqlite3
+from cutout import Append, DURABILITY_MODES, ExpectationFailed, TruncatedFile
+from cutout import note_open, note_closed
+from cutout.streamdb import encode_record
+from cutout.streamdb import Database as StreamDatabase
+
+
+class SQLiteDatabase(object):
+    """A database in an SQLite file, with the same interface as
+    `cutout.Database`"""
+
+    has_index = False
+    ## The files can't be copied as they are; see export_stream:
+    raw_files = False
+    ## How long to wait for another writer before failing (seconds):
+    timeout = 30
+    ## How many rows to fetch from a cursor at a time:
+    fetch_size = 500
+
+    def __init__(self, data_filename, index_filename=None, durability='none',
+                 recover=False):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Unknown durability %r (should be one of %s)'
+                             % (durability, ', '.join(DURABILITY_MODES)))
+        self.data_filename = data_filename
+        self.durability = durability
+        self.conn = self._connect(data_filename)
+        ## SQLite syncs each commit itself; there is nothing to group
+        self.conn.execute('PRAGMA synchronous = %s'
+                          % ('OFF' if durability == 'none' else 'FULL'))
+        note_open(self, 'sqlite')
+
+    def _connect(self, filename, wal=True):
+        ## Transactions are started explicitly:
+        conn = sqlite3.connect(filename, timeout=self.timeout, isolation_level=None)
+        conn.text_factory = str
+        if wal:
+            conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS records '
+                     '(count INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        return conn
+
+    def recover(self):
+        """SQLite recovers from crashes itself, so this never has
+        anything to repair"""
+        return (0, 0)
+
+    def _last_count(self, cursor=None):
+        row = (cursor or self.conn).execute('SELECT max(count) FROM records').fetchone()
+        return row[0] or 0
+
+    def extend(self, datas, expect_latest=None, expect_last_counter=None,
+               with_counters=False):
+        """Appends the data to the database, returning the integer
+        counter for the first item in the data
+        """
+        append = Append(datas, expect_latest, expect_last_counter, with_counters)
+        cursor = self.conn.cursor()
+        ## IMMEDIATE takes the write lock, so the last count can't
+        ## change before the rows are inserted:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            count, records = append.prepare(self._last_count(cursor))
+            if records:
+                cursor.executemany('INSERT INTO records (count, data) VALUES (?, ?)',
+                                   ((count, buffer(data)) for count, data in records))
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return append.result
+
+    def read(self, above, last=-1, max_bytes=None):
+        """Yields items starting at `above` and until (and including)
+        `last` if it is given.
+
+        If `max_bytes` is given, stops before the data would add up to
+        more than that (but always yields at least one item)"""
+        assert isinstance(above, int)
+        assert above >= 0
+        if last > 0:
+            cursor = self.conn.execute(
+                'SELECT count, data FROM records WHERE count > ? AND count <= ? ORDER BY count',
+                (above, last))
+        else:
+            cursor = self.conn.execute(
+                'SELECT count, data FROM records WHERE count > ? ORDER BY count', (above,))
+        total = 0
+        yielded = False
+        try:
+            while 1:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for count, data in rows:
+                    data = str(data)
+                    total += len(data)
+                    if max_bytes is not None and total > max_bytes and yielded:
+                        return
+                    yielded = True
+                    yield count, data
+        finally:
+            cursor.close()
+
+    def read_with_positions(self, above):
+        """Like `read`, but yields ``(count, data, position)``; the
+        position of a record is its count"""
+        for count, data in self.read(above):
+            yield count, data, count
+
+    def read_at(self, position, length):
+        """Returns the data at a position given by `read_with_positions`"""
+        row = self.conn.execute('SELECT data FROM records WHERE count = ?',
+                                (position,)).fetchone()
+        if row is None or len(row[0]) != length:
+            raise TruncatedFile()
+        return str(row[0])
+
+    def export_stream(self, fp, until=None):
+        """Writes the records (up to and including `until`) to the file
+        `fp` in the `cutout.streamdb` format"""
+        for count, data in self.read(0, until or -1):
+            if until is not None and count > until:
+                break
+            fp.write(encode_record(count, data))
+
+    @classmethod
+    def load_stream(cls, stream_filename, data_filename):
+        """Makes a new database at `data_filename` from a file in the
+        `cutout.streamdb` format"""
+        stream = StreamDatabase(stream_filename)
+        try:
+            db = cls(data_filename)
+            try:
+                batch = []
+                for record in stream.read(0):
+                    batch.append(record)
+                    if len(batch) >= 1000:
+                        db.extend(batch, with_counters=True)
+                        batch = []
+                if batch:
+                    db.extend(batch, with_counters=True)
+            finally:
+                db.close()
+        finally:
+            stream.close()
+
+    def clear(self):
+        self.conn.execute('DELETE FROM records')
+
+    def length(self):
+        return self._last_count()
+
+    def copy(self, exclude_counts, dest_filename, dest_index_filename=None):
+        """Copies this database to a new database, but excluding the
+        excluded counts (a set-like object)."""
+        ## Without WAL, so there's just the one file:
+        dest = self._connect(dest_filename, wal=False)
+        try:
+            dest.execute('BEGIN')
+            dest.executemany('INSERT INTO records (count, data) VALUES (?, ?)',
+                             ((count, buffer(data)) for count, data in self.read(0)
+                              if count not in exclude_counts))
+            dest.execute('COMMIT')
+        finally:
+            dest.close()
+
+    def overwrite(self, data_filename, index_filename=None):
+        """Overwrites this database with the records in the given
+        file (made with `copy`).  This is done in one transaction in
+        this database's file, rather than by replacing the file, so
+        other connections to it are unaffected."""
+        self.conn.execute('ATTACH DATABASE ? AS source', (data_filename,))
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('DELETE FROM records')
+                self.conn.execute('INSERT INTO records SELECT count, data FROM source.records')
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+        finally:
+            self.conn.execute('DETACH DATABASE source')
+
+    def _checkpoint(self):
+        """Moves everything from the write-ahead log into the database
+        file, so the file can be moved on its own"""
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def rename(self, data_filename, index_filename=None):
+        """Moves the database file to a new name"""
+        self._checkpoint()
+        self.conn.close()
+        os.rename(self.data_filename, data_filename)
+        _remove_sidecars(self.data_filename)
+        self.data_filename = data_filename
+        self.conn = self._connect(data_filename)
+
+    @staticmethod
+    def is_empty(data_filename, index_filename=None):
+        """True if the database at this filename has no items (or
+        doesn't exist)"""
+        if not os.path.exists(data_filename) or not os.path.getsize(data_filename):
+            return True
+        conn = sqlite3.connect(data_filename)
+        try:
+            return conn.execute('SELECT count FROM records LIMIT 1').fetchone() is None
+        except sqlite3.OperationalError:
+            ## No table yet
+            return True
+        finally:
+            conn.close()
+
+    def delete(self):
+        self.close()
+        os.unlink(self.data_filename)
+        _remove_sidecars(self.data_filename)
+
+    def close(self):
+        note_closed(self, 'sqlite')
+        self.conn.close()
+
+
+def _remove_sidecars(filename):
+    for suffix in '-wal', '-shm':
+        if os.path.exists(filename + suffix):
+            os.unlink(filename + suffix)
 
 
 class MySQLStorage(object):
 
     def __init__(self, **kw):
+        import MySQLdb
         self.conn = MySQLdb.connect(**kw)
         cur = self.conn.cursor()
         cur.execute("""
@@ -11,7 +262,7 @@ class MySQLStorage(object):
           id INT PRIMARY KEY AUTO_INCREMENT,
           scope VARCHAR(250) NOT NULL,
           value TEXT NOT NULL,
-          INDEX (scope)
+          INDEX (scope, id)
         )
         """)
         cur.close()
@@ -21,43 +272,67 @@ class MySQLStorage(object):
 
 
 class MySQLScoped(object):
+    """One database (a scope) in a `MySQLStorage`.  Counters are the
+    table's ids, so they are increasing but not consecutive."""
 
     def __init__(self, conn, scope):
         self.conn = conn
         self.scope = scope
 
     def extend(self, datas):
+        """Inserts all the data in one statement, returning the id of
+        the first row (with ``innodb_autoinc_lock_mode`` 0 or 1 the
+        ids of one statement are consecutive)"""
         cur = self.conn.cursor()
-        first = None
-        for data in datas:
-            cur.execute("""
-            INSERT INTO data (scope, value) VALUES
-            (%s, %s);
-            """, (self.scope, data))
-            if first is None:
-                first = self.conn.insert_id()
-        cur.close()
+        try:
+            cur.executemany("""
+            INSERT INTO data (scope, value) VALUES (%s, %s)
+            """, [(self.scope, data) for data in datas])
+            first = self.conn.insert_id()
+        finally:
+            cur.close()
+        self.conn.commit()
         return first
 
     def read(self, least):
+        """Yields (id, value) rows after `least`, using a server-side
+        cursor so rows are fetched as they are used"""
         ## Note we don't do reverse order, seems unfair since it's
         ## incidental to the other implementation, not actually
         ## particularly useful.
-        q = """SELECT id, value FROM data WHERE id > %s AND scope = %s"""
-        params = (least, self.scope)
-        cur = self.conn.cursor()
-        cur.execute(q, params)
-        return cur.fetchall()
+        from MySQLdb.cursors import SSCursor
+        cur = self.conn.cursor(SSCursor)
+        try:
+            cur.execute("""SELECT id, value FROM data WHERE scope = %s AND id > %s ORDER BY id""",
+                        (self.scope, least))
+            while 1:
+                rows = cur.fetchmany(500)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
 
     def clear(self):
         cur = self.conn.cursor()
-        cur.execute("DELETE FROM data")
-        cur.close()
+        try:
+            cur.execute("DELETE FROM data WHERE scope = %s", (self.scope,))
+        finally:
+            cur.close()
+        self.conn.commit()
 
     def length(self):
+        """The counter of the last item (like `cutout.Database.length`)"""
         cur = self.conn.cursor()
-        cur.execute("""SELECT count(*) FROM data WHERE scope = %s""", (self.scope,))
-        row = cur.fetchone()
-        if not row:
+        try:
+            cur.execute("""SELECT max(id) FROM data WHERE scope = %s""", (self.scope,))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        if not row or row[0] is None:
             return 0
         return row[0]
+
+    def close(self):
+        pass
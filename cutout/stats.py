@@ -0,0 +1,333 @@
+"""In-process metrics: counters, gauges and histograms
+
+Metrics are declared once, at module level, in a `Registry` (usually
+the module-level `registry`)::
+
+    requests = registry.counter('cutout_requests_total',
+                                'Requests handled', ('route', 'status'))
+    requests.labels(route='get', status='200').inc()
+
+Histograms keep counts in log-linear buckets (like HDR histograms:
+`SUB_BUCKETS` buckets for every power of two), so recording a value is
+a dictionary increment and percentiles are accurate to within one
+bucket (12.5%) whatever the range of values.
+
+`Registry.snapshot` returns everything as JSON-able data, and
+`Registry.prometheus` in the Prometheus text format; `response` serves
+either, and is used for the internal ``/stats`` route of
+`cutout.sync.Application` and `cutout.balancer.Application`.
+
+The metrics are kept per process: with several worker processes (as
+with ``cutout-server``) each worker has its own, and reports its
+``pid`` so they can be told apart.
+"""
+import os
+import math
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+SUB_BUCKETS = 8
+
+## Values at or below zero all go in this bucket:
+ZERO_BUCKET = -1 << 30
+
+## The bucket boundaries (``le``) used for the Prometheus format, by
+## unit; these are powers of two, which are also bucket boundaries:
+PROMETHEUS_BOUNDS = {
+    ## About 61us to 64 seconds:
+    'seconds': [2.0 ** e for e in range(-14, 7)],
+    ## 64 bytes to 64Mb:
+    'bytes': [2.0 ** e for e in range(6, 27)],
+    ## 1 to 1024:
+    'count': [2.0 ** e for e in range(0, 11)],
+    }
+
+## The percentiles included in `Registry.snapshot`:
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_of(value):
+    """The bucket a value is counted in"""
+    if value <= 0:
+        return ZERO_BUCKET
+    mantissa, exponent = math.frexp(value)
+    ## mantissa is in [0.5, 1); buckets include their upper bound (as
+    ## Prometheus buckets do), so an exact power of two is counted in
+    ## the last bucket of the power below:
+    return exponent * SUB_BUCKETS + int(math.ceil((mantissa * 2 - 1) * SUB_BUCKETS)) - 1
+
+
+def bucket_bound(bucket):
+    """The upper bound of the values counted in a bucket"""
+    if bucket == ZERO_BUCKET:
+        return 0.0
+    exponent, sub = divmod(bucket, SUB_BUCKETS)
+    return math.ldexp(1 + (sub + 1.0) / SUB_BUCKETS, exponent - 1)
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge(object):
+    """A value that goes up and down, or (with `set_function`) is
+    computed when the metrics are read"""
+
+    def __init__(self):
+        self._value = 0
+        self._func = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, func):
+        self._func = func
+
+    @property
+    def value(self):
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+
+class Histogram(object):
+
+    def __init__(self, unit='seconds'):
+        self.unit = unit
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bucket_of(value)
+        with self._lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    @contextmanager
+    def time(self):
+        """Observes the seconds the ``with`` block takes"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start)
+
+    def percentile(self, percent):
+        """The value below which `percent` of the values fall (the
+        upper bound of its bucket, but never more than the largest
+        value seen)"""
+        with self._lock:
+            buckets = sorted(self.buckets.items())
+            count = self.count
+        if not count:
+            return 0
+        wanted = max(1, int(math.ceil(count * percent / 100.0)))
+        seen = 0
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= wanted:
+                return min(bucket_bound(bucket), self.max)
+        return self.max
+
+    def cumulative(self, bounds):
+        """Returns the number of values at or below each bound"""
+        with self._lock:
+            buckets = sorted(self.buckets.items())
+        result = []
+        index = 0
+        seen = 0
+        for bound in bounds:
+            while index < len(buckets) and bucket_bound(buckets[index][0]) <= bound:
+                seen += buckets[index][1]
+                index += 1
+            result.append(seen)
+        return result
+
+
+class Family(object):
+    """A named metric, with one `Counter`, `Gauge` or `Histogram`
+    for each combination of label values"""
+
+    def __init__(self, kind, name, help, label_names, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        try:
+            key = tuple(str(labels[name]) for name in self.label_names)
+            return self.children[key]
+        except KeyError:
+            if sorted(labels) != sorted(self.label_names):
+                raise TypeError('%s takes the labels (%s), not (%s)'
+                                % (self.name, ', '.join(self.label_names),
+                                   ', '.join(sorted(labels))))
+            with self._lock:
+                if key not in self.children:
+                    self.children[key] = self.factory()
+                return self.children[key]
+
+    ## For metrics without labels:
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def items(self):
+        """Returns ``[(labels_dict, child)]``"""
+        with self._lock:
+            children = sorted(self.children.items())
+        return [(dict(zip(self.label_names, key)), child)
+                for key, child in children]
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.families = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def _family(self, kind, name, help, label_names, factory):
+        with self._lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = Family(kind, name, help, label_names, factory)
+            elif family.kind != kind or family.label_names != tuple(label_names):
+                raise ValueError('The metric %s is already registered as a %s with the labels (%s)'
+                                 % (name, family.kind, ', '.join(family.label_names)))
+            return family
+
+    def counter(self, name, help, label_names=()):
+        return self._family('counter', name, help, label_names, Counter)
+
+    def gauge(self, name, help, label_names=()):
+        return self._family('gauge', name, help, label_names, Gauge)
+
+    def histogram(self, name, help, label_names=(), unit='seconds'):
+        return self._family('histogram', name, help, label_names,
+                            lambda: Histogram(unit))
+
+    def clear(self):
+        """Resets all the values (the metrics stay registered, as do
+        gauges computed by a function)"""
+        with self._lock:
+            for family in self.families.values():
+                with family._lock:
+                    for key, child in family.children.items():
+                        if getattr(child, '_func', None) is None:
+                            del family.children[key]
+            self.started = time.time()
+
+    def snapshot(self):
+        """Returns all the metrics as JSON-able data"""
+        metrics = {}
+        for name, family in sorted(self.families.items()):
+            values = []
+            for labels, child in family.items():
+                if family.kind == 'histogram':
+                    value = dict(count=child.count, sum=child.sum, max=child.max)
+                    for percent in PERCENTILES:
+                        value['p%s' % str(percent).replace('.', '')] = child.percentile(percent)
+                else:
+                    value = dict(value=child.value)
+                value['labels'] = labels
+                values.append(value)
+            metrics[name] = dict(type=family.kind, help=family.help, values=values)
+        return dict(pid=os.getpid(), uptime=time.time() - self.started, metrics=metrics)
+
+    def prometheus(self):
+        """Returns all the metrics in the Prometheus text format"""
+        lines = ['# Metrics of process %i' % os.getpid()]
+        for name, family in sorted(self.families.items()):
+            lines.append('# HELP %s %s' % (name, family.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (name, family.kind))
+            for labels, child in family.items():
+                if family.kind != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(child.value)))
+                    continue
+                bounds = PROMETHEUS_BOUNDS[child.unit]
+                for bound, count in zip(bounds, child.cumulative(bounds)):
+                    lines.append('%s_bucket%s %i' % (
+                        name, format_labels(labels, le=format_value(bound)), count))
+                lines.append('%s_bucket%s %i' % (name, format_labels(labels, le='+Inf'), child.count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(child.sum)))
+                lines.append('%s_count%s %i' % (name, format_labels(labels), child.count))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels, **extra):
+    labels = sorted(labels.items() + extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+
+def response(req, registry=registry):
+    """Responds to ``GET /stats`` with the metrics as JSON, or with
+    ``?format=prometheus`` (or ``Accept: text/plain``) in the
+    Prometheus text format.  The caller should check that the request
+    is internal."""
+    ## Imported here so the databases don't need webob:
+    from webob import Response
+    format = req.GET.get('format')
+    if format is None and req.accept.best_match(['application/json', 'text/plain']) == 'text/plain':
+        format = 'prometheus'
+    if format == 'prometheus':
+        resp = Response(registry.prometheus(), content_type='text/plain')
+    else:
+        resp = Response(json.dumps(registry.snapshot()), content_type='application/json')
+    resp.cache_control = 'no-cache'
+    return resp
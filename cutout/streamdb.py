@@ -0,0 +1,383 @@
+"""A single-file append-only log, usable in place of `cutout.Database`
+
+Every record is framed with a header of (length, count, crc32) and
+followed by its data, all in one file; there is no index file, and an
+extend is a single write.
+
+To find records a sparse index (the position of every
+`SparseIndex.every`th record) is kept in memory.  It is shared by all
+the `Database` objects in a process for the same file (and kept after
+they are closed), and is built by scanning the record headers when the
+file is first opened; after that only records appended since the
+index was last used are scanned.
+"""
+import os
+import sys
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+from bisect import bisect_right
+from zlib import crc32
+from cutout import Append, DURABILITY_MODES, commit_group, fdatasync
+from cutout import lock_append, lock_complete, note_open, note_closed
+from cutout import DatabaseMoved, check_not_moved
+
+header_encoding = struct.Struct('<III')
+HEADER_SIZE = header_encoding.size
+
+
+class CorruptRecord(Exception):
+    """Raised when a record's data doesn't match its checksum"""
+
+
+def checksum(data):
+    return crc32(data) & 0xffffffff
+
+
+def encode_record(count, data):
+    return header_encoding.pack(len(data), count, checksum(data)) + data
+
+
+def decode_records(data):
+    """Yields the ``(count, data)`` records in a string of records
+    made with `encode_record`"""
+    pos = 0
+    while pos < len(data):
+        if pos + HEADER_SIZE > len(data):
+            raise CorruptRecord("Truncated record header at %i" % pos)
+        length, count, crc = header_encoding.unpack_from(data, pos)
+        pos += HEADER_SIZE
+        record = data[pos:pos + length]
+        if len(record) < length or checksum(record) != crc:
+            raise CorruptRecord("Record %i is corrupt" % count)
+        pos += length
+        yield count, record
+
+
+class SparseIndex(object):
+    """The positions of some of the records in one file"""
+
+    ## How many records there are between index entries:
+    every = 16
+    ## How much to read at a time when scanning headers:
+    scan_chunk = 256 * 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = []
+        self.positions = []
+        self.records = 0
+        ## The position after the last complete record that's been scanned:
+        self.end = 0
+        self.last_count = 0
+        self.last_pos = None
+        ## The file's (size, mtime) when it was last checked:
+        self.stat = None
+
+    def refresh(self, fp):
+        """Brings the index up to date with the file, returning
+        (end, last_count)"""
+        with self.lock:
+            stat = os.fstat(fp.fileno())
+            if (stat.st_size, stat.st_mtime) != self.stat:
+                size = stat.st_size
+                if size < self.end or not self._still_valid(fp):
+                    ## The file was cleared or overwritten
+                    self.reset()
+                if size > self.end:
+                    self._scan(fp, size)
+                self.stat = (size, stat.st_mtime)
+            return self.end, self.last_count
+
+    @property
+    def size(self):
+        """The size of the file when it was last checked"""
+        return self.stat[0]
+
+    def _still_valid(self, fp):
+        if self.last_pos is None:
+            return True
+        fp.seek(self.last_pos)
+        header = fp.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            return False
+        length, count, crc = header_encoding.unpack(header)
+        return count == self.last_count and self.last_pos + HEADER_SIZE + length == self.end
+
+    def _scan(self, fp, size):
+        pos = self.end
+        buf = ''
+        buf_pos = pos
+        while pos + HEADER_SIZE <= size:
+            offset = pos - buf_pos
+            if offset + HEADER_SIZE > len(buf):
+                fp.seek(pos)
+                buf = fp.read(self.scan_chunk)
+                buf_pos = pos
+                offset = 0
+                if len(buf) < HEADER_SIZE:
+                    break
+            length, count, crc = header_encoding.unpack_from(buf, offset)
+            end = pos + HEADER_SIZE + length
+            if end > size or count <= self.last_count:
+                ## A record still being written (or torn by a crash)
+                break
+            if not self.records % self.every:
+                self.counts.append(count)
+                self.positions.append(pos)
+            self.records += 1
+            self.last_count = count
+            self.last_pos = pos
+            pos = end
+        self.end = pos
+
+    def start_for(self, above):
+        """Returns a position at or before the first record with a
+        count greater than `above`"""
+        with self.lock:
+            index = bisect_right(self.counts, above) - 1
+            if index < 0:
+                return 0
+            return self.positions[index]
+
+
+## Indexes are kept after their databases are closed (most requests
+## open and close a database), for up to this many files:
+max_cached_indexes = 10000
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def sparse_index(filename):
+    """Returns the process-wide `SparseIndex` for this file"""
+    filename = os.path.abspath(filename)
+    with _indexes_lock:
+        index = _indexes.pop(filename, None)
+        if index is None:
+            index = SparseIndex()
+            while len(_indexes) >= max_cached_indexes:
+                _indexes.popitem(last=False)
+        _indexes[filename] = index
+        return index
+
+
+class Database(object):
+    """A drop-in replacement for `cutout.Database`, storing everything
+    in `data_filename`.  `index_filename` is accepted for
+    compatibility, and ignored."""
+
+    has_index = False
+    raw_files = True
+
+    def __init__(self, data_filename, index_filename=None, durability='none',
+                 recover=False):
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Unknown durability %r (should be one of %s)'
+                             % (durability, ', '.join(DURABILITY_MODES)))
+        self.data_filename = data_filename
+        self.index_filename = None
+        self.durability = durability
+        self._group = commit_group(data_filename)
+        self._index = sparse_index(data_filename)
+        fd = os.open(data_filename, os.O_RDWR | os.O_CREAT)
+        self.data_fp = os.fdopen(fd, 'r+b')
+        note_open(self, 'stream')
+        if recover:
+            self.recover()
+
+    def recover(self):
+        """Removes a torn record from the end of the file, returning
+        (records_removed, bytes_removed) like `cutout.Database.recover`"""
+        with lock_complete(self.data_fp):
+            end, last_count = self._index.refresh(self.data_fp)
+            self.data_fp.seek(0, os.SEEK_END)
+            size = self.data_fp.tell()
+            if size == end:
+                return 0, 0
+            self.data_fp.seek(end)
+            self.data_fp.truncate()
+            return 1, size - end
+
+    def extend(self, datas, expect_latest=None, expect_last_counter=None,
+               with_counters=False):
+        """Appends the data to the database, returning the integer
+        counter for the first item in the data
+        """
+        append = Append(datas, expect_latest, expect_last_counter, with_counters)
+        if self.durability == 'group':
+            self._group.commit(self, append)
+        else:
+            with self._group.locked():
+                self._write([append])
+        if append.error is not None:
+            raise append.error[0], append.error[1], append.error[2]
+        return append.result
+
+    def _write(self, appends):
+        """Writes all the appends with a single write"""
+        with lock_append(self.data_fp):
+            try:
+                check_not_moved(self.data_fp, self.data_filename)
+            except DatabaseMoved:
+                for append in appends:
+                    append.error = sys.exc_info()
+                return
+            end, count = self._index.refresh(self.data_fp)
+            chunks = []
+            for append in appends:
+                try:
+                    count, records = append.prepare(count)
+                except:
+                    append.error = sys.exc_info()
+                    continue
+                for record_count, data in records:
+                    chunks.append(encode_record(record_count, data))
+            if not chunks:
+                return
+            self.data_fp.seek(end)
+            if self._index.size > end:
+                ## Anything after the last complete record (we hold the
+                ## lock, so no one is writing it) was torn by a crash:
+                self.data_fp.truncate()
+            self.data_fp.write(''.join(chunks))
+            self.data_fp.flush()
+            if self.durability != 'none':
+                fdatasync(self.data_fp.fileno())
+
+    def read(self, above, last=-1, max_bytes=None):
+        """Yields items starting at `above` and until (and including)
+        `last` if it is given.
+
+        If `max_bytes` is given, stops before the data would add up to
+        more than that (but always yields at least one item)"""
+        assert isinstance(above, int)
+        assert above >= 0
+        end, last_count = self._index.refresh(self.data_fp)
+        if last_count <= above:
+            return
+        total = 0
+        pos = self._index.start_for(above)
+        fp = self.data_fp
+        fp.seek(pos)
+        while pos < end:
+            header = fp.read(HEADER_SIZE)
+            length, count, crc = header_encoding.unpack(header)
+            pos += HEADER_SIZE + length
+            if count <= above:
+                ## Reading small records keeps the file's buffer,
+                ## which seeking would throw away:
+                if length < 4096:
+                    fp.read(length)
+                else:
+                    fp.seek(length, os.SEEK_CUR)
+                continue
+            total += length
+            if max_bytes is not None and total > max_bytes and total > length:
+                break
+            data = fp.read(length)
+            if len(data) < length or checksum(data) != crc:
+                raise CorruptRecord(
+                    "Record %i in %s is corrupt" % (count, self.data_filename))
+            yield count, data
+            if last > 0 and last <= count:
+                break
+
+    def read_with_positions(self, above):
+        """Like `read`, but yields ``(count, data, position)``, where
+        position is where the data starts in the file (for use with
+        `read_at`)"""
+        for count, data in self.read(above):
+            yield count, data, self.data_fp.tell() - len(data)
+
+    def read_at(self, position, length):
+        """Returns the data at a position given by `read_with_positions`"""
+        self.data_fp.seek(position - HEADER_SIZE)
+        header = self.data_fp.read(HEADER_SIZE)
+        data = self.data_fp.read(length)
+        if len(header) < HEADER_SIZE:
+            raise CorruptRecord("No record at %i in %s" % (position, self.data_filename))
+        record_length, count, crc = header_encoding.unpack(header)
+        if record_length != length or len(data) < length or checksum(data) != crc:
+            raise CorruptRecord("No record at %i in %s" % (position, self.data_filename))
+        return data
+
+    def _position_of(self, count):
+        """The position of the record `count`, or of the first record
+        after it"""
+        end, last_count = self._index.refresh(self.data_fp)
+        pos = self._index.start_for(count - 1)
+        while pos < end:
+            self.data_fp.seek(pos)
+            length, record_count, crc = header_encoding.unpack(
+                self.data_fp.read(HEADER_SIZE))
+            if record_count >= count:
+                break
+            pos += HEADER_SIZE + length
+        return pos
+
+    def get_file_positions(self, until):
+        """Return (0, database_position) where the position is the
+        end of the record `until` (or of the last record before it, if
+        it is missing), like `cutout.Database.get_file_positions`.
+        There is no index, so its position is always 0.
+
+        This can be used to establish a chunk of the database that
+        represents a range."""
+        if until is None:
+            return (0, self._index.refresh(self.data_fp)[0])
+        return (0, self._position_of(until + 1))
+
+    def clear(self):
+        with lock_complete(self.data_fp):
+            self.data_fp.seek(0)
+            self.data_fp.truncate()
+            self._index.refresh(self.data_fp)
+
+    def length(self):
+        return self._index.refresh(self.data_fp)[1]
+
+    def copy(self, exclude_counts, dest_filename, dest_index_filename=None):
+        """Copies this database to a new database, but excluding the
+        excluded counts (a set-like object)."""
+        with open(dest_filename, 'wb') as fp:
+            for count, data in self.read(0):
+                if count in exclude_counts:
+                    continue
+                fp.write(encode_record(count, data))
+
+    def overwrite(self, data_filename, index_filename=None):
+        """Overwrites this database with the given file"""
+        with lock_complete(self.data_fp):
+            self.data_fp.seek(0)
+            self.data_fp.truncate()
+            with open(data_filename, 'rb') as fp:
+                shutil.copyfileobj(fp, self.data_fp)
+            self.data_fp.flush()
+            with self._index.lock:
+                self._index.reset()
+
+    def rename(self, data_filename, index_filename=None):
+        """Moves the database file to a new name"""
+        with lock_complete(self.data_fp):
+            os.rename(self.data_filename, data_filename)
+        self.data_filename = data_filename
+        self._index = sparse_index(data_filename)
+
+    @staticmethod
+    def is_empty(data_filename, index_filename=None):
+        """True if the database at this filename has no items (or
+        doesn't exist), without opening it"""
+        return (not os.path.exists(data_filename)
+                or os.path.getsize(data_filename) == 0)
+
+    def delete(self):
+        self.close()
+        os.unlink(self.data_filename)
+
+    def close(self):
+        note_closed(self, 'stream')
+        self.data_fp.close()
@@ -10,6 +10,7 @@ import time
 import urllib
 import urlparse
 import base64
+import hashlib
 from cStringIO import StringIO
 try:
     import simplejson as json
@@ -22,9 +23,22 @@ from webob.static import FileApp
 from hash_ring import HashRing
 from fcntl import lockf as lock_file
 from fcntl import LOCK_UN, LOCK_EX
-from cutout import Database, ExpectationFailed, lock_complete
+from cutout import Database, DatabaseMoved, ExpectationFailed, lock_complete
 from cutout import int_encoding
-from cutout.forwarder import forward
+from cutout import stats
+from cutout import timing
+from cutout import streamdb
+from cutout.sql import SQLiteDatabase
+from cutout.snapshot import Snapshot, page
+from cutout.objindex import ObjectIndex
+from cutout.expiry import ExpiryIndex
+from cutout.assets import ScriptAsset
+from cutout.polling import PollHints
+from cutout import heads
+from cutout import gc
+from cutout.tailcache import TailCache
+from cutout.pack import PackStore
+from cutout.forwarder import forward, inherit
 
 
 syncclient_filename = os.path.join(
@@ -32,27 +46,219 @@ syncclient_filename = os.path.join(
     'syncclient.js')
 
 
+def render_syncclient(source, base_url):
+    """Points syncclient.js at the server at `base_url`"""
+    return source.replace('Sync.baseUrl = null', 'Sync.baseUrl = %r' % base_url)
+
+
+## The database engines a node can keep its data in.  `Storage.db`
+## is an instance of one of these, constructed with a filename and
+## ``durability``, and each has the interface of `cutout.Database`:
+## extend, read, read_with_positions, read_at, length, clear, copy,
+## overwrite, rename, is_empty, delete, close and recover.  Engines
+## with ``raw_files`` are copied between nodes as files (with
+## get_file_positions); others with export_stream and load_stream.
+## (`cutout.sql.MySQLStorage` isn't one; see `cutout.sql`.)
+engines = {
+    'cutout': Database,
+    'stream': streamdb.Database,
+    'sqlite': SQLiteDatabase,
+    }
+
+
+request_seconds = stats.registry.histogram(
+    'cutout_request_seconds', 'Time taken to respond to requests, by route',
+    ('route',))
+requests_total = stats.registry.counter(
+    'cutout_requests_total', 'Requests, by route and response status',
+    ('route', 'status'))
+get_bytes = stats.registry.histogram(
+    'cutout_get_bytes', 'Object data read from the database for each GET',
+    unit='bytes')
+backup_failures = stats.registry.counter(
+    'cutout_backup_failures_total',
+    'POSTs that a backup node did not accept, by backup node', ('backup',))
+backup_catchups = stats.registry.counter(
+    'cutout_backup_catchups_total',
+    'Backups that arrived ahead of this node, so the database was copied from the master')
+tail_reads = stats.registry.counter(
+    'cutout_tail_cache_reads_total',
+    'GETs that could (hit) or could not (miss) be served from the tail cache',
+    ('result',))
+moved_forwards = stats.registry.counter(
+    'cutout_moved_forwards_total',
+    'Requests forwarded to the node a database was handed off to')
+handoff_waits = stats.registry.counter(
+    'cutout_handoff_waits_total',
+    'Requests that waited for a database being handed off to this node, by outcome',
+    ('result',))
+packed_gets = stats.registry.counter(
+    'cutout_packed_gets_total',
+    'GETs answered from a packed database, without unpacking it')
+unpacks = stats.registry.counter(
+    'cutout_unpacks_total',
+    'Packed databases unpacked to be used')
+
+
 class StorageDeprecated(Exception):
     """Raised when you try to access a database that has been deprecated"""
 
 
 class UserStorage(object):
-    """A container for multiple databases."""
-
-    def __init__(self, dir, timer=time.time):
+    """A container for multiple databases.
+
+    `durability` is passed on to each `cutout.Database` (one of
+    ``cutout.DURABILITY_MODES``), and `engine` picks the database
+    implementation (a key of `engines`).  With `object_index` each
+    database's `cutout.objindex.ObjectIndex` is updated on every
+    write, instead of when it is next used.  With `compress` records
+    are stored compressed (see `cutout.compression`; only engines with
+    ``can_compress``).
+
+    The head of every database is kept in `heads`, a
+    `cutout.heads.HeadTable` shared by every process using this
+    directory, and the latest records of active databases in
+    `tail_cache` (a `cutout.tailcache.TailCache`, one per process).
+
+    Databases that haven't been written for a while can be moved
+    into `packs` (a `cutout.pack.PackStore`) with `pack`; `for_user`
+    unpacks them again."""
+
+    heads_filename = 'heads'
+    packs_dirname = 'packs'
+    ## Databases with any of these files aren't packed:
+    unpackable_names = frozenset([
+        'blobs', 'queue', 'deprecated', 'receiving', 'moved_to', 'migrating_to'])
+
+    def __init__(self, dir, timer=time.time, durability='none', engine='cutout',
+                 object_index=False, compress=False):
+        if compress and not getattr(engines[engine], 'can_compress', False):
+            raise ValueError("The %r engine can't compress records" % engine)
         self.dir = dir
         self.timer = timer
+        self.durability = durability
+        self.engine = engine
+        self.object_index = object_index
+        self.compress = compress
+        self._heads = None
+        self.tail_cache = TailCache()
+        self.packs = PackStore(os.path.join(dir, self.packs_dirname))
+
+    @property
+    def heads(self):
+        if self._heads is None:
+            ensure_dir(self.dir)
+            self._heads = heads.open_table(os.path.join(self.dir, self.heads_filename))
+        return self._heads
+
+    def db_dir(self, domain, username, bucket):
+        return os.path.join(self.dir, urllib.quote(domain, ''), urllib.quote(username, ''), urllib.quote(bucket, ''))
 
     def for_user(self, domain, username, bucket):
-        dir = os.path.join(self.dir, urllib.quote(domain, ''), urllib.quote(username, ''), urllib.quote(bucket, ''))
-        return Storage(dir=dir, timer=self.timer)
+        """The `Storage` of a database, unpacking it first if it has
+        been packed"""
+        if self.packs.get(self.pack_key(domain, username, bucket)) is not None:
+            self.unpack(domain, username, bucket)
+        return self._storage(domain, username, bucket)
+
+    def _storage(self, domain, username, bucket):
+        return Storage(dir=self.db_dir(domain, username, bucket), timer=self.timer,
+                       durability=self.durability, engine=self.engine,
+                       object_index=self.object_index, compress=self.compress,
+                       heads=self.heads,
+                       tail_cache=self.tail_cache)
+
+    def pack_key(self, domain, username, bucket):
+        """The key of a database in `packs`: its directory, relative
+        to this storage's"""
+        return '/'.join(urllib.quote(part, '') for part in (domain, username, bucket))
+
+    def packed_names(self, key):
+        """The ``(domain, username, bucket)`` of a key in `packs`"""
+        return tuple(urllib.unquote(part) for part in key.split('/'))
+
+    def packed(self, domain, username, bucket):
+        """Returns a `cutout.pack.PackedDatabase` if the database is
+        packed, otherwise None"""
+        return self.packs.open(self.pack_key(domain, username, bucket))
+
+    def pack(self, domain, username, bucket, idle=None):
+        """Moves a database into `packs`, and removes its directory.
+        With `idle` (seconds), only if it hasn't been written for that
+        long.  Returns True if the database was packed.
+
+        The database is garbage collected first, then deprecated while
+        it is copied, so requests for it get a 503 until it is packed."""
+        db = self._storage(domain, username, bucket)
+        names = set(os.listdir(db.dir))
+        if names & self.unpackable_names or 'collection_id.txt' not in names:
+            return False
+        if idle is not None and db.last_modified > self.timer() - idle:
+            return False
+        key = self.pack_key(domain, username, bucket)
+        db.collect()
+        with self.packs.locked():
+            db.deprecate()
+            try:
+                encoded = ''.join(db.encode_db())
+                deprecated = db.deprecated_db
+                try:
+                    position = deprecated.length()
+                finally:
+                    deprecated.close()
+                self.packs.add(key, encoded, position, db.collection_id)
+            except:
+                db.undeprecate()
+                raise
+            db.clear()
+        return True
+
+    def unpack(self, domain, username, bucket):
+        """Moves a packed database back to its own directory.  Returns
+        False if it wasn't packed (or another process unpacked it
+        first)."""
+        key = self.pack_key(domain, username, bucket)
+        with self.packs.locked():
+            entry = self.packs.get(key)
+            if entry is None:
+                return False
+            db = self._storage(domain, username, bucket)
+            ## Left over from a pack or unpack that didn't finish:
+            if db.has_collection_id and not db.is_deprecated:
+                self.packs.remove(key)
+                return True
+            db.clear()
+            ensure_dir(db.dir)
+            db.decode_db(StringIO(self.packs.read(entry)))
+            self.packs.remove(key)
+        unpacks.inc()
+        return True
+
+    def head(self, domain, username, bucket):
+        """The `cutout.heads.Head` of a database (or None), without
+        touching the filesystem"""
+        return self.heads.get(self.db_dir(domain, username, bucket))
 
     def clear(self):
-        shutil.rmtree(self.dir)
-        os.mkdir(self.dir)
+        ## The heads file is kept (and cleared), as other processes
+        ## have it mapped:
+        for name in os.listdir(self.dir):
+            if name == self.heads_filename:
+                continue
+            path = os.path.join(self.dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        self.heads.clear()
+        self.tail_cache.clear()
 
-    def all_dbs(self):
+    def all_dbs(self, include_packed=True):
+        """Lists the ``(domain, username, bucket)`` of every database,
+        including the packed ones unless `include_packed` is false"""
         result = []
+        if include_packed:
+            result.extend(self.packed_names(key) for key in self.packs.keys())
         for dirpath, dirnames, filenames in os.walk(self.dir):
             if 'collection_id.txt' in filenames:
                 assert dirpath.startswith(self.dir)
@@ -73,17 +279,90 @@ class UserStorage(object):
         ## We don't care if multiple people disable this:
         with open(os.path.join(self.dir, 'disabled'), 'wb') as fp:
             fp.write('1')
+        self.heads.disable()
+
+    def start_running(self):
+        """Notes that a server is now using this storage.  Returns
+        True if the last server shut down cleanly, otherwise the
+        databases should be checked with `recover_all`.
+
+        The table of heads is cleared, as the databases may have been
+        changed while no server was running."""
+        ensure_dir(self.dir)
+        self.heads.clear(disabled=self.is_disabled)
+        try:
+            os.unlink(os.path.join(self.dir, 'clean-shutdown'))
+        except OSError, e:
+            if e.errno != 2:
+                raise
+            return False
+        return True
+
+    def mark_clean_shutdown(self):
+        """Notes that the server has stopped without leaving any
+        partial writes"""
+        with open(os.path.join(self.dir, 'clean-shutdown'), 'wb') as fp:
+            fp.write('1')
+
+    def recover_all(self):
+        """Checks and repairs the tail of every database (see
+        `cutout.Database.recover`).  Returns a list of ``(domain,
+        username, bucket, damage)`` for the databases that needed
+        repair, where damage is the result of `Storage.recover`"""
+        result = []
+        ## (packed databases are written whole, and synced, when packed)
+        for domain, username, bucket in self.all_dbs(include_packed=False):
+            damage = self.for_user(domain, username, bucket).recover()
+            if damage:
+                result.append((domain, username, bucket, damage))
+        return result
 
 
 class Storage(object):
-    """A single database."""
+    """A single database.
+
+    If `heads` (a `cutout.heads.HeadTable`) or `tail_cache` (a
+    `cutout.tailcache.TailCache`) are given they are kept up to date
+    with changes to the database."""
 
-    def __init__(self, dir, timer=time.time):
+    def __init__(self, dir, timer=time.time, durability='none', engine='cutout',
+                 object_index=False, compress=False, heads=None, tail_cache=None):
         self.dir = dir
         ensure_dir(dir)
         self.timer = timer
+        self.durability = durability
+        self.engine = engine
+        self.object_index = object_index
+        self.compress = compress
+        self.engine_class = engines[engine]
         self._collection_id = None
         self._collection_secret = None
+        self._db = None
+        self.heads = heads
+        self.tail_cache = tail_cache
+        ## Notes are only made if the entry is still what we saw now:
+        self._head_generation = 0
+        if heads is not None:
+            head = heads.get(dir)
+            if head is not None:
+                self._head_generation = head.generation
+
+    def note_head(self, collection_id, position):
+        """Notes the collection_id (or '') and last counter seen in
+        the heads table"""
+        if self.heads is not None:
+            self.heads.note(self.dir, self._head_generation, collection_id, position)
+
+    def _replaced(self):
+        """Notes that the database has been replaced or compacted"""
+        if self.tail_cache is not None:
+            self.tail_cache.invalidate(self.dir)
+        if self.heads is not None:
+            self.heads.invalidate(self.dir)
+            ## What this object sees from now on is after the change:
+            head = self.heads.get(self.dir)
+            if head is not None:
+                self._head_generation = head.generation
 
     @property
     def collection_id(self):
@@ -92,10 +371,15 @@ class Storage(object):
             return self._collection_id
         col_filename = os.path.join(self.dir, 'collection_id.txt')
 
+        created = []
+
         def creator():
+            created.append(True)
             return '%06i' % (int(self.timer() * 100) % (10 ** 6))
 
         self._collection_id = read_unique(col_filename, creator)
+        if created:
+            self._replaced()
         return self._collection_id
 
     @property
@@ -120,7 +404,10 @@ class Storage(object):
 
     def clear(self):
         """Clears this database entirely."""
+        self._forget_db()
+        self._replaced()
         shutil.rmtree(self.dir)
+        self._replaced()
 
     @property
     def is_deprecated(self):
@@ -131,12 +418,110 @@ class Storage(object):
 
     @property
     def db(self):
-        """Returns the cutout database"""
+        """Returns the cutout database
+
+        The database is opened once and kept for the life of this
+        object (which is typically one request)."""
+        if self._db is not None:
+            return self._db
         if self.is_deprecated:
             raise StorageDeprecated()
         db_name = os.path.join(self.dir, 'database')
-        db = Database(db_name)
-        return db
+        if self.compress:
+            self._db = self.engine_class(db_name, durability=self.durability, compress=True)
+        else:
+            self._db = self.engine_class(db_name, durability=self.durability)
+        return self._db
+
+    def _forget_db(self):
+        """Closes the kept database, for when the files underneath
+        it are being replaced"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def recover(self):
+        """Checks and repairs the tail of each database file in this
+        storage.  Returns a dictionary of ``{name: (index_records_removed,
+        data_bytes_removed)}`` for the files that needed repair"""
+        self._forget_db()
+        self._replaced()
+        damage = {}
+        for name in 'database', 'queue', 'deprecated':
+            db_name = os.path.join(self.dir, name)
+            if not os.path.exists(db_name):
+                continue
+            db = self.engine_class(db_name)
+            try:
+                removed = db.recover()
+                ## (the cutout engine repairs a torn tail when opened)
+                opened = getattr(db, 'recovered', (0, 0))
+                removed = (removed[0] + opened[0], removed[1] + opened[1])
+            finally:
+                db.close()
+            if removed != (0, 0):
+                damage[name] = removed
+        return damage
+
+    @property
+    def snapshot(self):
+        """The `cutout.snapshot.Snapshot` of the latest objects in the
+        database"""
+        return Snapshot(self.dir, self.engine_class)
+
+    @property
+    def objects(self):
+        """The `cutout.objindex.ObjectIndex` of where the latest
+        record of each object is"""
+        return ObjectIndex(os.path.join(self.dir, 'objects.index'))
+
+    @property
+    def expiry(self):
+        """The `cutout.expiry.ExpiryIndex` of records with an expire
+        time"""
+        return ExpiryIndex(os.path.join(self.dir, 'expiry.index'))
+
+    def extend(self, datas, **kw):
+        """Adds to the database (like `cutout.Database.extend`),
+        updating the expiry index, the object index if it is kept up
+        to date, and the heads table"""
+        datas = list(datas)
+        if self.heads is None:
+            counter = self.db.extend(datas, **kw)
+        else:
+            with self.heads.writing(self.dir):
+                counter = self.db.extend(datas, **kw)
+                collection_id = self.collection_id if self.has_collection_id else ''
+                self.note_head(collection_id, self.db.length())
+        if kw.get('with_counters'):
+            records = datas
+        else:
+            records = [(counter + index, data) for index, data in enumerate(datas)]
+        if self.heads is not None and self.tail_cache is not None:
+            self.tail_cache.extended(self.dir, self._head_generation, records)
+        ## (from the records themselves, so the log isn't read back)
+        self.expiry.add(self.db, records)
+        if self.object_index:
+            self.objects.sync(self.db)
+        return counter
+
+    def collect(self, expire_time=None):
+        """Removes superseded and expired records (see
+        `cutout.gc.collect`); returns the counters removed"""
+        self._replaced()
+        try:
+            return gc.collect(self.db, expire_time=expire_time, snapshot=self.snapshot,
+                              objects=self.objects, expiry=self.expiry)
+        finally:
+            self._replaced()
+
+    @property
+    def position(self):
+        """The counter of the last item in the database, without
+        creating the database if it does not yet exist"""
+        if self.empty:
+            return 0
+        return self.db.length()
 
     @property
     def deprecated_db(self):
@@ -144,7 +529,7 @@ class Storage(object):
         db_name = os.path.join(self.dir, 'deprecated')
         if not os.path.exists(db_name):
             raise IOError("File does not exist: %r" % db_name)
-        db = Database(db_name)
+        db = self.engine_class(db_name, durability=self.durability)
         return db
 
     @property
@@ -158,14 +543,13 @@ class Storage(object):
     def queue_db(self):
         """The queue cutout database"""
         db_name = os.path.join(self.dir, 'queue')
-        db = Database(db_name)
+        db = self.engine_class(db_name, durability=self.durability)
         return db
 
     @property
     def empty(self):
         return (not self.is_deprecated and not self.has_queue and
-                (not os.path.exists(os.path.join(self.dir, 'database.index'))
-                 or os.path.getsize(os.path.join(self.dir, 'database.index')) == 12))
+                self.engine_class.is_empty(os.path.join(self.dir, 'database')))
 
     def set_collection_id(self, collection_id):
         ## FIXME: This might have race conditions?
@@ -174,21 +558,127 @@ class Storage(object):
         with open(col_filename, 'wb') as fp:
             fp.write(collection_id)
         self._collection_id = collection_id
+        self._replaced()
 
     def deprecate(self):
         """Deprecates the database"""
         if self.is_deprecated:
             return
-        db_name = os.path.join(self.dir, 'database')
-        fp = open(db_name + '.index', 'r+b')
-        with lock_complete(fp):
-            ## FIXME: anyone holding the database open will still be able to write to it
-            ## Maybe copy and truncate the database?
-            ## FIXME: also this could fail if deprecated also exists, which is kind
-            ## of okay, but should be caught more formally
-            os.rename(db_name, os.path.join(self.dir, 'deprecated'))
-            os.rename(db_name + '.index', os.path.join(self.dir, 'deprecated.index'))
-        fp.close()
+        self._forget_db()
+        self._replaced()
+        db = self.engine_class(os.path.join(self.dir, 'database'))
+        ## Anyone still holding the database open can't write to it
+        ## once it is renamed (see `cutout.DatabaseMoved`)
+        ## FIXME: this this could fail if deprecated also exists, which is kind
+        ## of okay, but should be caught more formally
+        db.rename(os.path.join(self.dir, 'deprecated'))
+        db.close()
+        self._replaced()
+
+    def undeprecate(self):
+        """Puts a deprecated database back in use"""
+        if not self.is_deprecated:
+            return
+        db = self.deprecated_db
+        db.rename(os.path.join(self.dir, 'database'))
+        db.close()
+        self._replaced()
+
+    @property
+    def last_modified(self):
+        """When a file of this database was last changed"""
+        return max([os.path.getmtime(os.path.join(self.dir, name))
+                    for name in os.listdir(self.dir)] + [0])
+
+    def _marker(self, name):
+        """Returns the contents of a marker file, or None if it
+        doesn't exist"""
+        try:
+            with open(os.path.join(self.dir, name), 'rb') as fp:
+                return fp.read()
+        except IOError, e:
+            if e.errno != 2:
+                raise
+            return None
+
+    def _set_marker(self, name, value):
+        """Writes a marker file, or removes it if `value` is None"""
+        filename = os.path.join(self.dir, name)
+        if value is None:
+            try:
+                os.unlink(filename)
+            except OSError, e:
+                if e.errno != 2:
+                    raise
+            return
+        ensure_dir(self.dir)
+        with open(filename, 'wb') as fp:
+            fp.write(value)
+
+    ## Live migration: the source node marks the database with
+    ## `start_migration`, and keeps serving it while it is copied; the
+    ## new node is marked `is_receiving` while it copies; then
+    ## `hand_off` makes the source forward everything to the new node
+    ## (`moved_to`) and returns the records written since the copy.
+
+    @property
+    def migrating_to(self):
+        """The node this database is being copied to (see
+        `start_migration`), or None"""
+        return self._marker('migrating_to')
+
+    @property
+    def moved_to(self):
+        """The node this database has been handed off to (see
+        `hand_off`), or None"""
+        return self._marker('moved_to')
+
+    @property
+    def is_receiving(self):
+        """True while this database is being migrated here, and isn't
+        complete yet"""
+        return os.path.exists(os.path.join(self.dir, 'receiving'))
+
+    def set_receiving(self, receiving):
+        self._set_marker('receiving', '1' if receiving else None)
+
+    def start_migration(self, node):
+        """Starts a live migration to `node`.  Returns the position
+        the new node should copy up to; the database is still used as
+        normal until `hand_off`"""
+        self._set_marker('migrating_to', node)
+        return self.position
+
+    def hand_off(self, since):
+        """Finishes a live migration: from now on this database's
+        requests go to the new node, and the database is deprecated
+        here.  Returns the records after `since` (which the new node
+        hasn't copied yet).  It can be called again, to get any records
+        written by requests that were under way during the hand off;
+        writes that come after the database is deprecated fail with
+        `cutout.DatabaseMoved` instead of being lost"""
+        if self.moved_to is None:
+            node = self.migrating_to
+            if node is None:
+                raise ValueError('%s is not being migrated' % self.dir)
+            self._set_marker('moved_to', node)
+            self.deprecate()
+            self._set_marker('migrating_to', None)
+        if not self.is_deprecated:
+            return []
+        db = self.deprecated_db
+        try:
+            return list(db.read(since))
+        finally:
+            db.close()
+
+    def retire(self):
+        """Removes the data of a database that has been handed off,
+        keeping the note of where it went"""
+        node = self.moved_to
+        self.clear()
+        if node is not None:
+            self._set_marker('moved_to', node)
 
     def encode_db(self, until=None):
         """Returns an iterator that yields the encoded database, for
@@ -199,15 +689,44 @@ class Storage(object):
             db = self.deprecated_db
         else:
             db = self.db
+        if not db.raw_files:
+            ## Sent in the cutout.streamdb format instead:
+            export_filename = os.path.join(self.dir, 'export-%s' % b64_encode(os.urandom(9)))
+            with open(export_filename, 'wb') as fp:
+                db.export_stream(fp, until)
+            return EncodedIterator(collection_id, collection_secret, None, 0,
+                                   export_filename, os.path.getsize(export_filename),
+                                   delete_db=True)
         index_pos, data_pos = db.get_file_positions(until)
+        ## Compressed records are sent as they are, with the dictionary:
+        dictionary = None
+        dictionary_filename = getattr(db, 'dictionary_filename', None)
+        if dictionary_filename and os.path.exists(dictionary_filename):
+            with open(dictionary_filename, 'rb') as fp:
+                dictionary = fp.read()
         return EncodedIterator(collection_id,
                                collection_secret,
                                db.index_filename, index_pos,
-                               db.data_filename, data_pos)
+                               db.data_filename, data_pos,
+                               dictionary=dictionary)
 
     def decode_db(self, fp, append_queue=False):
         """Decodes the encoded database, as found in the file-like
         `fp` object.  Overwrites colletion_id and the database"""
+        self._forget_db()
+        self._replaced()
+        try:
+            self._decode_db(fp, append_queue)
+        finally:
+            self._replaced()
+        ## The database lives here again:
+        self._set_marker('moved_to', None)
+        self._set_marker('migrating_to', None)
+
+    def _decode_db(self, fp, append_queue):
+        self.snapshot.clear()
+        self.objects.clear()
+        self.expiry.clear()
         (length,) = int_encoding.unpack(fp.read(4))
         collection_id = fp.read(length)
         col_filename = os.path.join(self.dir, 'new_collection_id.txt')
@@ -227,28 +746,56 @@ class Storage(object):
         (length,) = int_encoding.unpack(fp.read(4))
         db_name = os.path.join(self.dir, 'new_database')
         queue_filename = os.path.join(self.dir, 'queue')
+        has_index = self.engine_class.has_index
+        if not has_index and length:
+            raise ValueError(
+                "The encoded database has an index, but the %r engine does not use one"
+                % self.engine)
+        raw_files = self.engine_class.raw_files
+        names = ['new_collection_id.txt', 'new_collection_secret.txt']
+        if raw_files:
+            names.append('new_database')
         queue_index_fp = None
-        if os.path.exists(queue_filename + '.index'):
-            queue_index_fp = open(queue_filename + '.index', 'rb')
+        ## Without an index file the queue's data file is locked instead:
+        queue_lock_filename = queue_filename
+        if has_index:
+            queue_lock_filename += '.index'
+        if raw_files and os.path.exists(queue_lock_filename):
+            queue_index_fp = open(queue_lock_filename, 'rb')
             lock_file(queue_index_fp, LOCK_EX, 0, 0, os.SEEK_SET)
-        new_fp = open_create(db_name + '.index')
-        try:
-            self._copy_chunked(fp, new_fp, length)
-            if queue_index_fp is not None:
-                new_fp.write(queue_index_fp.read())
-        finally:
-            new_fp.close()
+        if has_index:
+            names.append('new_database.index')
+            new_fp = open_create(db_name + '.index')
+            try:
+                self._copy_chunked(fp, new_fp, length)
+                if queue_index_fp is not None:
+                    new_fp.write(queue_index_fp.read())
+            finally:
+                new_fp.close()
         (length,) = int_encoding.unpack(fp.read(4))
         new_fp = open_create(db_name)
         try:
             self._copy_chunked(fp, new_fp, length)
-            if append_queue and os.path.exists(queue_filename):
+            if append_queue and os.path.exists(queue_filename) and raw_files:
                 with open(queue_filename, 'rb') as copy_fp:
                     ## FIXME: chunk
                     new_fp.write(copy_fp.read())
+            elif append_queue and os.path.exists(queue_filename):
+                queue_db = self.queue_db
+                queue_db.export_stream(new_fp)
+                queue_db.delete()
         finally:
             new_fp.close()
-        for name in 'new_collection_id.txt', 'new_collection_secret.txt', 'new_database.index', 'new_database':
+        if not raw_files:
+            self._load_stream(db_name)
+        ## An optional dictionary for compressed records follows:
+        chunk = fp.read(4)
+        if len(chunk) == 4:
+            (length,) = int_encoding.unpack(chunk)
+            with open(os.path.join(self.dir, 'new_database.dict'), 'wb') as dict_fp:
+                dict_fp.write(fp.read(length))
+            names.append('new_database.dict')
+        for name in names:
             os.rename(os.path.join(self.dir, name),
                       os.path.join(self.dir, name[4:]))
         if append_queue:
@@ -260,6 +807,24 @@ class Storage(object):
         if queue_index_fp is not None:
             lock_file(queue_index_fp, LOCK_UN, 0, 0, os.SEEK_SET)
 
+    def _load_stream(self, stream_filename):
+        """Replaces the database with the records in a file in the
+        `cutout.streamdb` format, for engines whose files can't just
+        be put in place"""
+        loaded_filename = stream_filename + '.loaded'
+        try:
+            self.engine_class.load_stream(stream_filename, loaded_filename)
+            db = self.engine_class(os.path.join(self.dir, 'database'),
+                                   durability=self.durability)
+            try:
+                db.overwrite(loaded_filename)
+            finally:
+                db.close()
+        finally:
+            os.unlink(stream_filename)
+            if os.path.exists(loaded_filename):
+                self.engine_class(loaded_filename).delete()
+
     def _copy_chunked(self, old, new, length, chunk=4000 * 1024):
         while length > 0:
             chunk = old.read(min(length, chunk))
@@ -327,8 +892,13 @@ class Storage(object):
 class EncodedIterator(object):
     """An iterator for the result of db.encode_db()"""
 
-    def __init__(self, collection_id, collection_secret, index_name, index_length, db_name, db_length, chunk=4000 * 1024):
+    def __init__(self, collection_id, collection_secret, index_name, index_length, db_name, db_length, chunk=4000 * 1024,
+                 delete_db=False, dictionary=None):
         self.collection_id = collection_id
+        ## The dictionary of compressed records (see `cutout.compression`):
+        self.dictionary = dictionary
+        ## If db_name is a temporary file, to remove once it's sent:
+        self.delete_db = delete_db
         self.collection_secret = collection_secret
         self.db_name = db_name
         self.db_length = db_length
@@ -337,8 +907,11 @@ class EncodedIterator(object):
         self.chunk = chunk
         self.length = (
             4 + len(collection_id)
+            + 4 + len(collection_secret)
             + 4 + self.index_length
             + 4 + self.db_length)
+        if dictionary is not None:
+            self.length += 4 + len(dictionary)
 
     def __iter__(self):
         yield int_encoding.pack(len(self.collection_id))
@@ -347,33 +920,53 @@ class EncodedIterator(object):
         yield self.collection_secret
         yield int_encoding.pack(self.index_length)
         left = self.index_length
-        with open(self.index_name, 'rb') as fp:
-            while left > 0:
-                chunk = fp.read(min(self.chunk, left))
-                left -= len(chunk)
-                yield chunk
+        if left:
+            with open(self.index_name, 'rb') as fp:
+                while left > 0:
+                    chunk = fp.read(min(self.chunk, left))
+                    left -= len(chunk)
+                    yield chunk
         yield int_encoding.pack(self.db_length)
         left = self.db_length
-        with open(self.db_name, 'rb') as fp:
-            while left > 0:
-                chunk = fp.read(min(self.chunk, left))
-                left -= len(chunk)
-                yield chunk
+        try:
+            with open(self.db_name, 'rb') as fp:
+                while left > 0:
+                    chunk = fp.read(min(self.chunk, left))
+                    left -= len(chunk)
+                    yield chunk
+        finally:
+            if self.delete_db:
+                os.unlink(self.db_name)
+        if self.dictionary is not None:
+            yield int_encoding.pack(len(self.dictionary))
+            yield self.dictionary
 
 
 class Application(object):
 
     def __init__(self, storage=None, dir=None,
                  include_syncclient=False,
-                 secret_filename='/tmp/cutout-secret.txt'):
+                 secret_filename='/tmp/cutout-secret.txt',
+                 durability='none', engine='cutout',
+                 max_response_bytes=4 * 1024 * 1024, object_index=False,
+                 max_post_bytes=16 * 1024 * 1024, minify_syncclient=False,
+                 poll_hints=None, compress=False):
         if storage is None and dir:
-            storage = UserStorage(dir)
+            storage = UserStorage(dir, durability=durability, engine=engine,
+                                  object_index=object_index, compress=compress)
         self.storage = storage
+        ## The most object data a GET returns at once (None for no limit):
+        self.max_response_bytes = max_response_bytes
+        ## The largest POST body accepted (None for no limit):
+        self.max_post_bytes = max_post_bytes
         self.include_syncclient = include_syncclient
-        self._syncclient_app = None
-        self._syncclient_mtime = None
-        self._syncclient_app_url = None
+        self._syncclient = ScriptAsset(syncclient_filename, render_syncclient,
+                                       minify=minify_syncclient)
         self._secret_filename = secret_filename
+        ## The X-Sync-Poll-Time given with GETs (see `cutout.polling`):
+        if poll_hints is None:
+            poll_hints = PollHints()
+        self.poll_hints = poll_hints
 
     def unauthorized(self, reason):
         return Response(
@@ -400,22 +993,61 @@ class Application(object):
 
     @wsgify
     def __call__(self, req):
-        """Responds to and routes all requests
+        """Responds to all requests, noting the time taken and the
+        status for each route (which is set in ``cutout.route``), and
+        adding the request ID and timings (see `cutout.timing`)
+        """
+        start = time.time()
+        req.environ['cutout.route'] = 'other'
+        timing.request_id(req.environ)
+        status = 500
+        resp = None
+        self.poll_hints.started()
+        try:
+            resp = self.route(req)
+            status = getattr(resp, 'status_code', 200)
+            return resp
+        except exc.HTTPException, e:
+            status = e.code
+            resp = e
+            raise
+        except DatabaseMoved:
+            ## A write that lost the race with a hand off (see
+            ## `Storage.hand_off`); when retried it is forwarded:
+            status = 503
+            resp = Response(status=503, retry_after=1, body='Data in transit')
+            return resp
+        finally:
+            self.poll_hints.finished()
+            route = req.environ['cutout.route']
+            request_seconds.labels(route=route).observe(time.time() - start)
+            requests_total.labels(route=route, status=status).inc()
+            timing.finish(req, resp, 'node', start, status)
+
+    ## The requests that aren't for a database: {path: (route, method name)}
+    paths = {
+        '/verify': ('verify', 'verify'),
+        '/node-added': ('node-added', 'node_added'),
+        '/remove-self': ('remove-self', 'remove_self'),
+        '/query-deprecate': ('query-deprecate', 'query_deprecate'),
+        '/take-over': ('take-over', 'take_over'),
+        '/query-shard': ('query-shard', 'query_shard'),
+        '/stats': ('stats', 'stats'),
+        }
+
+    def route(self, req):
+        """Routes all requests
         """
         if self.include_syncclient and req.path_info == '/syncclient.js':
+            req.environ['cutout.route'] = 'syncclient'
             return self.syncclient(req)
         path_info = req.path_info
-        if path_info == '/verify':
-            return self.verify(req)
-        if path_info == '/node-added':
-            return self.node_added(req)
-        if path_info == '/remove-self':
-            return self.remove_self(req)
-        if path_info == '/query-deprecate':
-            return self.query_deprecate(req)
-        if path_info == '/take-over':
-            return self.take_over(req)
-        self.annotate_auth(req)
+        if path_info in self.paths:
+            route, method = self.paths[path_info]
+            req.environ['cutout.route'] = route
+            return getattr(self, method)(req)
+        with timing.timings(req.environ).phase('auth'):
+            self.annotate_auth(req)
         domain = req.path_info_peek()
         headers = self.access_for_domain(domain)
         _suppress_headers = []
@@ -423,6 +1055,7 @@ class Application(object):
         def suppress_headers():
             _suppress_headers.append(True)
         if req.method == 'OPTIONS':
+            req.environ['cutout.route'] = 'options'
             return Response(
                 status='200 OK',
                 body='',
@@ -443,25 +1076,55 @@ class Application(object):
         req.script_name, req.path_info = script_name, path_info
         if domain is None or username is None or not bucket:
             return exc.HTTPNotFound('Not a valid URL: %r' % path_info)
+        times = timing.timings(req.environ)
         if not self.is_internal(req):
-            resp = self._check_auth(req, username=username, domain=domain)
+            with times.phase('auth'):
+                resp = self._check_auth(req, username=username, domain=domain)
             if resp:
                 return resp
+        if req.method == 'GET' and not static_path and set(req.GET) <= self.head_params:
+            with times.phase('head'):
+                resp = self.head_response(req, domain, username, bucket)
+            if resp is not None:
+                return resp
         if 'include' in req.GET and 'exclude' in req.GET:
             raise exc.HTTPBadRequest('You may only include one of "exclude" or "include"')
-        db = self.storage.for_user(domain, username, bucket)
+        if (req.method == 'GET' and not static_path and set(req.GET) <= self.packed_params
+            and getattr(self.storage, 'packs', None) is not None
+            and not self.storage.is_disabled):
+            with times.phase('open'):
+                packed = self.storage.packed(domain, username, bucket)
+            if packed is not None:
+                return self.packed_get(req, packed, self.storage.db_dir(domain, username, bucket))
+        with times.phase('open'):
+            db = self.storage.for_user(domain, username, bucket)
         if 'copy' in req.GET:
+            req.environ['cutout.route'] = 'copy'
             suppress_headers()
             return self.copy(req, db)
         elif 'paste' in req.GET:
+            req.environ['cutout.route'] = 'paste'
             suppress_headers()
             return self.paste(req, db)
         elif 'deprecate' in req.GET:
+            req.environ['cutout.route'] = 'deprecate'
             suppress_headers()
             return self.deprecate(req, db)
-        elif 'delete' in req.GET:
+        elif 'handoff' in req.GET:
+            req.environ['cutout.route'] = 'handoff'
+            suppress_headers()
+            return self.handoff(req, db)
+        moved_to = db.moved_to
+        if moved_to is not None:
+            req.environ['cutout.route'] = 'moved'
+            return self.moved(req, moved_to)
+        if db.is_receiving and not self.wait_for_handoff(db):
+            return Response(status=503, retry_after=1, body='Data in transit')
+        if 'delete' in req.GET:
+            req.environ['cutout.route'] = 'delete'
             return self.delete(req, db)
         elif 'backup-from-pos' in req.GET:
+            req.environ['cutout.route'] = 'backup'
             suppress_headers()
             return self.apply_backup(req, db)
         if db.is_deprecated:
@@ -469,23 +1132,108 @@ class Application(object):
         if self.storage.is_disabled:
             return Response(status=503, retry_after=60, body='Server in process of retiring')
         if static_path:
+            req.environ['cutout.route'] = 'static'
             return self.static(req, db, static_path)
+        if 'position' in req.GET:
+            req.environ['cutout.route'] = 'position'
+            return self.position(req, db)
+        etag = None
+        if req.method == 'GET' and 'id' not in req.GET:
+            ## Taken before reading, so a write during the read can
+            ## only make the ETag older than the data:
+            with times.phase('open'):
+                etag = self.get_etag(req, db)
+            if etag in req.if_none_match:
+                req.environ['cutout.route'] = 'not-modified'
+                return self.not_modified(req, db, etag)
+        with times.phase('open'):
+            db.db
         collection_id = req.GET.get('collection_id')
         if collection_id is not None and collection_id != db.collection_id:
+            req.environ['cutout.route'] = 'get'
             req.GET.since = '0'
             resp_data = self.get(req, db)
             resp_data = self.update_json(
                 resp_data, collection_changed=True,
                 collection_id=db.collection_id)
         elif req.method == 'POST':
+            req.environ['cutout.route'] = 'post'
             resp_data = self.post(req, db)
         else:
+            req.environ['cutout.route'] = 'get'
             resp_data = self.get(req, db)
         if 'collection_id' not in req.GET and db.has_collection_id:
             resp_data = self.update_json(resp_data, collection_id=db.collection_id)
         if not isinstance(resp_data, str):
-            resp_data = json.dumps(resp_data, separators=(',', ':'))
+            with times.phase('encode'):
+                resp_data = json.dumps(resp_data, separators=(',', ':'))
         resp = Response(resp_data, content_type='application/json')
+        resp.headers['X-Sync-Position'] = str(db.position)
+        if db.has_collection_id:
+            ## So the balancer can tell when the database was reset:
+            resp.headers['X-Sync-Collection-Id'] = db.collection_id
+        if (etag is not None and req.environ['cutout.route'] == 'get'
+            and not req.environ.get('cutout.incomplete')):
+            resp.etag = etag
+        if req.method == 'GET':
+            resp.headers['X-Sync-Poll-Time'] = str(self.poll_hints.poll_time(db.dir))
+        return resp
+
+    ## How long (in seconds) a request waits for a database that is
+    ## being handed off to this node before getting a 503:
+    handoff_wait = 1.0
+
+    def wait_for_handoff(self, db):
+        """Waits for a live migration to this node to finish (see
+        `node_added`); returns False if it didn't in time"""
+        deadline = time.time() + self.handoff_wait
+        while db.is_receiving:
+            if time.time() >= deadline:
+                handoff_waits.labels(result='timeout').inc()
+                return False
+            time.sleep(0.01)
+        handoff_waits.labels(result='done').inc()
+        return True
+
+    ## The parameters of a GET that `head_response` may answer:
+    head_params = frozenset(['since', 'collection_id', 'limit', 'max_bytes', 'auth'])
+
+    def head_response(self, req, domain, username, bucket):
+        """Answers a GET from a client that is up to date (or has the
+        current ETag) from the heads table, without touching the
+        filesystem; returns None if the table can't tell"""
+        storage_heads = getattr(self.storage, 'heads', None)
+        if storage_heads is None or storage_heads.disabled:
+            return None
+        head = self.storage.head(domain, username, bucket)
+        if head is None or not head.known:
+            return None
+        try:
+            since = int(req.GET.get('since', 0))
+        except ValueError:
+            return None
+        collection_id = req.GET.get('collection_id')
+        if collection_id is not None and collection_id != head.collection_id:
+            return None
+        etag = self.make_etag(head.collection_id, head.counter, '')
+        key = self.storage.db_dir(domain, username, bucket)
+        if etag in req.if_none_match:
+            req.environ['cutout.route'] = 'head-not-modified'
+            resp = Response(status=304)
+        elif since >= head.counter:
+            req.environ['cutout.route'] = 'head'
+            if collection_id is None and head.collection_id:
+                body = '{"objects":[],"collection_id":%s}' % json.dumps(head.collection_id)
+            else:
+                body = '{"objects":[]}'
+            resp = Response(body, content_type='application/json')
+        else:
+            return None
+        resp.etag = etag
+        resp.headers['X-Sync-Position'] = str(head.counter)
+        if head.collection_id:
+            resp.headers['X-Sync-Collection-Id'] = head.collection_id
+        resp.headers['X-Sync-Poll-Time'] = str(self.poll_hints.poll_time(key))
         return resp
 
     static_re = re.compile(r'^[a-zA-Z0-9_-]+$')
@@ -518,6 +1266,10 @@ class Application(object):
         return {
             'Access-Control-Allow-Methods': 'GET,POST',
             'Access-Control-Allow-Origin': 'http://%s https://%s' % (domain, domain),
+            ## So clients can make conditional GETs (see `get`) and
+            ## follow the poll hints (see `cutout.polling`):
+            'Access-Control-Allow-Headers': 'If-None-Match',
+            'Access-Control-Expose-Headers': 'ETag, X-Sync-Poll-Time',
             }
 
     def _check_auth(self, req, username, domain):
@@ -535,17 +1287,36 @@ class Application(object):
         if remote_domain != domain:
             return self.unauthorized('Incorrect authentication provided: bad domain (%r != %r)' % (remote_domain, domain))
 
+    def read_items(self, req):
+        """Reads the JSON array of items in a POST body, returning a
+        list of ``(item, encoded)`` (see `split_items`)"""
+        if (self.max_post_bytes is not None and req.content_length is not None
+            and req.content_length > self.max_post_bytes):
+            raise exc.HTTPRequestEntityTooLarge(
+                'POST bodies may be at most %i bytes' % self.max_post_bytes)
+        body = req.body
+        if self.max_post_bytes is not None and len(body) > self.max_post_bytes:
+            raise exc.HTTPRequestEntityTooLarge(
+                'POST bodies may be at most %i bytes' % self.max_post_bytes)
+        try:
+            return split_items(body)
+        except ValueError, e:
+            raise exc.HTTPBadRequest('POST must have a valid JSON body: %s' % e)
+
     def post(self, req, db):
         """Responds to ``POST /db-name``
 
-        Handles the public interface for adding to a database.
+        Handles the public interface for adding to a database.  Items
+        are stored as they were sent, except for items with blob data
+        (which is removed and saved separately).
         """
-        try:
-            data = req.json
-        except ValueError:
-            raise exc.HTTPBadRequest('POST must have valid JSON body')
+        times = timing.timings(req.environ)
+        with times.phase('parse'):
+            items = self.read_items(req)
+        data = [item for item, encoded in items]
+        data_encoded = [encoded for item, encoded in items]
         blobs = []
-        for item in data:
+        for index, item in enumerate(data):
             ## FIXME: I should verify any blob.href's the body, to
             ## make sure the URL isn't being inappropriately modified.
             ## Maybe if neither data nor href are present I should
@@ -573,12 +1344,13 @@ class Application(object):
                     blob_item['type'] = item['type']
                 blobs.append(blob_item)
                 del item['blob']['data']
-        data_encoded = [json.dumps(i) for i in data]
+                data_encoded[index] = json.dumps(item)
         since = int(req.GET.get('since', 0))
         counter = None
         last_pos = db.db.length()
         try:
-            counter = db.db.extend(data_encoded, expect_latest=since)
+            with times.phase('extend'):
+                counter = db.extend(data_encoded, expect_latest=since)
         except ExpectationFailed:
             pass
         if counter is None and 'include' in req.GET or 'exclude' in req.GET:
@@ -600,15 +1372,18 @@ class Application(object):
                 if failed:
                     break
                 try:
-                    counter = db.db.extend(data_encoded, expect_latest=since)
+                    counter = db.extend(data_encoded, expect_latest=since)
                     break
                 except ExpectationFailed:
                     pass
         if counter is None:
             resp_data = self.get(req, db)
-            resp_data = self.update_json(resp_data, invalid_since=True)
+            resp_data = self.update_json(
+                resp_data, invalid_since=True,
+                conflicts=self.find_conflicts(db, data, since))
             return resp_data
         counters = [counter + index for index in range(len(data))]
+        self.poll_hints.note_change(db.dir)
         if req.headers.get('X-Backup-To'):
             backups = [name.strip() for name in req.headers['X-Backup-To'].split(',')
                        if name.strip()]
@@ -617,9 +1392,10 @@ class Application(object):
         resp = dict(object_counters=counters)
         if blobs:
             for blob_item in blobs:
-                db.save_blob(blob_item['name'],
-                             blob_item['content_type'],
-                             blob_item['data'])
+                with times.phase('blob'):
+                    db.save_blob(blob_item['name'],
+                                 blob_item['content_type'],
+                                 blob_item['data'])
                 del blob_item['name']
                 del blob_item['content_type']
                 del blob_item['data']
@@ -629,6 +1405,17 @@ class Application(object):
                 db.maybe_delete_blob(item.get('type'), item['id'])
         return resp
 
+    def find_conflicts(self, db, data, since):
+        """Returns ``[type, id]`` for each of the posted objects that
+        has been changed since `since`"""
+        objects = db.objects
+        conflicts = []
+        for item in data:
+            found = objects.get(db.db, item.get('type'), item['id'])
+            if found is not None and found[0] > since:
+                conflicts.append([item.get('type'), item['id']])
+        return conflicts
+
     def post_backup(self, req, db, backup, last_pos):
         """Handles backups from a POST request.
 
@@ -649,10 +1436,11 @@ class Application(object):
             if key in backup_req.GET:
                 del backup_req.GET[key]
         backup_req.body = req.body
-        backup_req.environ['cutout.root'] = req.environ.get('cutout.root')
+        inherit(backup_req, req, 'backup')
         resp = forward(backup_req)
         #print 'sending backup req', backup_req, resp
         if resp.status_code >= 300:
+            backup_failures.labels(backup=backup).inc()
             ## FIXME: what then?!
             print 'WARNING: bad response from %s: %s' % (backup_req.url, resp)
 
@@ -660,7 +1448,65 @@ class Application(object):
         """Responds to ``GET /db-name``
 
         Returns the (public-interface) GET request.
+
+        The response is bounded by ``?limit`` (a number of items) and
+        by ``?max_bytes`` (of object data, at most the server's
+        ``max_response_bytes``).  If there are more items the response
+        includes ``incomplete: true`` and ``next_since``, the
+        ``since`` to use to get the rest.  Complete responses have an
+        ETag (see `get_etag`); sending it back in ``If-None-Match``
+        gets a 304 if nothing has been added since.
+
+        Initial syncs (``since=0``), and requests from before the
+        database was last garbage collected, are served from the
+        snapshot: only the latest version of each object.
+
+        ``?id=ID`` (with ``&type=TYPE`` if the object has one) returns
+        just the latest version of that object, if there is one (see
+        `get_object`).
         """
+        if 'id' in req.GET:
+            req.environ['cutout.route'] = 'get-object'
+            return self.get_object(req, db)
+        since, limit, max_bytes = self.read_params(req)
+        filtered = 'include' in req.GET or 'exclude' in req.GET
+        ## The tail only stands in for the log, not the snapshot:
+        from_snapshot = not since or since < db.snapshot.compacted
+        if not from_snapshot and not filtered and db.tail_cache is not None:
+            result = self.get_cached(req, db, since, max_bytes, limit)
+            if result is not None:
+                return result
+        with timing.timings(req.environ).phase('read'):
+            if from_snapshot:
+                items, complete = db.snapshot.read(db.db, since, max_bytes=max_bytes,
+                                                   limit=limit)
+            else:
+                items, complete = page(db.db.read(since), max_bytes=max_bytes,
+                                       limit=limit)
+        get_bytes.observe(sum(len(item) for count, item in items))
+        next_since = None
+        if not complete:
+            next_since = items[-1][0]
+            ## The client doesn't have everything, so no ETag:
+            req.environ['cutout.incomplete'] = True
+        elif items and not from_snapshot and db.tail_cache is not None:
+            db.tail_cache.read_all(db.dir, db._head_generation, since, items)
+        if filtered:
+            result = self.get_filtered(req, db, items)
+            if next_since is not None:
+                result.update(incomplete=True, next_since=next_since)
+            return result
+        if next_since is not None:
+            more = ',"incomplete":true,"next_since":%i' % next_since
+        else:
+            more = ''
+        result = '{"objects":[%s]%s}' % (
+            ','.join('[%i,%s]' % (count, item)
+                     for count, item in items), more)
+        return result
+
+    def read_params(self, req):
+        """Returns the ``(since, limit, max_bytes)`` of a GET"""
         try:
             since = int(req.GET.get('since', 0))
         except ValueError:
@@ -669,18 +1515,146 @@ class Application(object):
             limit = int(req.GET.get('limit', 0))
         except ValueError:
             raise exc.HTTPBadRequest('Bad value limit=%s' % req.GET['limit'])
-        items = db.db.read(since)
-        if limit:
-            new_items = []
-            for c, item in zip(xrange(limit), items):
-                new_items.append(item)
-            items = new_items
-        if 'include' in req.GET or 'exclude' in req.GET:
-            return self.get_filtered(req, db, items)
-        result = '{"objects":[%s]}' % (
-            ','.join('[%i,%s]' % (count, item)
-                     for count, item in items))
-        return result
+        max_bytes = self.max_response_bytes
+        if req.GET.get('max_bytes'):
+            try:
+                max_bytes = int(req.GET['max_bytes'])
+            except ValueError:
+                raise exc.HTTPBadRequest('Bad value max_bytes=%s' % req.GET['max_bytes'])
+            if self.max_response_bytes is not None:
+                max_bytes = min(max_bytes, self.max_response_bytes)
+        return since, limit, max_bytes
+
+    ## The parameters of a GET that `packed_get` may answer:
+    packed_params = head_params | frozenset(['include', 'exclude', 'id', 'type'])
+
+    def packed_get(self, req, packed, key):
+        """Answers a GET of a packed database (a
+        `cutout.pack.PackedDatabase`) from the pack, without unpacking
+        it.  This works like `get`, with the collection_id, ETag and
+        headers that `get_database_response` adds."""
+        packed_gets.inc()
+        filters = '&'.join('%s=%s' % (name, value) for name, value in req.GET.items()
+                           if name in ('include', 'exclude'))
+        etag = self.make_etag(packed.collection_id, packed.position, filters)
+        if self.storage.heads is not None:
+            head = self.storage.heads.get(key)
+            self.storage.heads.note(key, head.generation if head else 0,
+                                    packed.collection_id, packed.position)
+        headers = {'X-Sync-Position': str(packed.position),
+                   'X-Sync-Collection-Id': packed.collection_id,
+                   'X-Sync-Poll-Time': str(self.poll_hints.poll_time(key))}
+        if 'id' in req.GET:
+            req.environ['cutout.route'] = 'packed-get-object'
+            found = packed.get_object(req.GET.get('type'), req.GET['id'])
+            get_bytes.observe(len(found[1]) if found else 0)
+            objects = '[[%i,%s]]' % found if found else '[]'
+            return Response('{"objects":%s,"collection_id":%s}' % (objects, json.dumps(packed.collection_id)),
+                            content_type='application/json', headers=headers)
+        if etag in req.if_none_match:
+            req.environ['cutout.route'] = 'packed-not-modified'
+            resp = Response(status=304, headers=headers)
+            resp.etag = etag
+            return resp
+        req.environ['cutout.route'] = 'packed-get'
+        since, limit, max_bytes = self.read_params(req)
+        collection_id = req.GET.get('collection_id')
+        changed = collection_id is not None and collection_id != packed.collection_id
+        if changed:
+            since = 0
+        items, complete = packed.read(since, max_bytes=max_bytes, limit=limit)
+        get_bytes.observe(sum(len(item) for count, item in items))
+        result = self.get_filtered(req, None, items)
+        if not complete:
+            result.update(incomplete=True, next_since=items[-1][0])
+        if changed:
+            result.update(collection_changed=True)
+        result['collection_id'] = packed.collection_id
+        resp = Response(json.dumps(result, separators=(',', ':')),
+                        content_type='application/json', headers=headers)
+        if not result.get('incomplete'):
+            resp.etag = etag
+        return resp
+
+    def get_cached(self, req, db, since, max_bytes, limit):
+        """Returns the response to a GET from the database's tail in
+        the `cutout.tailcache.TailCache`, or None if the records after
+        `since` aren't all there"""
+        found = db.tail_cache.get(db.dir, db.heads and db.heads.get(db.dir), since,
+                                  max_bytes=max_bytes, limit=limit)
+        if found is None:
+            tail_reads.labels(result='miss').inc()
+            return None
+        tail_reads.labels(result='hit').inc()
+        records, complete = found
+        ## (the data is the fragment less the count and brackets)
+        get_bytes.observe(sum(len(fragment) - len(str(count)) - 3
+                              for count, fragment in records))
+        if complete:
+            more = ''
+        else:
+            more = ',"incomplete":true,"next_since":%i' % records[-1][0]
+            req.environ['cutout.incomplete'] = True
+        return '{"objects":[%s]%s}' % (','.join(fragment for count, fragment in records), more)
+
+    def get_etag(self, req, db):
+        """The ETag of a GET of `db`: the collection, the counter of
+        its last item and the ``include``/``exclude`` filters (the
+        collection_id is left out until it has been set)
+
+        Only the tail of the index is read.  ``since`` isn't part of
+        it: a client sending back the ETag of its last complete GET
+        already has everything up to the last item."""
+        filters = '&'.join('%s=%s' % (key, value) for key, value in req.GET.items()
+                           if key in ('include', 'exclude'))
+        collection_id = db.collection_id if db.has_collection_id else ''
+        position = db.position
+        ## Read before the items, so it's no newer than what was sent:
+        db.note_head(collection_id, position)
+        return self.make_etag(collection_id, position, filters)
+
+    def make_etag(self, collection_id, position, filters):
+        return '%s-%i-%s' % (collection_id, position, hashlib.md5(filters).hexdigest()[:8])
+
+    def not_modified(self, req, db, etag):
+        """Responds to a GET whose ``If-None-Match`` has the current
+        ETag (see `get_etag`), without reading any items"""
+        resp = Response(status=304)
+        resp.etag = etag
+        resp.headers['X-Sync-Position'] = str(db.position)
+        if db.has_collection_id:
+            resp.headers['X-Sync-Collection-Id'] = db.collection_id
+        resp.headers['X-Sync-Poll-Time'] = str(self.poll_hints.poll_time(db.dir))
+        return resp
+
+    def get_object(self, req, db):
+        """Responds to ``GET /db-name?id=ID&type=TYPE``
+
+        Uses the object index, so this does not read through the
+        database.  Deleted objects are returned too (with
+        ``deleted: true``), so clients can tell they are gone.
+        """
+        with timing.timings(req.environ).phase('read'):
+            found = db.objects.get(db.db, req.GET.get('type'), req.GET['id'])
+        if found is None:
+            get_bytes.observe(0)
+            return '{"objects":[]}'
+        get_bytes.observe(len(found[1]))
+        return '{"objects":[[%i,%s]]}' % found
+
+    def position(self, req, db):
+        """Responds to ``GET /db-name?position``
+
+        A cheap probe of how far along this copy of the database is;
+        only the tail of the index is read.  The balancer uses this to
+        decide if a backup is current enough to serve reads.
+        """
+        position = db.position
+        resp = Response(json={'position': position},
+                        headers={'X-Sync-Position': str(position)})
+        if db.has_collection_id:
+            resp.headers['X-Sync-Collection-Id'] = db.collection_id
+        return resp
 
     def get_filtered(self, req, db, items):
         """Handles ``GET /db-name?include=...|exclude=...``
@@ -703,28 +1677,15 @@ class Application(object):
         """Responds to ``GET /syncclient.js``
 
         Returns syncclient.js, with a substitution to point it to this
-        server.
+        server (see `cutout.assets`).
         """
-        if self._syncclient_app:
-            mtime = os.path.getmtime(syncclient_filename)
-            if mtime > self._syncclient_mtime:
-                self._syncclient_app = None
-            if req.application_url != self._syncclient_app_url:
-                ## cache different app urls?
-                self._syncclient_app = None
-        if not self._syncclient_app:
-            self._syncclient_mtime = os.path.getmtime(syncclient_filename)
-            self._syncclient_app_url = req.application_url
-            with open(syncclient_filename) as fp:
-                content = fp.read()
-            content = content.replace(
-                'Sync.baseUrl = null',
-                'Sync.baseUrl = %r' % req.application_url)
-            self._syncclient_app = Response(
-                content_type='text/javascript',
-                conditional_response=True,
-                body=content)
-        return self._syncclient_app
+        return self._syncclient.response(req, req.application_url)
+
+    @property
+    def syncclient_version(self):
+        """The version of syncclient.js; pages that load it from
+        ``syncclient.js?v=VERSION`` can cache it for a long time"""
+        return self._syncclient.current_version()
 
     def verify(self, req):
         """Responds to ``POST /verify``
@@ -749,6 +1710,16 @@ class Application(object):
             r['auth'] = {'query': {'auth': static}}
         return Response(json=r)
 
+    def stats(self, req):
+        """Responds to ``GET /stats`` (internal only)
+
+        Returns the request latencies, storage counters and so on of
+        this process (see `cutout.stats`), as JSON or with
+        ``?format=prometheus`` in the Prometheus text format.
+        """
+        self.assert_is_internal(req)
+        return stats.response(req)
+
     def annotate_auth(self, req):
         """Adds ``REMOTE_USER`` to ``req.environ``
 
@@ -768,6 +1739,28 @@ class Application(object):
         db.clear()
         return Response(status=201)
 
+    def moved(self, req, node):
+        """Forwards a request for a database that has been handed off
+        to `node` (see `Storage.hand_off`), for the requests that
+        arrive before the balancer sends them there"""
+        moved_forwards.inc()
+        url = urlparse.urljoin(req.application_url, '/' + node)
+        url += urllib.quote(req.path_info)
+        if req.query_string:
+            url += '?' + req.query_string
+        moved_req = Request.blank(url, method=req.method)
+        for name, value in req.headers.items():
+            if name.lower() not in ('host', 'content-length'):
+                moved_req.headers[name] = value
+        if req.method == 'POST':
+            moved_req.body = req.body
+        ## It was authenticated here, as it will be there:
+        for key in 'REMOTE_USER', 'cutout.internal':
+            if key in req.environ:
+                moved_req.environ[key] = req.environ[key]
+        inherit(moved_req, req, 'moved')
+        return forward(moved_req)
+
     ## Internal/management methods
 
     def copy(self, req, db):
@@ -810,6 +1803,32 @@ class Application(object):
         db.deprecate()
         return Response(status=201)
 
+    def handoff(self, req, db):
+        """Responds to ``POST /db-name?handoff&since=N`` - the last
+        step of a live migration (see `node_added`)
+
+        From now on requests for the database are forwarded to the
+        node it is being migrated to.  Responds with the records after
+        ``since``, in the `cutout.streamdb` format.  With ``?retire``
+        the database's data is also removed from this node.
+        """
+        self.assert_is_internal(req)
+        if req.method != 'POST':
+            return exc.HTTPMethodNotAllowed(allow='POST')
+        try:
+            since = int(req.GET.get('since', 0))
+        except ValueError:
+            raise exc.HTTPBadRequest('Bad value since=%s' % req.GET['since'])
+        try:
+            records = db.hand_off(since)
+        except ValueError, e:
+            raise exc.HTTPConflict(str(e))
+        if 'retire' in req.GET:
+            db.retire()
+        return Response(
+            ''.join(streamdb.encode_record(count, data) for count, data in records),
+            content_type='application/octet-stream')
+
     def node_added(self, req):
         """Responds to ``POST /node-added``
 
@@ -820,46 +1839,91 @@ class Application(object):
 
         `other`: list of all nodes.
         `name`: the name of this node.
+        `live`: if true, migrate the databases live: the other nodes
+        keep serving them while they are copied, and then hand them
+        off (see `handoff`), instead of returning 503 until the copy
+        is done.
 
         Responds with a text description of what it did.
         """
         self.assert_is_internal(req)
         status = Response(content_type='text/plain')
         data = req.json
+        live = data.get('live')
         dbs = []
         for other_node in data['other']:
             req_data = data.copy()
             req_data['name'] = other_node
             url = urlparse.urljoin(req.application_url, '/' + other_node)
-            status.write('Deprecating from %s\n' % url)
+            status.write('%s from %s\n' % ('Migrating' if live else 'Deprecating', url))
             query = Request.blank(url + '/query-deprecate', json=req_data, method='POST')
-            query.environ['cutout.root'] = req.environ.get('cutout.root')
+            inherit(query, req, 'query-deprecate')
             resp = forward(query)
             assert resp.status_code == 200, str(resp)
             resp_data = resp.json
-            for db_data in resp_data['deprecated']:
+            for db_data in resp_data.get('deprecated', []):
                 status.write('  deprecated: %(path)s\n' % db_data)
                 dbs.append((other_node, db_data))
+            for db_data in resp_data.get('migrating', []):
+                status.write('  migrating: %(path)s\n' % db_data)
+                dbs.append((other_node, db_data))
         for other_node, db_data in dbs:
             status.write('Copying database %s from %s\n' % (db_data['path'], other_node))
             url = urlparse.urljoin(req.application_url, '/' + other_node)
-            copier = Request.blank(url + urllib.quote(db_data['path']) + '?copy')
-            copier.environ['cutout.root'] = req.environ.get('cutout.root')
+            copy_url = url + urllib.quote(db_data['path']) + '?copy'
+            if 'position' in db_data:
+                copy_url += '&until=%i' % db_data['position']
+            copier = Request.blank(copy_url)
+            inherit(copier, req, 'copy')
             resp = forward(copier)
             assert resp.status_code == 200, str(resp)
             ## FIXME: the terribleness!
             fp = StringIO(resp.body)
             db = self.storage.for_user(db_data['domain'], db_data['username'], db_data['bucket'])
-            db.decode_db(fp)
-            status.write('  copied %i bytes\n' % resp.content_length)
-            deleter = Request.blank(url + db_data['path'] + '?delete')
-            deleter.environ['cutout.root'] = req.environ.get('cutout.root')
-            resp = forward(deleter)
-            assert resp.status_code < 300, str(resp)
-            status.write('  deleted\n')
+            if 'position' not in db_data:
+                db.decode_db(fp)
+                status.write('  copied %i bytes\n' % resp.content_length)
+                deleter = Request.blank(url + db_data['path'] + '?delete')
+                inherit(deleter, req, 'delete')
+                resp = forward(deleter)
+                assert resp.status_code < 300, str(resp)
+                status.write('  deleted\n')
+                continue
+            db.set_receiving(True)
+            try:
+                db.decode_db(fp)
+                status.write('  copied %i bytes\n' % resp.content_length)
+                self.receive_handoff(req, url, db, db_data, status)
+            finally:
+                db.set_receiving(False)
         status.write('done.\n')
         return status
 
+    def receive_handoff(self, req, url, db, db_data, status):
+        """Finishes the live migration of a database that has been
+        copied from the node at `url` up to ``db_data['position']``.
+        The source hands the database off, and the records it got
+        during the copy are added here.  Then it is asked again, for
+        any writes that were under way during the hand off, and
+        removes its copy."""
+        position = db_data['position']
+        for step in 'handoff', 'retire':
+            handoff_url = url + urllib.quote(db_data['path']) + '?handoff&since=%i' % position
+            if step == 'retire':
+                handoff_url += '&retire'
+            handoff = Request.blank(handoff_url, method='POST')
+            inherit(handoff, req, 'handoff')
+            resp = forward(handoff)
+            assert resp.status_code == 200, str(resp)
+            records = list(streamdb.decode_records(resp.body))
+            if records:
+                db.extend(records, with_counters=True)
+                position = records[-1][0]
+            if step == 'handoff':
+                status.write('  handed off, with %i new records\n' % len(records))
+            else:
+                status.write('  retired, with %i late records\n' % len(records))
+
     def remove_self(self, req):
         """Responds to ``POST /remove-self``
 
@@ -897,7 +1961,7 @@ class Application(object):
             url = urlparse.urljoin(req.application_url, '/' + new_node)
             send = Request.blank(url + urllib.quote(path) + '?paste',
                                  method='POST', body=''.join(db.encode_db()))
-            send.environ['cutout.root'] = req.environ.get('cutout.root')
+            inherit(send, req, 'paste')
             resp = forward(send)
             assert resp.status_code == 201, str(resp)
             status.write('  success, deleting\n')
@@ -919,6 +1983,8 @@ class Application(object):
         `name`: the name of this node
         `new`: the node being added
         `backups`: the number of backups to keep
+        `live`: if true, the databases are not deprecated, but are
+        kept in use until they are handed off (see `handoff`)
 
         Returns JSON::
 
@@ -931,6 +1997,9 @@ class Application(object):
              "username": "user",
              "bucket": "bucket"
             }
+
+        With `live` they are returned as ``"migrating"`` instead,
+        each with a ``"position"`` to copy the database up to.
         """
         self.assert_is_internal(req)
         data = req.json
@@ -939,6 +2008,7 @@ class Application(object):
         new_node = data['new']
         backups = data['backups']
         ring = HashRing(nodes + [new_node])
+        live = data.get('live')
         deprecated = []
         for domain, username, bucket in self.storage.all_dbs():
             assert bucket.startswith('/')
@@ -947,12 +2017,51 @@ class Application(object):
             active_nodes = [iterator.next() for i in xrange(backups + 1)]
             deprecated_node = iterator.next()
             if deprecated_node == self_name and new_node in active_nodes:
-                deprecated.append(
-                    {'path': path, 'domain': domain, 'username': username, 'bucket': bucket})
+                db_data = {'path': path, 'domain': domain, 'username': username, 'bucket': bucket}
+                deprecated.append(db_data)
                 db = self.storage.for_user(domain, username, bucket)
-                db.deprecate()
+                if live:
+                    db_data['position'] = db.start_migration(new_node)
+                else:
+                    db.deprecate()
+        if live:
+            return Response(json={'migrating': deprecated})
         return Response(json={'deprecated': deprecated})
 
+    def query_shard(self, req):
+        """Responds to ``POST /query-shard``
+
+        Lists the databases on this node that belong to one shard, for
+        moving a shard between pools (see `cutout.router`).  Only the
+        databases this node is the master for are listed, so that each
+        database is listed by just one node.
+
+        Accepts a JSON body with the keys:
+
+        `other`: list of all nodes in this node's pool
+        `name`: the name of this node
+        `shards`: the total number of shards
+        `shard`: the shard being queried
+        `backups`: the number of backups kept in the pool
+
+        Returns JSON like ``/query-deprecate``::
+
+            {"databases": [{"path": ..., "domain": ..., "username": ..., "bucket": ...}]}
+        """
+        self.assert_is_internal(req)
+        data = req.json
+        ring = HashRing(data['other'])
+        databases = []
+        for domain, username, bucket in self.storage.all_dbs():
+            if shard_number(domain, username, data['shards']) != data['shard']:
+                continue
+            path = '/' + domain + '/' + username + bucket
+            if iter(ring.iterate_nodes(path)).next() != data['name']:
+                continue
+            databases.append(
+                {'path': path, 'domain': domain, 'username': username, 'bucket': bucket})
+        return Response(json={'databases': databases})
+
     def apply_backup(self, req, db):
         """Responds to ``POST /db-name?backup-from-pos=N``
 
@@ -972,20 +2081,26 @@ class Application(object):
         self.assert_is_internal(req)
         backup_pos = int(req.GET['backup-from-pos'])
         source = req.GET['source']
-        collection_id = req.GET['collection_id']
+        collection_id = str(req.GET['collection_id'])
         if collection_id != db.collection_id:
             if db.empty:
                 db.set_collection_id(collection_id)
             else:
                 dir, timer = db.dir, db.timer
                 db.clear()
-                db = Storage(dir, timer)
-        items = req.json
-        datas = [
-            (backup_pos + index + 1, json.dumps(item))
-            for index, item in enumerate(items)]
+                db = Storage(dir, timer, durability=db.durability, engine=db.engine,
+                             object_index=db.object_index, compress=db.compress,
+                             heads=db.heads, tail_cache=db.tail_cache)
+                db.set_collection_id(collection_id)
+        times = timing.timings(req.environ)
+        with times.phase('parse'):
+            datas = [
+                (backup_pos + index + 1, encoded)
+                for index, (item, encoded) in enumerate(self.read_items(req))]
         try:
-            db.db.extend(datas, expect_last_counter=backup_pos, with_counters=True)
+            with times.phase('extend'):
+                db.extend(datas, expect_last_counter=backup_pos, with_counters=True)
+            self.poll_hints.note_change(db.dir)
         except ExpectationFailed:
             # The canonical server is ahead of us, we must catch up!
             has_queue = db.has_queue
@@ -995,10 +2110,11 @@ class Application(object):
                 ## FIXME: we should really try to extend the
             else:
                 # We need to catch up
+                backup_catchups.inc()
                 catchup_req = Request.blank(source)
                 catchup_req.GET['copy'] = ''
                 catchup_req.GET['until'] = backup_pos
-                catchup_req.environ['cutout.root'] = req.environ.get('cutout.root')
+                inherit(catchup_req, req, 'catchup')
                 resp = forward(catchup_req)
                 assert resp.status_code == 200, str(resp)
                 fp = StringIO(resp.body)
@@ -1053,7 +2169,7 @@ class Application(object):
             db = self.storage.for_user(domain, username, bucket)
             send = Request.blank(replacement_node + urllib.quote(path) + '?paste',
                                  method='POST', body=''.join(db.encode_db()))
-            send.environ['cutout.root'] = req.environ.get('cutout.root')
+            inherit(send, req, 'paste')
             resp = forward(send)
             assert resp.status_code == 201, str(resp)
             #status.write('  nodes: %r - %r / %r\n' % (active_nodes, bad_node, self_name))
@@ -1061,6 +2177,44 @@ class Application(object):
         return status
 
 
+_whitespace_re = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+
+def split_items(body):
+    """Parses a JSON array of objects, returning a list of ``(item,
+    encoded)`` where `encoded` is the item's own text from `body`, so
+    it can be stored without encoding it again.
+
+    Each item must be an object with an ``id``; raises ValueError
+    otherwise, or if `body` is not a JSON array."""
+    skip = _whitespace_re.match
+    pos = skip(body, 0).end()
+    if body[pos:pos + 1] != '[':
+        raise ValueError('Expected a JSON array')
+    pos = skip(body, pos + 1).end()
+    result = []
+    if body[pos:pos + 1] == ']':
+        pos += 1
+    else:
+        while 1:
+            item, end = _decoder.raw_decode(body, pos)
+            if not isinstance(item, dict) or not isinstance(item.get('id'), basestring):
+                raise ValueError('Item %i is not an object with an id' % len(result))
+            result.append((item, body[pos:end]))
+            pos = skip(body, end).end()
+            char = body[pos:pos + 1]
+            pos += 1
+            if char == ']':
+                break
+            if char != ',':
+                raise ValueError('Expected , or ] at character %i' % (pos - 1))
+            pos = skip(body, pos).end()
+    if skip(body, pos).end() != len(body):
+        raise ValueError('Extra data after the array')
+    return result
+
+
 def b64_encode(s):
     """Compact/url-safe base64 encoding"""
     import base64
@@ -1082,6 +2236,15 @@ def sign(secret, text):
     return b64_encode(hmac.new(secret, text, hashlib.sha1).digest())
 
 
+def shard_number(domain, username, shards):
+    """Returns the shard (an integer below `shards`) that a user's
+    databases belong to.  This must never change for a given number of
+    shards, as the shard table depends on it."""
+    import hashlib
+    digest = hashlib.md5(domain + '/' + username).digest()
+    return int_encoding.unpack(digest[:4])[0] % shards
+
+
 def open_create(filename):
     """Opens the file, but we must be the one that created the file"""
     fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_EXCL)
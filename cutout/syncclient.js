@@ -169,12 +169,13 @@ Sync.Service = function (server, appData, storage) {
   }
   this.storage = storage || new Sync.LocalStorage('sync::');
   this.storage.get(
-    ['lastSyncTime', 'lastSyncPut', 'lastSyncCollectionId', 'syncPosition'],
+    ['lastSyncTime', 'lastSyncPut', 'lastSyncCollectionId', 'syncPosition', 'syncEtag'],
     (function (values) {
       this._lastSyncTime = values.lastSyncTime ? parseFloat(values.lastSyncTime) : null;
       this._lastSyncPut = values.lastSyncPut ? parseFloat(values.lastSyncPut) : null;
       this._lastSyncCollectionId = values.lastSyncCollectionId || null;
       this._syncPosition = values.syncPosition || 0;
+      this._syncEtag = values.syncEtag || null;
     }).bind(this)
   );
   // This will get set if the server tells us to back off on polling:
@@ -203,11 +204,13 @@ Sync.Service.prototype = {
       lastSyncTime: null,
       lastSyncPut: null,
       lastSyncCollectionId: null,
-      syncPosition: null
+      syncPosition: null,
+      syncEtag: null
     }, done);
     this._lastSyncTime = null;
     this._lastSyncPut = null;
     this._syncPosition = 0;
+    this._syncEtag = null;
     if (steps === 0) {
       this.sendStatus({status: 'reset'});
       return Sync.finish(callback);
@@ -265,9 +268,19 @@ Sync.Service.prototype = {
     this.storage.put('lastSyncTime', this._lastSyncTime);
   },
 
+  /* Any change of position (except by a complete GET, which then sets
+     the ETag) means we no longer have exactly what the ETag describes */
   _setSyncPosition: function (position) {
     this._syncPosition = position;
     this.storage.put('syncPosition', position);
+    this._setSyncEtag(null);
+  },
+
+  /* The ETag of the last complete GET, sent back as If-None-Match so
+     the server can answer 304 if nothing has changed */
+  _setSyncEtag: function (etag) {
+    this._syncEtag = etag || null;
+    this.storage.put('syncEtag', this._syncEtag);
   },
 
   _setLastSyncPut: function (timestamp) {
@@ -370,6 +383,10 @@ Sync.Service.prototype = {
         this.sendStatus({error: 'server_get', detail: error});
         return Sync.finish(callback, error);
       }
+      if (results.not_modified) {
+        this._setLastSyncTime(Date.now());
+        return Sync.finish(callback);
+      }
       if (! this.confirmCollectionId(results.collection_id)) {
         // FIXME: should accept the new results
         this.reset();
@@ -379,12 +396,12 @@ Sync.Service.prototype = {
         return Sync.finish(callback, error);
       }
       this._processUpdates(results, callback);
-    }).bind(this));
+    }).bind(this), this._syncEtag);
   },
 
   _processUpdates: function (results, callback) {
     if (results.objects.length) {
-      var newPosition = results.until || results.objects[results.objects.length-1][0];
+      var newPosition = results.next_since || results.until || results.objects[results.objects.length-1][0];
       var received = [];
       var seen = {};
       for (var i=results.objects.length-1; i>=0; i--) {
@@ -411,12 +428,23 @@ Sync.Service.prototype = {
           this._getUpdates(callback);
           return;
         }
+        this._setSyncEtag(results.etag);
       }
       if (error) {
         return Sync.finish(callback, error);
       }
     } else {
+      if (results.next_since) {
+        // Everything in this batch was filtered out, but there is more
+        this._setSyncPosition(results.next_since);
+      }
       this._setLastSyncTime(Date.now());
+      if (results.incomplete) {
+        log('Refetching next batch');
+        this._getUpdates(callback);
+        return;
+      }
+      this._setSyncEtag(results.etag);
     }
     return Sync.finish(callback);
   },
@@ -664,33 +692,41 @@ Sync.Server = function (baseUrl, bucketName, authenticator) {
   this._loginStatus = null;
   // This is a header sent with all requests (after login):
   this.authData = null;
-  /* This is a callback for anytime a Retry-After or X-Sync-Poll-Time
-     header is set, or when there is a 5xx error (all cases when the
-     client should back off)
+  /* This is a callback for anytime a Retry-After header is set, or
+     when there is a 5xx error (all cases when the client should back
+     off)
 
-     Gets as its argument an object with .retryAfter (if that or
-     X-Sync-Poll-Time is set), a value in seconds, and a .status
-     attribute (integer response code).
+     Gets as its argument an object with .retryAfter (if that is set),
+     a value in seconds, and a .status attribute (integer response
+     code).
   */
   this.onretryafter = null;
+  /* This is a callback for anytime a successful (or 304) response has an
+     X-Sync-Poll-Time header: how often the server would like to be
+     polled, given its load and how active the bucket is.  Gets the
+     value in seconds. */
+  this.onpolltime = null;
   /* This is a callback whenever there is a 401 error */
   this.onautherror = null;
 };
 
 Sync.Server.prototype = {
 
-  /* Checks a request for Retry-After or X-Sync-Poll headers, and calls
-     onretryafter.  This should be called for every request, including
-     unsuccessful requests */
+  /* Checks a request for Retry-After or X-Sync-Poll-Time headers, and
+     calls onretryafter or onpolltime.  This should be called for every
+     request, including unsuccessful requests */
   checkRetryRequest: function (req) {
+    if (this.onpolltime && ((req.status >= 200 && req.status < 300) || req.status == 304)) {
+      var pollTime = parseInt(req.getResponseHeader('X-Sync-Poll-Time'), 10);
+      if (this.isSaneRetryAfter(pollTime)) {
+        this.onpolltime(pollTime);
+      }
+    }
     if (! this.onretryafter) {
       // No one cares, so we don't need to check anything
       return;
     }
     var retryAfter = req.getResponseHeader('Retry-After');
-    if (! retryAfter) {
-      retryAfter = req.getResponseHeader('X-Sync-Poll-Time');
-    }
     if (retryAfter) {
       var val = parseInt(retryAfter, 10);
       if (isNaN(val)) {
@@ -748,8 +784,10 @@ Sync.Server.prototype = {
   },
 
   /* Does a GET request on the server, getting all updates since the
-     given timestamp */
-  get: function (since, callback) {
+     given timestamp.  If etag (from the .etag of an earlier result)
+     is given and nothing has changed, the result is just
+     {objects: [], not_modified: true} */
+  get: function (since, callback, etag) {
     if (since === null) {
       since = 0;
     }
@@ -769,11 +807,17 @@ Sync.Server.prototype = {
       url += '&collection_id=' + encodeURIComponent(this._lastSyncCollectionId);
     }
     var req = this._createRequest('GET', url);
+    if (etag) {
+      req.setRequestHeader('If-None-Match', etag);
+    }
     req.onreadystatechange = (function () {
       if (req.readyState != 4) {
         return;
       }
       this.checkRequest(req);
+      if (req.status == 304) {
+        return callback(null, {objects: [], not_modified: true, etag: etag});
+      }
       if (req.status != 200) {
         return Sync.finish(callback, {error: "Non-200 response code", code: req.status, url: url, request: req, text: req.responseText});
       }
@@ -783,6 +827,7 @@ Sync.Server.prototype = {
       } catch (e) {
         return Sync.finish(callback, {error: "invalid_json", exception: e, data: req.responseText});
       }
+      data.etag = req.getResponseHeader('ETag');
       if (data.collection_deleted) {
         callback(data, null);
       } else {
@@ -877,6 +922,9 @@ Sync.Scheduler = function (service, authenticator) {
     }).bind(this)
   });
   this._timeoutId = null;
+  // The period the server asked for with X-Sync-Poll-Time (in place
+  // of settings.normalPeriod), if it has:
+  this._serverPeriod = null;
   this._period = this.settings.normalPeriod;
   // This is an amount to be added to the *next* request period,
   // but not repeated after:
@@ -889,6 +937,9 @@ Sync.Scheduler = function (service, authenticator) {
     this.retryAfter(value);
     this.schedule();
   }).bind(this);
+  this.service.server.onpolltime = (function (seconds) {
+    this.serverPeriod(seconds);
+  }).bind(this);
   this.adjustForVisibility();
 };
 
@@ -906,7 +957,10 @@ Sync.Scheduler.prototype = {
     normalPeriod: 5*60000, // 5 minutes
     // When the repo is updated we sync within this amount of time
     // (this allows quick successive updates to be batched):
-    immediateUpdateDelay: 500 // .5 seconds
+    immediateUpdateDelay: 500, // .5 seconds
+    // Each wait is randomly made up to this fraction longer or
+    // shorter, so clients given the same times don't sync in step:
+    jitter: 0.2
   },
 
   /* Called when we should start regularly syncing (generally after
@@ -927,12 +981,31 @@ Sync.Scheduler.prototype = {
     }
   },
 
-  /* Resets the schedule to the normal pacing, undoing any adjustments */
+  /* Resets the schedule to the normal pacing (or what the server asked
+     for), undoing any adjustments */
   resetSchedule: function () {
-    this._period = this.settings.normalPeriod;
+    this._period = this._serverPeriod || this.settings.normalPeriod;
     this._periodAddition = 0;
   },
 
+  /* Called when the server says how often it should be polled (in
+     seconds); this is used in place of normalPeriod until the server
+     says otherwise */
+  serverPeriod: function (seconds) {
+    var period = seconds * 1000;
+    if (period < this.settings.minPeriod) {
+      period = this.settings.minPeriod;
+    } else if (period > this.settings.maxPeriod) {
+      period = this.settings.maxPeriod;
+    }
+    this._serverPeriod = period;
+  },
+
+  /* Adds up to settings.jitter (either way) to the given wait */
+  _jitter: function (delay) {
+    return Math.max(0, Math.round(delay * (1 + this.settings.jitter * (2 * Math.random() - 1))));
+  },
+
   /* Schedules the next sync job, using this._period and this._periodAddition */
   schedule: function () {
     if (this._timeoutId) {
@@ -960,7 +1033,7 @@ Sync.Scheduler.prototype = {
         }
         this.schedule();
       }
-    }).bind(this), this._period + this._periodAddition);
+    }).bind(this), this._jitter(this._period + this._periodAddition));
     this._periodAddition = 0;
   },
 
@@ -1036,7 +1109,7 @@ Sync.Scheduler.prototype = {
       this.scheduleSlowly();
     } else {
       log('Scheduling immediately due to tab becoming visible');
-      this._period = this.settings.normalPeriod;
+      this._period = this._serverPeriod || this.settings.normalPeriod;
       this.scheduleImmediately();
     }
   }
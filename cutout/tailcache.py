@@ -0,0 +1,136 @@
+"""An in-memory cache of the most recent records of active databases
+
+All of a user's devices poll the same bucket, and mostly ask for the
+same few recent records.  `TailCache` keeps the last
+`TailCache.records_per_db` records of each database, already
+formatted as the ``[count,json]`` fragments of a GET response, so
+those GETs don't read the database at all.
+
+A `Tail` holds every record with a counter above its `floor`, up to
+its `last`.  Tails are filled by `cutout.sync.Storage.extend` (when
+the new records follow on from the tail) and by GETs that read to the
+end of the database, and dropped when the database is replaced or
+compacted.
+
+The cache is per process, so it can't see writes made by other
+processes.  Before a tail is used it is checked against the
+database's `cutout.heads.Head`, which all processes keep up to date:
+it is only used if the head is known, of the same generation, and
+has the same last counter.
+
+Tails are evicted least recently used first, to keep all of them
+within `TailCache.max_bytes`.
+"""
+import threading
+from collections import OrderedDict
+
+
+class Tail(object):
+
+    def __init__(self, generation, floor):
+        self.generation = generation
+        self.floor = floor
+        self.last = floor
+        ## [(count, fragment)]
+        self.records = []
+        self.bytes = 0
+
+    def add(self, records, keep):
+        """Adds ``[(count, data)]`` (which must follow `last`), keeping
+        only the last `keep` records"""
+        for count, data in records:
+            fragment = '[%i,%s]' % (count, data)
+            self.records.append((count, fragment))
+            self.bytes += len(fragment)
+            self.last = count
+        if len(self.records) > keep:
+            removed = self.records[:-keep]
+            del self.records[:-keep]
+            self.bytes -= sum(len(fragment) for count, fragment in removed)
+            self.floor = removed[-1][0]
+
+
+class TailCache(object):
+
+    def __init__(self, records_per_db=64, max_bytes=16 * 1024 * 1024):
+        self.records_per_db = records_per_db
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._lock = threading.Lock()
+        ## {key: Tail}, least recently used first
+        self._tails = OrderedDict()
+
+    def _put(self, key, tail):
+        old = self._tails.pop(key, None)
+        if old is not None:
+            self.bytes -= old.bytes
+        self._tails[key] = tail
+        self.bytes += tail.bytes
+        while self.bytes > self.max_bytes and self._tails:
+            evicted_key, evicted = self._tails.popitem(last=False)
+            self.bytes -= evicted.bytes
+
+    def extended(self, key, generation, records):
+        """Notes that ``[(count, data)]`` were just added to the
+        database `key` (whose head had the given generation)"""
+        if not records:
+            return
+        with self._lock:
+            tail = self._tails.get(key)
+            ## The record before the first new one is its count - 1:
+            previous = records[0][0] - 1
+            if tail is None or tail.generation != generation or tail.last != previous:
+                tail = Tail(generation, previous)
+            else:
+                self.bytes -= tail.bytes
+                del self._tails[key]
+            tail.add(records, self.records_per_db)
+            self._put(key, tail)
+
+    def read_all(self, key, generation, since, records):
+        """Notes that ``[(count, data)]`` are all the records of the
+        database `key` after `since`"""
+        with self._lock:
+            tail = Tail(generation, since)
+            tail.add(records, self.records_per_db)
+            self._put(key, tail)
+
+    def get(self, key, head, since, max_bytes=None, limit=None):
+        """Returns ``([(count, fragment)], complete)`` for the records
+        after `since`, stopping (like `cutout.Database.read`) before
+        their data would add up to more than `max_bytes` or there are
+        more than `limit`; or None if they aren't all cached, or the
+        tail doesn't match `head` (a `cutout.heads.Head`)"""
+        if head is None or not head.known:
+            return None
+        with self._lock:
+            tail = self._tails.get(key)
+            if (tail is None or tail.generation != head.generation
+                or tail.last != head.counter or since < tail.floor):
+                return None
+            self._tails[key] = self._tails.pop(key)
+            records = list(tail.records)
+        result = []
+        total = 0
+        for count, fragment in records:
+            if count <= since:
+                continue
+            if limit and len(result) >= limit:
+                return result, False
+            ## The data is the fragment less the count and brackets:
+            total += len(fragment) - len(str(count)) - 3
+            if max_bytes is not None and total > max_bytes and result:
+                return result, False
+            result.append((count, fragment))
+        return result, True
+
+    def invalidate(self, key):
+        with self._lock:
+            tail = self._tails.pop(key, None)
+            if tail is not None:
+                self.bytes -= tail.bytes
+
+    def clear(self):
+        with self._lock:
+            self._tails.clear()
+            self.bytes = 0
@@ -1 +1,19 @@
+"""Helpers shared by the tests"""
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from webob.dec import wsgify
 
+
+@wsgify.middleware
+def set_remote_user(req, app, username):
+    """Makes requests to `app` look authenticated as `username`"""
+    req.environ['REMOTE_USER'] = username
+    return app
+
+
+def item(id, **kw):
+    """The JSON of an object with the given id (and other keys)"""
+    kw['id'] = id
+    return json.dumps(kw)
@@ -0,0 +1,115 @@
+"""Load test for cutout.evserver
+
+Starts the sync application under the event-loop server, opens many
+idle keep-alive connections (like mobile clients between polls), and
+then runs concurrent clients doing GETs and POSTs against their own
+buckets, reporting throughput and latency.
+
+    python cutout/tests/evserver_load.py --idle 2000 --clients 50
+"""
+import os
+import sys
+import time
+import simplejson as json
+import shutil
+import socket
+import httplib
+import tempfile
+import threading
+import optparse
+from webob.dec import wsgify
+from cutout.sync import Application
+from cutout.evserver import Server
+
+parser = optparse.OptionParser(usage='%prog [OPTIONS]')
+parser.add_option('--idle', type='int', default=1000,
+                  help='Idle connections to hold open (default: %default)')
+parser.add_option('--clients', type='int', default=20,
+                  help='Concurrent active clients (default: %default)')
+parser.add_option('--requests', type='int', default=200,
+                  help='Requests per active client (default: %default)')
+parser.add_option('--threads', type='int', default=10,
+                  help='Server worker threads (default: %default)')
+parser.add_option('--size', type='int', default=500,
+                  help='Size of each posted item (default: %default)')
+
+
+@wsgify.middleware
+def remote_user(req, app):
+    req.environ['REMOTE_USER'] = req.headers.get('X-Remote-User')
+    return app
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def client(server, num, options, latencies, errors):
+    user = 'user%i@example.com' % num
+    headers = {'X-Remote-User': user + '/example.com'}
+    url = '/example.com/%s/bucket' % user
+    conn = httplib.HTTPConnection(server.host, server.port, timeout=60)
+    since = 0
+    item = json.dumps([{'id': 'x', 'data': 'x' * options.size}])
+    for i in xrange(options.requests):
+        start = time.time()
+        if i % 5:
+            conn.request('GET', url + '?since=%i' % since, headers=headers)
+        else:
+            conn.request('POST', url + '?since=%i' % since, body=item, headers=headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        latencies.append(time.time() - start)
+        if resp.status != 200:
+            errors.append(resp.status)
+            continue
+        data = json.loads(body)
+        if data.get('object_counters'):
+            since = data['object_counters'][-1]
+        elif data.get('objects'):
+            since = data['objects'][-1][0]
+    conn.close()
+
+
+def main():
+    options, args = parser.parse_args()
+    dir = tempfile.mkdtemp()
+    app = remote_user(Application(dir=dir))
+    server = Server(app, port=0, threads=options.threads,
+                    max_connections=options.idle + options.clients + 100)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    idle = []
+    try:
+        for i in xrange(options.idle):
+            idle.append(socket.create_connection((server.host, server.port)))
+        print 'Holding %i idle connections' % len(idle)
+        latencies = []
+        errors = []
+        threads = [threading.Thread(target=client, args=(server, i, options, latencies, errors))
+                   for i in xrange(options.clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total = time.time() - start
+        print '%i requests in %.1f seconds (%i/second), %i errors' % (
+            len(latencies), total, len(latencies) / total, len(errors))
+        for pct in 50, 95, 99:
+            print '  p%i: %.1fms' % (pct, percentile(latencies, pct) * 1000)
+        if errors:
+            sys.exit(1)
+    finally:
+        for sock in idle:
+            sock.close()
+        server.shutdown()
+        server_thread.join()
+        shutil.rmtree(dir)
+
+
+if __name__ == '__main__':
+    main()
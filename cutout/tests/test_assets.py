@@ -0,0 +1,87 @@
+import os
+import gzip
+import shutil
+import tempfile
+from cStringIO import StringIO
+from unittest2 import TestCase
+from webob import Request
+from cutout.assets import ScriptAsset, minify
+from cutout.sync import Application, render_syncclient
+
+
+class TestScriptAsset(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'script.js')
+        self.write('// comment\nSync.baseUrl = null;\n\nfunction f() {\n  return 1;\n}\n')
+        self.asset = ScriptAsset(self.filename, render_syncclient)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.filename, 'wb') as fp:
+            fp.write(content)
+
+    def get(self, query='', base_url='http://a.example.com', **headers):
+        req = Request.blank('/syncclient.js' + query, headers=headers)
+        return self.asset.response(req, base_url)
+
+    def test_variants(self):
+        resp = self.get()
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue("Sync.baseUrl = 'http://a.example.com';" in resp.body)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        other = self.get(base_url='http://b.example.com')
+        self.assertTrue("'http://b.example.com'" in other.body)
+        self.assertNotEqual(resp.etag, other.etag)
+        ## Both are kept:
+        self.assertTrue(self.asset.variant('http://a.example.com') is
+                        self.asset.variant('http://a.example.com'))
+        self.assertEqual(len(self.asset._variants), 2)
+        self.asset.max_variants = 1
+        self.get(base_url='http://c.example.com')
+        self.assertEqual(self.asset._variants.keys(), ['http://c.example.com'])
+
+    def test_caching(self):
+        resp = self.get(**{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        body = gzip.GzipFile(fileobj=StringIO(resp.body)).read()
+        self.assertEqual(body, self.get().body)
+        not_modified = self.get(**{'Accept-Encoding': 'gzip', 'If-None-Match': '"%s"' % resp.etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.body, '')
+        ## The plain version has a different ETag:
+        self.assertEqual(self.get(**{'If-None-Match': '"%s"' % resp.etag}).status_code, 200)
+        version = self.asset.current_version()
+        resp = self.get('?v=' + version)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000')
+        self.assertEqual(self.get('?v=old').headers['Cache-Control'], 'no-cache')
+
+    def test_changes(self):
+        old_version = self.asset.current_version()
+        self.write('Sync.baseUrl = null; var changed = true;\n')
+        ## Not checked again so soon:
+        self.assertFalse('changed' in self.get().body)
+        self.asset._checked = 0
+        os.utime(self.filename, (1, 1))
+        self.assertTrue('changed' in self.get().body)
+        self.assertNotEqual(self.asset.current_version(), old_version)
+
+    def test_minify(self):
+        self.assertEqual(minify('// comment\nvar a = "// not";\n\n  if (a) {\n    b();  // c\n  }\n'),
+                         'var a = "// not";\nif (a) {\nb();  // c\n}\n')
+
+    def test_application(self):
+        app = Application(dir=self.dir, include_syncclient=True, minify_syncclient=True)
+        resp = Request.blank('/syncclient.js?v=%s' % app.syncclient_version,
+                             base_url='http://localhost/sync',
+                             headers={'Accept-Encoding': 'gzip'}).send(app)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/javascript')
+        body = gzip.GzipFile(fileobj=StringIO(resp.body)).read()
+        self.assertTrue("Sync.baseUrl = 'http://localhost/sync'" in body)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000')
+        self.assertTrue(len(body) < os.path.getsize(app._syncclient.filename))
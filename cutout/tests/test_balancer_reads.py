@@ -0,0 +1,101 @@
+import os
+import shutil
+import threading
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout.balancer import Application, PositionCache
+from cutout.forwarder import rooted
+from cutout.tests import set_remote_user
+
+here = os.path.dirname(os.path.abspath(__file__))
+test_dir = os.path.join(here, 'test-balancer-dbs')
+
+
+class TestBackupReads(TestCase):
+
+    def setUp(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        self.balancer = Application(preload=3, preload_dir=test_dir,
+                                    backups=1, read_backups=True)
+        self.app = set_remote_user(rooted(self.balancer), username='a@b/c')
+
+    def tearDown(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+
+    def send(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def test_reads_from_current_backup(self):
+        master, backup = self.balancer.node_list('/c/a@b/x')
+        # Nothing is known about the database yet, so the master answers:
+        resp = self.send('/c/a@b/x')
+        self.assertEqual(resp.headers['X-Node-Name'], master)
+        resp = self.send('/c/a@b/x', method='POST', body=json.dumps([dict(id='1')]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.balancer.positions.get('/c/a@b/x').position, 1)
+        # The backup hasn't received the item:
+        self.balancer.latency.averages[master] = 10
+        resp = self.send('/c/a@b/x')
+        self.assertEqual(resp.headers['X-Node-Name'], master)
+        collection_id = self.balancer.positions.get('/c/a@b/x').collection_id
+        self.assertTrue(collection_id)
+        self.backup_db(backup).set_collection_id(collection_id)
+        self.send('/%s/c/a@b/x' % backup, method='POST', body=json.dumps([dict(id='1')]))
+        resp = self.send('/c/a@b/x')
+        self.assertEqual(resp.headers['X-Node-Name'], backup)
+        self.assertEqual(resp.json['objects'], [[1, {'id': '1'}]])
+        # A client that has seen more than the backup has goes to the master:
+        self.send('/%s/c/a@b/x?since=1' % master, method='POST', body=json.dumps([dict(id='2')]))
+        resp = self.send('/c/a@b/x?since=2')
+        self.assertEqual(resp.headers['X-Node-Name'], master)
+
+    def backup_db(self, node, bucket='/x'):
+        return self.balancer.subnodes[node].storage.for_user('c', 'a@b', bucket)
+
+    def test_reset(self):
+        master, backup = self.balancer.node_list('/c/a@b/x')
+        self.balancer.latency.averages[master] = 10
+        self.send('/c/a@b/x', method='POST', body=json.dumps([dict(id='1'), dict(id='2')]))
+        self.backup_db(backup).set_collection_id(self.backup_db(master).collection_id)
+        self.send('/%s/c/a@b/x' % backup, method='POST', body=json.dumps([dict(id='1'), dict(id='2')]))
+        self.assertEqual(self.send('/c/a@b/x').headers['X-Node-Name'], backup)
+        ## The master's copy is reset, and written to again:
+        self.backup_db(master).clear()
+        self.send('/c/a@b/x', method='POST', body=json.dumps([dict(id='3')]))
+        self.assertEqual(self.balancer.positions.get('/c/a@b/x').position, 1)
+        self.assertEqual(self.balancer.replica_positions.get((backup, '/c/a@b/x')), None)
+        ## The backup still has the old database, at a later position:
+        resp = self.send('/c/a@b/x')
+        self.assertEqual(resp.headers['X-Node-Name'], master)
+        self.assertEqual(resp.json['objects'], [[1, {'id': '3'}]])
+
+    def test_position_cache(self):
+        now = [0]
+        cache = PositionCache(2, 10, timer=lambda: now[0])
+        cache.note('a', 1)
+        cache.note('b', 2, 'x')
+        self.assertEqual(cache.get('a').position, 1)
+        ## The least recently used is dropped:
+        cache.note('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+        now[0] = 11
+        self.assertEqual(cache.get('a'), None)
+
+    def test_hedged(self):
+        self.balancer.hedge_after = 0
+        master, backup = self.balancer.node_list('/c/a@b/x')
+        for node in master, backup:
+            self.send('/%s/c/a@b/x' % node, method='POST', body=json.dumps([dict(id='1')]))
+        self.balancer.positions.note('/c/a@b/x', 1)
+        resp = self.send('/c/a@b/x')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['X-Node-Name'] in (master, backup))
+        # Let the losing request finish before cleaning up:
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+        self.assertTrue(self.balancer.latency.get(backup) is not None)
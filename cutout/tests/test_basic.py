@@ -3,7 +3,12 @@ import re
 import random
 import time
 import struct
-from cutout import Database
+import shutil
+import tempfile
+import threading
+from itertools import islice
+import cutout
+from cutout import Database, ExpectationFailed
 from unittest2 import TestCase
 
 tmp_filename = '/tmp/test.db'
@@ -50,6 +55,8 @@ class TestBasic(TestCase):
         self.assertEqual(list(db.read(last + 9)), [])
         all = list(db.read(0))
         self.assertEqual(list(all[:6]), [(1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6')])
+        self.assertEqual(list(db.read(0, max_bytes=2)), [(1, '1'), (2, '2')])
+        self.assertEqual(list(db.read(last + 8, max_bytes=0)), [(10006, 'x' * 999)])
         READ_COUNT = 100
         for i in xrange(READ_COUNT):
             pos = random.randint(1, last)
@@ -78,6 +85,163 @@ class TestBasic(TestCase):
         self.assertEqual(list(db.read(db.length() - 1, db.length() + 100)), [(202, '100')])
         self.assertEqual(list(db.read(db.length(), db.length() + 100)), [])
 
+    def test_sparse(self):
+        db = create_db()
+        db.extend([(count, str(count)) for count in range(2, 2000, 7)], with_counters=True)
+        counts = range(2, 2000, 7)
+        for above in range(0, 2010, 3):
+            expected = [count for count in counts if count > above][:2]
+            self.assertEqual([count for count, data in islice(db.read(above), 2)], expected)
+
+
+class TestDurability(TestCase):
+
+    def setUp(self):
+        create_db().close()
+        self.syncs = []
+        self._fdatasync = cutout.fdatasync
+
+        def fdatasync(fd):
+            self.syncs.append(fd)
+            ## Give other writers a chance to pile up:
+            time.sleep(0.001)
+            return self._fdatasync(fd)
+        cutout.fdatasync = fdatasync
+
+    def tearDown(self):
+        cutout.fdatasync = self._fdatasync
+
+    def write_concurrently(self, durability, writers=8, reps=20):
+        def writer(num):
+            db = Database(tmp_filename, durability=durability)
+            for i in xrange(reps):
+                db.extend(['%i-%i' % (num, i)] * 3)
+            db.close()
+        threads = [threading.Thread(target=writer, args=(num,)) for num in xrange(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db = Database(tmp_filename)
+        items = list(db.read(0))
+        self.assertEqual([count for count, data in items], range(1, writers * reps * 3 + 1))
+        ## Each extend stays together:
+        for i in xrange(0, len(items), 3):
+            self.assertEqual(len(set(data for count, data in items[i:i + 3])), 1)
+        return writers * reps
+
+    def test_modes(self):
+        self.assertRaises(ValueError, Database, tmp_filename, durability='sometimes')
+        self.write_concurrently('none')
+        self.assertEqual(self.syncs, [])
+        create_db().close()
+        extends = self.write_concurrently('batch')
+        self.assertEqual(len(self.syncs), extends * 2)
+
+    def test_group_commit(self):
+        extends = self.write_concurrently('group')
+        self.assertTrue(len(self.syncs) < extends * 2, len(self.syncs))
+        self.assertEqual(len(self.syncs) % 2, 0)
+
+    def test_group_expectations(self):
+        db = Database(tmp_filename, durability='group')
+        self.assertEqual(db.extend(['a', 'b']), 1)
+        self.assertRaises(ExpectationFailed, db.extend, ['c'], expect_last_counter=1)
+        self.assertEqual(db.extend(['c'], expect_last_counter=2), 3)
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (2, 'b'), (3, 'c')])
+
+
+class TestRecover(TestCase):
+
+    def test_clean(self):
+        db = create_db()
+        self.assertEqual(db.recover(), (0, 0))
+        db.extend(['a', 'bb', 'ccc'])
+        self.assertEqual(db.recover(), (0, 0))
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (2, 'bb'), (3, 'ccc')])
+
+    def test_torn_tail(self):
+        db = create_db()
+        db.extend(['a', 'bb', 'ccc'])
+        db.close()
+        ## A partial index record, and the last record's data cut short:
+        with open(tmp_filename + '.index', 'ab') as fp:
+            fp.write('\x05\x00\x00')
+        with open(tmp_filename, 'r+b') as fp:
+            fp.truncate(4)
+        db = Database(tmp_filename, recover=True)
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (2, 'bb')])
+        self.assertEqual(os.path.getsize(tmp_filename + '.index'), 36)
+        self.assertEqual(os.path.getsize(tmp_filename), 3)
+        self.assertEqual(db.recover(), (0, 0))
+        self.assertEqual(db.extend(['dddd']), 3)
+        self.assertEqual(list(db.read(2)), [(3, 'dddd')])
+
+    def test_unindexed_data(self):
+        db = create_db()
+        db.extend(['a'])
+        db.data_fp.write('partial')
+        db.data_fp.flush()
+        self.assertEqual(db.recover(), (0, 7))
+        self.assertEqual(db.extend(['b']), 2)
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (2, 'b')])
+
+    def test_empty_index(self):
+        db = create_db()
+        db.extend(['a'])
+        db.close()
+        with open(tmp_filename + '.index', 'r+b') as fp:
+            fp.truncate(5)
+        ## Repaired as it is opened:
+        db = Database(tmp_filename)
+        self.assertEqual(db.recovered, (1, 1))
+        self.assertEqual(db.recover(), (0, 0))
+        self.assertEqual(db.length(), 0)
+        self.assertEqual(db.extend(['b']), 1)
+
+    def test_open_torn(self):
+        ## As left by a worker that crashed, for the next one to open:
+        db = create_db()
+        db.extend(['a', 'bb'])
+        db.close()
+        with open(tmp_filename + '.index', 'ab') as fp:
+            fp.write(struct.pack('<III', 3, 3, 3)[:7])
+        db = Database(tmp_filename)
+        self.assertEqual(db.recovered, (1, 0))
+        self.assertEqual(db.extend(['ccc']), 3)
+        db.close()
+        with open(tmp_filename + '.index', 'ab') as fp:
+            fp.write(struct.pack('<III', 4, 6, 4))
+        db = Database(tmp_filename)
+        self.assertEqual(db.recovered, (1, 0))
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (2, 'bb'), (3, 'ccc')])
+        ## A clean database isn't changed:
+        db.close()
+        self.assertEqual(Database(tmp_filename).recovered, (0, 0))
+
+    def test_user_storage(self):
+        from cutout.sync import UserStorage
+        dir = tempfile.mkdtemp()
+        try:
+            storage = UserStorage(dir)
+            self.assertFalse(storage.start_running())
+            for bucket, items in ('bucket', ['a', 'b']), ('other', ['c']):
+                user_storage = storage.for_user('example.com', 'user', bucket)
+                user_storage.collection_id
+                db = user_storage.db
+                db.extend(items)
+                db.close()
+            db = storage.for_user('example.com', 'user', 'bucket').db
+            with open(db.index_filename, 'ab') as fp:
+                fp.write(struct.pack('<III', 10, 2, 3))
+            self.assertEqual(storage.recover_all(),
+                             [('example.com', 'user', 'bucket', {'database': (1, 0)})])
+            self.assertEqual(storage.recover_all(), [])
+            storage.mark_clean_shutdown()
+            self.assertTrue(storage.start_running())
+            self.assertFalse(storage.start_running())
+        finally:
+            shutil.rmtree(dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import shutil
+from unittest2 import TestCase
+from cutout.benchmark import Suite, compare
+
+
+class TestBenchmark(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_suite(self):
+        suite = Suite(os.path.join(self.dir, 'bench'), record_sizes=(50,),
+                      db_sizes=(40,), reps=3)
+        summary = suite.run()
+        for engine in 'cutout', 'stream':
+            for case in ('extend', 'read-tail/warm', 'after-gc/read-range/warm',
+                         'gc.collect', 'encode_db', 'decode_db', 'filtered-get/warm'):
+                stats = summary['%s/50b/40/%s' % (engine, case)]
+                self.assertTrue(stats['p50'] <= stats['p95'] <= stats['p99'])
+        for name in 'plain', 'compressed':
+            for case in 'extend', 'read-all/warm':
+                self.assertTrue('compression/40/%s/%s' % (name, case) in summary)
+        ## (too few records here for compression to pay for its dictionary)
+        self.assertEqual(suite.sizes[40]['plain'], suite.sizes[40]['raw'])
+        self.assertTrue(suite.sizes[40]['ratio'] > 0)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'bench')))
+        self.assertEqual(compare(summary, summary), [])
+        slower = dict((name, dict(stats, p50=stats['p50'] * 2 + 1))
+                      for name, stats in summary.items())
+        self.assertEqual(len(compare(slower, summary)), len(summary))
@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+import threading
+import simplejson as json
+from cStringIO import StringIO
+from unittest2 import TestCase
+from cutout import Database, gc, heads
+from cutout import compression
+from cutout.compression import RecordCodec, train_dictionary
+from cutout.objindex import ObjectIndex
+from cutout.sync import UserStorage
+
+
+def item(i, **kw):
+    kw.update(id='item-%i' % i, type='bookmark',
+              url='http://example.com/pages/%i' % i,
+              title='Page number %i' % i, tags=['a', 'b'])
+    return json.dumps(kw)
+
+
+class TestRecordCodec(TestCase):
+
+    def test_round_trip(self):
+        samples = [item(i) for i in range(40)]
+        dictionary = train_dictionary(samples)
+        self.assertTrue(len(dictionary) <= compression.DICTIONARY_SIZE)
+        codec = RecordCodec(dictionary)
+        data = item(1000, deleted=True)
+        compressed = codec.compress(data)
+        self.assertTrue(len(compressed) < len(data) / 2)
+        self.assertEqual(codec.decompress(compressed), data)
+        ## The codec is used again and again:
+        self.assertEqual(codec.decompress(codec.compress(data)), data)
+        ## Records it can't make smaller are left alone:
+        self.assertEqual(codec.compress('{}'), None)
+        self.assertEqual(codec.compress(os.urandom(100)), None)
+
+
+class TestWriteDictionary(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_concurrent(self):
+        filename = os.path.join(self.dir, 'database.dict')
+        codecs = []
+        errors = []
+
+        def write(i):
+            try:
+                codecs.append(compression.write_dictionary(filename, str(i) * 20000))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        ## Every writer uses the dictionary that was kept:
+        with open(filename, 'rb') as fp:
+            kept = fp.read()
+        self.assertEqual(set(codec.dictionary for codec in codecs), set([kept]))
+        self.assertEqual(os.listdir(self.dir), ['database.dict'])
+
+    def test_temp_names(self):
+        ## Each writer has a temporary file of its own:
+        filename = os.path.join(self.dir, 'database.dict')
+        linked = []
+        link = os.link
+
+        def recording_link(source, dest):
+            linked.append(source)
+            return link(source, dest)
+        os.link = recording_link
+        try:
+            compression.write_dictionary(filename, 'a' * 100)
+            compression.write_dictionary(filename, 'b' * 100)
+        finally:
+            os.link = link
+        self.assertEqual(len(set(linked)), 2)
+
+
+class TestCompressedDatabase(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.dir, 'database'), compress=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def test_read(self):
+        ## Not enough records to train a dictionary:
+        self.db.extend([item(i) for i in range(10)])
+        self.assertFalse(os.path.exists(self.db.dictionary_filename))
+        self.db.extend([item(i) for i in range(10, 40)])
+        self.assertTrue(os.path.exists(self.db.dictionary_filename))
+        self.db.extend([item(i) for i in range(40, 50)])
+        self.assertEqual(list(self.db.read(0)),
+                         [(i + 1, item(i)) for i in range(50)])
+        self.assertTrue(os.path.getsize(self.db.data_filename)
+                        < sum(len(item(i)) for i in range(50)) * 0.75)
+        self.assertEqual(list(self.db.read(45, last=47)), [(46, item(45)), (47, item(46))])
+        ## max_bytes counts the records as they are read:
+        self.assertEqual(len(list(self.db.read(40, max_bytes=len(item(40)) * 3))), 3)
+        for count, data, position in self.db.read_with_positions(0):
+            self.assertEqual(self.db.read_at(position, len(data)), data)
+        ## Other databases read the compressed records too:
+        other = Database(self.db.data_filename)
+        self.assertEqual(list(other.read(48)), [(49, item(48)), (50, item(49))])
+        other.close()
+
+    def test_codec_kept(self):
+        self.db.extend([item(i) for i in range(40)])
+        codec_for = compression.codec_for
+        calls = []
+
+        def counting_codec_for(filename):
+            calls.append(filename)
+            return codec_for(filename)
+        compression.codec_for = counting_codec_for
+        try:
+            self.db.extend([item(i) for i in range(40, 50)])
+            self.assertEqual(len(list(self.db.read(0))), 50)
+            self.assertEqual(calls, [])
+            ## Until the files are replaced:
+            tmp = os.path.join(self.dir, 'copy')
+            self.db.copy(set([1]), tmp, tmp + '.index')
+            self.db.overwrite(tmp, tmp + '.index')
+            self.assertEqual(len(list(self.db.read(0))), 49)
+            self.assertEqual(len(calls), 1)
+        finally:
+            compression.codec_for = codec_for
+
+    def test_gc(self):
+        self.db.extend([item(i) for i in range(40)])
+        self.db.extend([item(i, v=2) for i in range(20)])
+        objects = ObjectIndex(os.path.join(self.dir, 'objects.index'))
+        found = objects.get(self.db, 'bookmark', 'item-30')
+        self.assertEqual(found, (31, item(30)))
+        gc.collect(self.db, objects=objects)
+        self.assertEqual(list(self.db.read(0)),
+                         [(i + 1, item(i)) for i in range(20, 40)]
+                         + [(i + 41, item(i, v=2)) for i in range(20)])
+        self.assertEqual(objects.get(self.db, 'bookmark', 'item-5'), (46, item(5, v=2)))
+        objects.close()
+
+
+class TestCopy(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = UserStorage(self.dir, compress=True)
+
+    def tearDown(self):
+        heads._tables.pop(self.storage.heads.filename).close()
+        shutil.rmtree(self.dir)
+
+    def test_encode(self):
+        source = self.storage.for_user('c', 'a@b', '/x')
+        source.db.extend([item(i) for i in range(40)])
+        encoded = ''.join(source.encode_db())
+        self.assertEqual(len(encoded), source.encode_db().length)
+        ## The copy isn't compressed itself, but can read what it was sent:
+        dest = UserStorage(self.dir).for_user('c', 'a@b', '/y')
+        dest.decode_db(StringIO(encoded))
+        self.assertEqual(list(dest.db.read(0)), [(i + 1, item(i)) for i in range(40)])
+        self.assertTrue(os.path.exists(dest.db.dictionary_filename))
+        self.assertRaises(ValueError, UserStorage, self.dir, engine='stream', compress=True)
@@ -0,0 +1,76 @@
+import socket
+import httplib
+import threading
+from unittest2 import TestCase
+from webob.dec import wsgify
+from webob import Response
+from cutout.evserver import Server
+
+
+@wsgify
+def echo_app(req):
+    if req.path_info == '/stream':
+        return Response(app_iter=iter(['a' * 10, 'b' * 10]))
+    return Response('%s %s %s' % (req.method, req.path_info, req.body))
+
+
+class TestServer(TestCase):
+
+    def setUp(self):
+        self.server = Server(echo_app, port=0, threads=2, max_pending=0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def connect(self):
+        return httplib.HTTPConnection(self.server.host, self.server.port, timeout=5)
+
+    def test_keep_alive(self):
+        conn = self.connect()
+        for i in range(3):
+            conn.request('POST', '/x', body='body %s' % i)
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.read(), 'POST /x body %s' % i)
+        conn.request('GET', '/stream')
+        resp = conn.getresponse()
+        self.assertEqual(resp.getheader('transfer-encoding'), 'chunked')
+        self.assertEqual(resp.read(), 'a' * 10 + 'b' * 10)
+        conn.close()
+
+    def test_idle_connections(self):
+        idle = []
+        for i in range(50):
+            sock = socket.create_connection((self.server.host, self.server.port))
+            sock.sendall('GET /partial HTTP/1.1\r\nHost: x\r\n')
+            idle.append(sock)
+        # Idle and half-sent requests don't use up the two worker threads:
+        conn = self.connect()
+        conn.request('GET', '/y')
+        self.assertEqual(conn.getresponse().read(), 'GET /y ')
+        for sock in idle:
+            sock.close()
+
+    def test_slow_upload(self):
+        sock = socket.create_connection((self.server.host, self.server.port))
+        sock.sendall('POST /up HTTP/1.0\r\nContent-Length: 6\r\n\r\nabc')
+        conn = self.connect()
+        conn.request('GET', '/z')
+        self.assertEqual(conn.getresponse().read(), 'GET /z ')
+        sock.sendall('def')
+        data = ''
+        while 1:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertTrue(data.startswith('HTTP/1.1 200 OK'))
+        self.assertTrue(data.endswith('POST /up abcdef'))
+
+    def test_bad_request(self):
+        sock = socket.create_connection((self.server.host, self.server.port))
+        sock.sendall('POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+        self.assertTrue(sock.recv(4096).startswith('HTTP/1.1 411'))
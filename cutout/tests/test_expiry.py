@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+from unittest2 import TestCase
+from cutout import Database, gc, admin
+from cutout.expiry import ExpiryIndex
+from cutout.sync import UserStorage
+from cutout.tests import item
+
+
+class TestExpiryIndex(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.dir, 'database'))
+        self.expiry = ExpiryIndex(os.path.join(self.dir, 'expiry.index'))
+        self.expiry.min_merge = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_expired(self):
+        self.db.extend([item('a'), item('b', expire=30), item('c', expire=10)])
+        self.assertEqual(self.expiry.next_expiry(self.db), 10)
+        self.assertFalse(self.expiry.has_expired(self.db, 10))
+        self.assertTrue(self.expiry.has_expired(self.db, 11))
+        self.assertEqual(self.expiry.expired(self.db, 31), set([2, 3]))
+        ## Added unsorted, then merged in:
+        for i in range(5):
+            self.db.extend([item('d%i' % i, expire=20 - i)])
+            self.expiry.sync(self.db)
+        self.assertEqual(self.expiry.expired(self.db, 18), set([3, 7, 8]))
+        self.assertEqual(self.expiry.next_expiry(self.db), 10)
+
+    def test_collect(self):
+        self.db.extend([item('a', expire=10), item('b'), item('a', v=2, expire=50),
+                        item('c', expire=20)])
+        self.assertEqual(gc.find_to_remove(self.db, expire_time=30, expiry=self.expiry),
+                         gc.find_to_remove(self.db, expire_time=30))
+        gc.collect(self.db, expire_time=30, expiry=self.expiry)
+        self.assertEqual([count for count, data in self.db.read(0)], [2, 3])
+        ## Kept up to date through the collection:
+        self.assertEqual(self.expiry.expired(self.db, 100), set([3]))
+        self.db.extend([item('d', expire=5)])
+        self.assertEqual(self.expiry.expired(self.db, 100), set([3, 4]))
+        self.db.clear()
+        self.db.extend([item('x')])
+        self.assertEqual(self.expiry.next_expiry(self.db), None)
+
+    def test_add(self):
+        self.expiry.add(self.db, [])
+        ## A new database is indexed from its first records:
+        self.db.extend([item('a', expire=10), item('b')])
+        self.expiry.add(self.db, [(1, item('a', expire=10)), (2, item('b'))])
+        read = Database.read
+        Database.read = None
+        try:
+            self.assertEqual(self.expiry.next_expiry(self.db), 10)
+        finally:
+            Database.read = read
+        ## Records after some the index hasn't seen are left to sync:
+        self.db.extend([item('c', expire=5), item('d', expire=1)])
+        self.expiry.add(self.db, [(4, item('d', expire=1))])
+        self.assertEqual(self.expiry.expired(self.db, 8), set([3, 4]))
+
+    def test_add_without_expire(self):
+        ## Writes that don't expire don't touch the index:
+        self.db.extend([item('a')])
+        self.expiry.add(self.db, [(1, item('a'))])
+        self.assertEqual(os.listdir(self.dir), ['database', 'database.index'])
+        self.db.extend([item('b', expire=10)])
+        self.expiry.add(self.db, [(2, item('b', expire=10))])
+        self.assertEqual(self.expiry.next_expiry(self.db), 10)
+
+
+class TestExpireCommand(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = UserStorage(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_expire(self):
+        for bucket, expire in ('old', 1), ('new', 2 ** 40):
+            db = self.storage.for_user('example.com', 'user', bucket)
+            db.collection_id
+            db.extend([item('a', expire=expire), item('b')])
+        self.assertTrue(os.path.exists(os.path.join(db.dir, 'expiry.index')))
+        ## An index that was never built is built by the command, not
+        ## by writes:
+        unindexed = self.storage.for_user('example.com', 'user', 'unindexed')
+        unindexed.collection_id
+        unindexed.extend([item('b')])
+        unindexed.extend([item('a', expire=1)])
+        self.assertEqual([name for name in os.listdir(unindexed.dir) if name.startswith('expiry')], [])
+        import sys
+        old_stdout = sys.stdout
+        sys.stdout = out = StringIO()
+        try:
+            admin.main(['--dir', self.dir, 'expire'])
+        finally:
+            sys.stdout = old_stdout
+        self.assertIn('3 databases checked, 2 collected, 2 records removed', out.getvalue())
+        self.assertEqual([count for count, data in unindexed.db.read(0)], [1])
+        old = self.storage.for_user('example.com', 'user', 'old')
+        self.assertEqual([count for count, data in old.db.read(0)], [2])
+        self.assertEqual([count for count, data in db.db.read(0)], [1, 2])
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import heads
+from cutout.heads import HeadTable, Head
+from cutout.sync import Application
+from cutout.tests import set_remote_user
+
+
+class TestHeadTable(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'heads')
+        self.table = HeadTable(self.filename)
+
+    def tearDown(self):
+        self.table.close()
+        shutil.rmtree(self.dir)
+
+    def test_note(self):
+        self.assertEqual(self.table.get('a'), None)
+        self.table.note('a', 0, '', 3)
+        self.assertEqual(self.table.get('a'), Head(0, '', 3, True))
+        ## The counter only goes up:
+        self.table.note('a', 0, '', 2)
+        self.assertEqual(self.table.get('a').counter, 3)
+        self.table.note('a', 0, '123', 1)
+        self.assertEqual(self.table.get('a'), Head(0, '123', 1, True))
+        ## Other processes map the same file:
+        other = HeadTable(self.filename)
+        self.assertEqual(other.get('a'), Head(0, '123', 1, True))
+        other.close()
+        self.table.note('b', 0, 'x' * 29, 1)
+        self.assertEqual(self.table.get('b'), None)
+
+    def test_invalidate(self):
+        self.table.note('a', 0, '', 3)
+        self.table.invalidate('a')
+        self.assertEqual(self.table.get('a'), Head(1, '', 3, False))
+        ## A note from before the invalidation is ignored:
+        self.table.note('a', 0, '', 5)
+        self.assertFalse(self.table.get('a').known)
+        self.table.note('a', 1, '', 0)
+        self.assertEqual(self.table.get('a'), Head(1, '', 0, True))
+
+    def test_writing(self):
+        self.table.note('a', 0, '', 3)
+        with self.table.writing('a'):
+            self.assertFalse(self.table.get('a').known)
+            self.table.note('a', 0, '', 4)
+            self.assertFalse(self.table.get('a').known)
+        self.assertEqual(self.table.get('a'), Head(0, '', 4, True))
+        try:
+            with self.table.writing('a'):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.table.get('a'), Head(1, '', 4, False))
+        self.table.clear()
+        self.assertEqual(self.table.get('a'), None)
+
+    def test_full(self):
+        self.table.close()
+        self.table = HeadTable(os.path.join(self.dir, 'small'), slots=4)
+        for key in 'abcd':
+            self.table.note(key, 0, '', 1)
+        self.table.note('e', 0, '', 1)
+        self.assertEqual(self.table.get('e'), None)
+        self.assertEqual([self.table.get(key).counter for key in 'abcd'], [1, 1, 1, 1])
+
+
+class TestHeadResponses(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sync = Application(dir=self.dir)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+
+    def tearDown(self):
+        heads._tables.pop(self.sync.storage.heads.filename).close()
+        shutil.rmtree(self.dir)
+
+    def get(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def post(self, since, *ids):
+        resp = self.get('/c/a@b/x?since=%i' % since, method='POST',
+                        body=json.dumps([{'id': id} for id in ids]))
+        self.assertEqual(resp.status_code, 200, resp.body)
+
+    def test_head(self):
+        self.post(0, 'a', 'b')
+        self.assertEqual(self.sync.storage.head('c', 'a@b', '/x').counter, 2)
+
+        def for_user(*args):
+            raise AssertionError('Storage used')
+        real_for_user = self.sync.storage.for_user
+        self.sync.storage.for_user = for_user
+        resp = self.get('/c/a@b/x?since=2')
+        self.assertEqual(resp.json, {'objects': []})
+        self.assertEqual(resp.headers['X-Sync-Position'], '2')
+        resp = self.get('/c/a@b/x?since=1', headers={'If-None-Match': '"%s"' % resp.etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertRaises(AssertionError, self.get, '/c/a@b/x?since=1')
+        self.sync.storage.for_user = real_for_user
+        self.assertEqual(self.get('/c/a@b/x?since=1').json['objects'][0][0], 2)
+        self.post(2, 'c')
+        self.assertEqual(self.get('/c/a@b/x?since=2').json['objects'][0][0], 3)
+
+    def test_replaced(self):
+        self.post(0, 'a')
+        self.assertEqual(self.get('/c/a@b/x?delete', method='POST').status_code, 201)
+        self.assertFalse(self.sync.storage.head('c', 'a@b', '/x').known)
+        ## A GET fills it in again:
+        resp = self.get('/c/a@b/x?since=1')
+        self.assertEqual(resp.json, {'objects': []})
+        self.assertEqual(self.sync.storage.head('c', 'a@b', '/x').counter, 0)
+        self.post(0, 'a')
+        db = self.sync.storage.for_user('c', 'a@b', '/x')
+        collection_id = db.collection_id
+        self.assertFalse(self.sync.storage.head('c', 'a@b', '/x').known)
+        self.get('/c/a@b/x?since=1')
+        self.assertEqual(self.sync.storage.head('c', 'a@b', '/x').collection_id, collection_id)
+        self.assertEqual(self.get('/c/a@b/x?since=1').json,
+                         {'objects': [], 'collection_id': collection_id})
+        db.deprecate()
+        self.assertEqual(self.get('/c/a@b/x?since=1').status_code, 503)
+        self.sync.storage.disable()
+        self.assertTrue(self.sync.storage.heads.disabled)
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import simplejson as json
+from cStringIO import StringIO
+from unittest2 import TestCase
+from webob import Request
+from webob.dec import wsgify
+from cutout import Database, DatabaseMoved, heads
+from cutout import streamdb
+from cutout import sync
+from cutout.balancer import Application
+from cutout.forwarder import rooted
+
+
+@wsgify.middleware
+def trusted(req, app):
+    req.environ['REMOTE_USER'] = 'a@b/c'
+    req.environ['cutout.internal'] = True
+    return app
+
+
+class TestLiveMigration(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.balancer = Application(preload=1, preload_dir=self.dir, backups=0)
+        self.app = rooted(trusted(self.balancer))
+        self.source = self.balancer.subnodes['node-000']
+        ## Reachable, but not in the ring until it is added:
+        self.dest = self.balancer.subnodes['node-new'] = sync.Application(
+            dir=os.path.join(self.dir, 'node-new'))
+
+    def tearDown(self):
+        for node in self.balancer.subnodes.values():
+            filename = node.storage.heads.filename
+            if filename in heads._tables:
+                heads._tables.pop(filename).close()
+        shutil.rmtree(self.dir)
+
+    def send(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def post(self, path, since, *ids):
+        resp = self.send(path + '?since=%i' % since, method='POST',
+                         body=json.dumps([{'id': id} for id in ids]))
+        self.assertEqual(resp.status_code, 200, resp.body)
+
+    def test_handoff(self):
+        self.post('/node-000/c/a@b/x', 0, 'a', 'b')
+        source_db = self.source.storage.for_user('c', 'a@b', '/x')
+        self.assertEqual(source_db.start_migration('node-new'), 2)
+        ## The source is still in use while it is copied:
+        resp = self.send('/node-000/c/a@b/x?copy&until=2')
+        self.assertEqual(resp.status_code, 200)
+        dest_db = self.dest.storage.for_user('c', 'a@b', '/x')
+        dest_db.set_receiving(True)
+        dest_db.decode_db(StringIO(resp.body))
+        self.post('/node-000/c/a@b/x', 2, 'c')
+        self.assertEqual(len(self.send('/node-000/c/a@b/x').json['objects']), 3)
+        resp = self.send('/node-000/c/a@b/x?handoff&since=2', method='POST')
+        records = list(streamdb.decode_records(resp.body))
+        self.assertEqual([count for count, data in records], [3])
+        ## Now the source forwards to the new node, which waits for the rest:
+        self.dest.handoff_wait = 0
+        self.assertEqual(self.send('/node-000/c/a@b/x').status_code, 503)
+        dest_db.extend(records, with_counters=True)
+        dest_db.set_receiving(False)
+        resp = self.send('/node-000/c/a@b/x')
+        self.assertEqual([count for count, obj in resp.json['objects']], [1, 2, 3])
+        self.post('/node-000/c/a@b/x', 3, 'd')
+        self.assertEqual(dest_db.db.length(), 4)
+        resp = self.send('/node-000/c/a@b/x?handoff&since=3&retire', method='POST')
+        self.assertEqual(resp.body, '')
+        self.assertEqual(os.listdir(source_db.dir), ['moved_to'])
+        self.assertEqual(self.send('/node-000/c/a@b/x').json['objects'][-1][0], 4)
+
+    def test_write_during_handoff(self):
+        self.post('/node-000/c/a@b/x', 0, 'a')
+        source_db = self.source.storage.for_user('c', 'a@b', '/x')
+        source_db.start_migration('node-new')
+        ## Another process has the database open, and writes after the
+        ## hand off:
+        writer = Database(os.path.join(source_db.dir, 'database'))
+        resp = self.send('/node-000/c/a@b/x?handoff&since=1', method='POST')
+        self.assertEqual(resp.status_code, 200)
+        self.assertRaises(DatabaseMoved, writer.extend, [json.dumps({'id': 'b'})])
+        writer.close()
+        ## Nothing was written where the hand off wouldn't see it:
+        self.assertEqual(list(source_db.deprecated_db.read(0)), [(1, '{"id": "a"}')])
+
+    def test_node_added(self):
+        buckets = ['/%i' % i for i in range(10)]
+        paths = ['/c/a@b' + bucket for bucket in buckets]
+        for bucket, path in zip(buckets, paths):
+            self.post(path, 0, 'a', 'b')
+            ## (only databases with a collection_id are moved)
+            self.source.storage.for_user('c', 'a@b', bucket).collection_id
+        before = dict((path, self.send(path).json) for path in paths)
+        self.balancer.add_node('node-new', root=self.app)
+        moved = [path for path in paths if self.balancer.node_list(path)[0] == 'node-new']
+        self.assertTrue(moved)
+        for path in paths:
+            self.assertEqual(self.send(path).json, before[path])
+            ## Requests that still go to the old node are forwarded:
+            self.assertEqual(self.send('/node-000' + path).json, before[path])
+        for path in moved:
+            db = self.source.storage.for_user('c', 'a@b', path[len('/c/a@b'):])
+            self.assertEqual(os.listdir(db.dir), ['moved_to'])
+            self.assertEqual(db.moved_to, 'node-new')
+            self.assertFalse(db.is_deprecated)
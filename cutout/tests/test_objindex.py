@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import Database, gc
+from cutout import objindex, streamdb
+from cutout.objindex import ObjectIndex
+from cutout.sync import Application
+from cutout.tests import set_remote_user, item
+
+
+class TestObjectIndex(TestCase):
+
+    engine_class = Database
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = self.engine_class(os.path.join(self.dir, 'database'))
+        self.objects = ObjectIndex(os.path.join(self.dir, 'objects.index'))
+        self.objects.initial_capacity = 4
+
+    def tearDown(self):
+        self.objects.close()
+        shutil.rmtree(self.dir)
+
+    def get(self, id, type=None):
+        found = self.objects.get(self.db, type, id)
+        if found is not None:
+            return found[0], json.loads(found[1])
+
+    def test_lookup(self):
+        self.db.extend([item('a'), item('b', type='t'), item('c')])
+        self.assertEqual(self.get('b', 't'), (2, dict(id='b', type='t')))
+        self.assertEqual(self.get('b'), None)
+        ## Grows past its initial size as records are added:
+        self.db.extend([item(str(i), v=1) for i in range(20)])
+        self.db.extend([item('a', v=2), item('5', deleted=True)])
+        self.assertEqual(self.get('a'), (24, dict(id='a', v=2)))
+        self.assertEqual(self.get('5'), (25, dict(id='5', deleted=True)))
+        self.assertEqual(self.get('19'), (23, dict(id='19', v=1)))
+        self.assertEqual(self.get('missing'), None)
+        ## Another index on the same file picks up where this one left off:
+        other = ObjectIndex(self.objects.filename)
+        self.db.extend([item('c', v=2)])
+        self.assertEqual(other.get(self.db, None, 'c')[0], 26)
+        other.close()
+
+    def test_rewritten(self):
+        self.db.extend([item('a'), item('b'), item('a', v=2), item('b', v=2)])
+        self.assertEqual(self.get('a')[0], 3)
+        gc.collect(self.db)
+        self.db.extend([item('c')])
+        ## Positions have changed, but the index notices:
+        self.assertEqual(self.get('a'), (3, dict(id='a', v=2)))
+        self.assertEqual(self.get('c'), (5, dict(id='c')))
+        self.db.clear()
+        self.db.extend([item('x')])
+        self.assertEqual(self.get('a'), None)
+        self.assertEqual(self.get('x'), (1, dict(id='x')))
+
+    def test_collision(self):
+        old_hash = objindex.object_hash
+        objindex.object_hash = lambda type, id: 1
+        try:
+            self.db.extend([item('a'), item('b'), item('c')])
+            self.assertEqual(self.get('a'), (1, dict(id='a')))
+            self.assertEqual(self.get('c'), (3, dict(id='c')))
+        finally:
+            objindex.object_hash = old_hash
+
+    def test_gc(self):
+        self.db.extend([item('a'), item('b'), item('a', v=2),
+                        item('c', expire=1), item('b', v=2)])
+        self.assertEqual(gc.find_to_remove(self.db, objects=self.objects),
+                         gc.find_to_remove(self.db))
+        gc.collect(self.db, objects=self.objects)
+        self.assertEqual([count for count, data in self.db.read(0)], [3, 5])
+        self.assertFalse(os.path.exists(self.objects.filename))
+        self.assertEqual(self.get('b'), (5, dict(id='b', v=2)))
+
+    def test_gc_large(self):
+        ## More records than are read at once:
+        self.db.extend([item(str(i % 2000), v=i) for i in range(5500)])
+        found = gc.find_to_remove(self.db, objects=self.objects)
+        self.assertEqual(len(found), 3500)
+        self.assertEqual(found, gc.find_to_remove(self.db))
+
+
+class TestStreamObjectIndex(TestObjectIndex):
+
+    engine_class = streamdb.Database
+
+
+class TestObjectGet(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sync = Application(dir=self.dir, object_index=True)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def request(self, path, **kw):
+        resp = Request.blank('http://localhost' + path, **kw).send(self.app)
+        self.assertEqual(resp.status_code, 200, resp.body)
+        return resp
+
+    def test_get_and_conflicts(self):
+        self.request('/c/a@b/x', method='POST', body=json.dumps(
+            [dict(id='a', type='note', v=1), dict(id='b', v=1)]))
+        storage = self.sync.storage.for_user('c', 'a@b', '/x')
+        ## Kept up to date as items are posted:
+        self.assertTrue(os.path.exists(storage.objects.filename))
+        self.request('/c/a@b/x?since=2', method='POST', body=json.dumps(
+            [dict(id='a', type='note', v=2)]))
+        resp = self.request('/c/a@b/x?id=a&type=note')
+        self.assertEqual(resp.json['objects'], [[3, dict(id='a', type='note', v=2)]])
+        resp = self.request('/c/a@b/x?id=a')
+        self.assertEqual(resp.json['objects'], [])
+        resp = self.request('/c/a@b/x?since=2', method='POST', body=json.dumps(
+            [dict(id='a', type='note', v=3), dict(id='b', v=2)]))
+        self.assertEqual(resp.json['invalid_since'], True)
+        self.assertEqual(resp.json['conflicts'], [['note', 'a']])
@@ -0,0 +1,163 @@
+import os
+import shutil
+import tempfile
+import time
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import Database, heads
+from cutout import admin
+from cutout.sync import Application, UserStorage
+from cutout.tests import set_remote_user
+
+
+class TestPack(TestCase):
+
+    engine = 'cutout'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.now = time.time()
+        self.storage = UserStorage(self.dir, engine=self.engine, timer=lambda: self.now)
+        self.sync = Application(storage=self.storage)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+
+    def tearDown(self):
+        heads._tables.pop(self.storage.heads.filename).close()
+        shutil.rmtree(self.dir)
+
+    def request(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def post(self, bucket, since, *items):
+        resp = self.request('/c/a@b/%s?since=%i' % (bucket, since), method='POST',
+                            body=json.dumps(list(items)))
+        self.assertEqual(resp.status_code, 200, resp.body)
+        return resp
+
+    def test_pack(self):
+        self.post('x', 0, dict(id='a', type='t', v=1), dict(id='b', type='t'))
+        self.post('x', 2, dict(id='a', type='t', v=2), dict(id='c', type='u', deleted=True))
+        db = self.storage.for_user('c', 'a@b', '/x')
+        collection_id = db.collection_id
+        ## Not idle yet:
+        self.assertFalse(self.storage.pack('c', 'a@b', '/x', idle=60))
+        self.now += 120
+        self.assertTrue(self.storage.pack('c', 'a@b', '/x', idle=60))
+        self.assertFalse(os.path.exists(db.dir))
+        self.assertEqual(self.storage.all_dbs(), [('c', 'a@b', '/x')])
+        self.assertEqual(self.storage.all_dbs(include_packed=False), [])
+
+        ## GETs are answered from the pack (with superseded records gone):
+        resp = self.request('/c/a@b/x')
+        self.assertEqual(resp.json, {'objects': [[2, dict(id='b', type='t')],
+                                                 [3, dict(id='a', type='t', v=2)]],
+                                     'collection_id': collection_id})
+        self.assertEqual(resp.headers['X-Sync-Position'], '4')
+        resp = self.request('/c/a@b/x?since=2&limit=1')
+        self.assertEqual(resp.json['objects'], [[3, dict(id='a', type='t', v=2)]])
+        self.assertEqual(resp.json['next_since'], 3)
+        resp = self.request('/c/a@b/x?since=2&include=u')
+        self.assertEqual(resp.json['objects'], [[4, dict(id='c', type='u', deleted=True)]])
+        resp = self.request('/c/a@b/x?id=a&type=t')
+        self.assertEqual(resp.json['objects'], [[3, dict(id='a', type='t', v=2)]])
+        resp = self.request('/c/a@b/x', headers={'If-None-Match': resp.etag or ''})
+        etag = self.request('/c/a@b/x').etag
+        self.assertEqual(self.request('/c/a@b/x?since=1', headers={'If-None-Match': '"%s"' % etag}).status_code, 304)
+        resp = self.request('/c/a@b/x?collection_id=other')
+        self.assertEqual(resp.json['collection_changed'], True)
+        self.assertFalse(os.path.exists(db.dir))
+
+        ## A write unpacks it:
+        resp = self.post('x', 4, dict(id='d', type='t'))
+        self.assertTrue(os.path.exists(db.dir))
+        self.assertEqual(self.storage.packs.keys(), [])
+        resp = self.request('/c/a@b/x?since=1')
+        self.assertEqual([count for count, item in resp.json['objects']], [2, 3, 4, 5])
+        self.assertEqual(resp.json['collection_id'], collection_id)
+        self.assertEqual(self.storage.packs.compact(), ['segment-000001'])
+
+    def test_compressed(self):
+        if self.engine != 'cutout':
+            self.skipTest('Only the cutout engine compresses')
+        db = self.storage.for_user('c', 'a@b', '/x')
+        db.collection_id
+        compressed = Database(os.path.join(db.dir, 'database'), compress=True)
+        items = [dict(id=str(i), type='bookmark', url='http://example.com/%i' % i)
+                 for i in range(40)]
+        compressed.extend([json.dumps(item) for item in items])
+        compressed.close()
+        self.now += 120
+        self.assertTrue(self.storage.pack('c', 'a@b', '/x', idle=60))
+        self.assertEqual(self.request('/c/a@b/x').json['objects'],
+                         [[i + 1, item] for i, item in enumerate(items)])
+
+    def test_admin(self):
+        for bucket in 'x', 'y', 'z':
+            self.post(bucket, 0, dict(id='a', type='t'))
+            self.storage.for_user('c', 'a@b', '/' + bucket).collection_id
+        self.post('z', 1, dict(id='b', type='t'))
+        self.now += 3 * 24 * 60 * 60
+        ## Newly written:
+        os.utime(os.path.join(self.storage.db_dir('c', 'a@b', '/z'), 'database'), (self.now, self.now))
+        admin.pack(self.storage, ['2'])
+        self.assertEqual(sorted(self.storage.all_dbs(include_packed=False)), [('c', 'a@b', '/z')])
+        self.assertEqual(sorted(self.storage.all_dbs()),
+                         [('c', 'a@b', '/x'), ('c', 'a@b', '/y'), ('c', 'a@b', '/z')])
+        ## Other processes see what was packed:
+        other = UserStorage(self.dir, engine=self.engine)
+        self.assertEqual([(count, json.loads(data)) for count, data in other.packed('c', 'a@b', '/y').records],
+                         [(1, dict(id='a', type='t'))])
+        admin.unpack(self.storage, [])
+        self.assertEqual(len(self.storage.all_dbs(include_packed=False)), 3)
+        self.assertEqual(os.listdir(self.storage.packs.dir), ['index'])
+        self.assertEqual(other.packed('c', 'a@b', '/y'), None)
+        self.assertEqual(self.request('/c/a@b/y').json['objects'], [[1, dict(id='a', type='t')]])
+
+
+    def test_index_read_once(self):
+        self.post('x', 0, dict(id='a', type='t'))
+        self.storage.for_user('c', 'a@b', '/x').collection_id
+        self.now += 120
+        self.assertTrue(self.storage.pack('c', 'a@b', '/x', idle=60))
+        packs = self.storage.packs
+        reads = []
+        read_index = packs._read_index
+
+        def counting_read_index():
+            reads.append(True)
+            read_index()
+        packs._read_index = counting_read_index
+        for i in range(3):
+            self.assertEqual(self.request('/c/a@b/x').status_code, 200)
+        self.assertEqual(reads, [])
+        self.assertEqual(packs.compact(), [])
+        self.assertEqual(self.request('/c/a@b/x').json['objects'], [[1, dict(id='a', type='t')]])
+        self.assertEqual(len(reads), 1)
+
+    def test_compacted_away(self):
+        self.storage.packs.max_segment_bytes = 0
+        self.post('x', 0, dict(id='a', type='t'))
+        self.storage.for_user('c', 'a@b', '/x').collection_id
+        self.now += 120
+        self.assertTrue(self.storage.pack('c', 'a@b', '/x', idle=60))
+        other = UserStorage(self.dir, engine=self.engine)
+        key = other.pack_key('c', 'a@b', '/x')
+        stale = other.packs.get(key)
+        ## Unpacked and packed again (into a new segment), and the old
+        ## segment removed, just as another process had found the entry:
+        self.post('x', 1, dict(id='b', type='t'))
+        self.now += 120
+        self.assertTrue(self.storage.pack('c', 'a@b', '/x', idle=60))
+        self.assertEqual(self.storage.packs.compact(), ['segment-000001'])
+        get = other.packs.get
+        found = [stale]
+        other.packs.get = lambda key: found.pop() if found else get(key)
+        packed = other.packs.open(key)
+        self.assertEqual(packed.entry.segment, 'segment-000002')
+        self.assertEqual(len(packed.records), 2)
+
+
+class TestStreamPack(TestPack):
+
+    engine = 'stream'
@@ -0,0 +1,91 @@
+import os
+import shutil
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout.sync import Application
+from cutout.tests import set_remote_user
+
+here = os.path.dirname(os.path.abspath(__file__))
+test_dir = os.path.join(here, 'test-pagination-dbs')
+
+
+class TestPagination(TestCase):
+
+    def setUp(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        self.sync = Application(dir=test_dir, max_response_bytes=100)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+        items = [dict(id=str(i), type='big' if i % 2 else 'small', data='x' * 30)
+                 for i in range(1, 7)]
+        resp = self.get('/c/a@b/x', method='POST', body=json.dumps(items))
+        self.assertEqual(resp.status_code, 200, resp.body)
+
+    def tearDown(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+
+    def get(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def counts(self, resp):
+        return [count for count, item in resp.json['objects']]
+
+    def test_max_bytes(self):
+        ## Each item is about 70 bytes, so the server limit allows one:
+        resp = self.get('/c/a@b/x')
+        self.assertEqual(self.counts(resp), [1])
+        self.assertEqual(resp.json['incomplete'], True)
+        self.assertEqual(resp.json['next_since'], 1)
+        self.sync.max_response_bytes = None
+        resp = self.get('/c/a@b/x?since=1&max_bytes=150')
+        self.assertEqual(self.counts(resp), [2, 3])
+        self.assertEqual(resp.json['next_since'], 3)
+        resp = self.get('/c/a@b/x?since=3&max_bytes=150')
+        self.assertEqual(self.counts(resp), [4, 5])
+        resp = self.get('/c/a@b/x?since=5&max_bytes=150')
+        self.assertEqual(self.counts(resp), [6])
+        self.assertTrue('incomplete' not in resp.json)
+        resp = self.get('/c/a@b/x?max_bytes=bad')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_limit_and_filter(self):
+        self.sync.max_response_bytes = None
+        resp = self.get('/c/a@b/x?limit=4')
+        self.assertEqual(self.counts(resp), [1, 2, 3, 4])
+        self.assertEqual(resp.json['next_since'], 4)
+        resp = self.get('/c/a@b/x?limit=2&include=small')
+        self.assertEqual(self.counts(resp), [2])
+        self.assertEqual(resp.json['next_since'], 2)
+        resp = self.get('/c/a@b/x?since=4&limit=2&include=small')
+        self.assertEqual(self.counts(resp), [6])
+        self.assertTrue('incomplete' not in resp.json)
+
+    def test_etag(self):
+        ## Incomplete responses have no ETag:
+        self.assertEqual(self.get('/c/a@b/x').etag, None)
+        self.sync.max_response_bytes = None
+        resp = self.get('/c/a@b/x')
+        etag = resp.etag
+        self.assertTrue(etag.endswith('-6-' + etag.split('-')[-1]), etag)
+        not_modified = self.get('/c/a@b/x?since=6', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.body, '')
+        self.assertEqual(not_modified.headers['X-Sync-Position'], '6')
+        self.assertTrue(not_modified.headers['X-Sync-Poll-Time'])
+        ## Browsers may send If-None-Match and read the ETag:
+        self.assertEqual(resp.headers['Access-Control-Expose-Headers'], 'ETag, X-Sync-Poll-Time')
+        options = self.get('/c/a@b/x', method='OPTIONS')
+        self.assertEqual(options.headers['Access-Control-Allow-Headers'], 'If-None-Match')
+        self.assertEqual(options.headers['Access-Control-Expose-Headers'], 'ETag, X-Sync-Poll-Time')
+        ## Filters have their own ETags:
+        filtered = self.get('/c/a@b/x?include=small')
+        self.assertNotEqual(filtered.etag, etag)
+        resp = self.get('/c/a@b/x?include=small', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(resp.status_code, 200)
+        self.get('/c/a@b/x?since=6', method='POST', body=json.dumps([dict(id='7')]))
+        resp = self.get('/c/a@b/x?since=6', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.counts(resp), [7])
+        self.assertNotEqual(resp.etag, etag)
@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout.polling import PollHints
+from cutout.sync import Application
+from cutout.tests import set_remote_user
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPollHints(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.hints = PollHints(timer=self.clock)
+        self.hints.system_load = lambda: 0.0
+
+    def test_activity(self):
+        self.assertEqual(self.hints.poll_time('a'), 300)
+        self.hints.note_change('a')
+        self.assertEqual(self.hints.poll_time('a'), 30)
+        self.clock.now += 300
+        self.assertEqual(self.hints.poll_time('a'), 165)
+        self.clock.now += 300
+        self.assertEqual(self.hints.poll_time('a'), 300)
+        self.assertEqual(self.hints.poll_time('b'), 300)
+
+    def test_load(self):
+        self.hints.note_change('a')
+        for i in range(16):
+            self.hints.started()
+        ## Half loaded is still idle:
+        self.assertEqual(self.hints.poll_time('a'), 30)
+        for i in range(8):
+            self.hints.started()
+        self.assertEqual(self.hints.poll_time('a'), 1815)
+        for i in range(100):
+            self.hints.started()
+        self.assertEqual(self.hints.poll_time('a'), 3600)
+        self.hints.system_load = lambda: 1.0
+        for i in range(124):
+            self.hints.finished()
+        self.assertEqual(self.hints.poll_time('b'), 3600)
+
+    def test_forgets(self):
+        self.hints.max_buckets = 2
+        for key in 'abc':
+            self.hints.note_change(key)
+        self.assertEqual(self.hints._changed.keys(), ['b', 'c'])
+        self.assertEqual(self.hints.poll_time('a'), 300)
+
+
+class TestApplication(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.hints = PollHints()
+        self.hints.system_load = lambda: 0.0
+        self.app = set_remote_user(Application(dir=self.dir, poll_hints=self.hints),
+                                   username='a@b/c')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_header(self):
+        resp = Request.blank('/c/a@b/x').send(self.app)
+        self.assertEqual(resp.headers['X-Sync-Poll-Time'], '300')
+        ## Cross-origin clients can read it:
+        self.assertTrue('X-Sync-Poll-Time' in resp.headers['Access-Control-Expose-Headers'])
+        resp = Request.blank('/c/a@b/x', method='POST', body=json.dumps([{'id': 'a'}])).send(self.app)
+        self.assertEqual(resp.status_code, 200)
+        self.assertFalse('X-Sync-Poll-Time' in resp.headers)
+        resp = Request.blank('/c/a@b/x').send(self.app)
+        self.assertEqual(resp.headers['X-Sync-Poll-Time'], '30')
+        self.assertEqual(Request.blank('/c/a@b/y').send(self.app).headers['X-Sync-Poll-Time'], '300')
+        self.assertEqual(self.hints.in_progress, 0)
@@ -0,0 +1,53 @@
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout.sync import Application, split_items
+from cutout.tests import set_remote_user
+
+
+class TestSplitItems(TestCase):
+
+    def test_split(self):
+        body = ' [ {"id": "a"} ,{"id":"b", "x": [1, "]"]}\n]\n'
+        self.assertEqual(split_items(body),
+                         [({'id': 'a'}, '{"id": "a"}'),
+                          ({'id': 'b', 'x': [1, ']']}, '{"id":"b", "x": [1, "]"]}')])
+        self.assertEqual(split_items('[]'), [])
+        for bad in '', '{"id": "a"}', '[{"id": "a"}', '[{"id": "a"},]', '[1]', '[{}]', '[] x':
+            self.assertRaises(ValueError, split_items, bad)
+
+
+class TestPost(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sync = Application(dir=self.dir, max_post_bytes=1000)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def post(self, body, path='/c/a@b/x'):
+        return Request.blank('http://localhost' + path, method='POST', body=body).send(self.app)
+
+    def test_stored_as_sent(self):
+        body = '[{"id": "a",  "text": "caf\xc3\xa9"}, {"id": "b", "blob": {"content_type": "text/plain", "data": "aGk="}}]'
+        resp = self.post(body)
+        self.assertEqual(resp.status_code, 200, resp.body)
+        self.assertEqual(resp.json['object_counters'], [1, 2])
+        db = self.sync.storage.for_user('c', 'a@b', '/x')
+        records = list(db.db.read(0))
+        self.assertEqual(records[0], (1, '{"id": "a",  "text": "caf\xc3\xa9"}'))
+        ## Only the item with blob data is encoded again, without the data:
+        blob_item = json.loads(records[1][1])
+        self.assertEqual(blob_item['blob']['content_type'], 'text/plain')
+        self.assertTrue('data' not in blob_item['blob'])
+        resp = Request.blank('http://localhost/c/a@b/x').send(self.app)
+        self.assertEqual(resp.json['objects'][0], [1, {'id': 'a', 'text': u'caf\xe9'}])
+
+    def test_bad_bodies(self):
+        self.assertEqual(self.post('[{"id": "a"}').status_code, 400)
+        self.assertEqual(self.post('[{"no-id": 1}]').status_code, 400)
+        self.assertEqual(self.post(json.dumps([{'id': 'a', 'data': 'x' * 1000}])).status_code, 413)
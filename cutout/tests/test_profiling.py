@@ -0,0 +1,95 @@
+import os
+import marshal
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout.profiling import Profiler, collapse
+from cutout.sync import Application
+from cutout.tests import set_remote_user
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.profiler = Profiler(Application(dir=self.dir))
+        self.app = set_remote_user(self.profiler, username='a@b/c')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def control(self, query='', method='GET'):
+        req = Request.blank('/profile' + query, method=method)
+        req.environ['cutout.internal'] = True
+        return req.send(self.app)
+
+    def sync(self):
+        resp = Request.blank('/c/a@b/x', method='POST', body=json.dumps([{'id': 'a'}])).send(self.app)
+        self.assertEqual(resp.status_code, 200)
+        resp = Request.blank('/c/a@b/x').send(self.app)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_off(self):
+        self.sync()
+        self.assertEqual(Request.blank('/profile').send(self.app).status_code, 403)
+        status = self.control().json
+        self.assertEqual((status['enabled'], status['requests']), (False, 0))
+        self.assertEqual(self.control('?format=text').body, 'Nothing has been profiled\n')
+
+    def test_sample(self):
+        status = self.control('?sample=1', method='POST').json
+        self.assertTrue(status['enabled'])
+        self.sync()
+        status = self.control().json
+        self.assertEqual(status['route_counts'], {'post': 1, 'get': 1})
+        self.assertTrue('Application.post' not in self.control('?format=text&limit=0').body)
+        text = self.control('?format=text&limit=1000').body
+        self.assertTrue('2 requests' in text)
+        self.assertTrue('(post)' in text, text)
+        filename = os.path.join(self.dir, 'dump.pstats')
+        with open(filename, 'wb') as fp:
+            fp.write(self.control('?format=pstats').body)
+        with open(filename, 'rb') as fp:
+            raw = marshal.load(fp)
+        self.assertTrue([func for func in raw if func[2] == 'post'])
+        lines = self.control('?format=collapsed').body.splitlines()
+        self.assertTrue([line for line in lines if 'sync.py' in line and ':post;' in line], lines)
+        self.control('?stop', method='POST')
+        self.sync()
+        self.assertEqual(self.control().json['requests'], 2)
+        self.control('?reset', method='POST')
+        self.assertEqual(self.control().json['requests'], 0)
+        self.assertEqual(self.control('?sample=2', method='POST').status_code, 400)
+
+    def test_route_and_user(self):
+        self.control('?route=post', method='POST')
+        self.sync()
+        self.assertEqual(self.control().json['route_counts'], {'post': 1})
+        self.control('?user=someone-else', method='POST')
+        self.sync()
+        self.assertEqual(self.control().json['requests'], 1)
+        self.control('?user=a@b', method='POST')
+        self.sync()
+        self.assertEqual(self.control().json['route_counts'], {'post': 2, 'get': 1})
+
+
+class TestCollapse(TestCase):
+
+    def test_collapse(self):
+        main = ('m.py', 1, 'main')
+        a = ('m.py', 5, 'a')
+        b = ('m.py', 9, 'b')
+        ## b is called by main and a, taking 1s from each:
+        raw = {
+            main: (1, 1, 1.0, 5.0, {}),
+            a: (1, 1, 1.0, 2.0, {main: (1, 1, 1.0, 2.0)}),
+            b: (2, 2, 2.0, 2.0, {main: (1, 1, 1.0, 1.0), a: (1, 1, 1.0, 1.0)}),
+            }
+        self.assertEqual(collapse(raw), [
+            ('m.py:1:main', 1000000),
+            ('m.py:1:main;m.py:5:a', 1000000),
+            ('m.py:1:main;m.py:5:a;m.py:9:b', 1000000),
+            ('m.py:1:main;m.py:9:b', 1000000),
+            ])
@@ -0,0 +1,57 @@
+import os
+import shutil
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from webob.dec import wsgify
+from cutout.router import Application
+from cutout.forwarder import rooted
+
+here = os.path.dirname(os.path.abspath(__file__))
+test_dir = os.path.join(here, 'test-router-dbs')
+
+
+@wsgify.middleware
+def trusted(req, app):
+    req.environ['REMOTE_USER'] = 'a@b/c'
+    req.environ['cutout.internal'] = True
+    return app
+
+
+class TestRouter(TestCase):
+
+    def setUp(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        self.router = Application(preload=(2, 3), preload_dir=test_dir, shards=16)
+        self.app = rooted(trusted(self.router))
+
+    def tearDown(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+
+    def send(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def test_migrate_shard(self):
+        shard = self.router.table.shard_for('c', 'a@b')
+        old_pool = self.router.table.pools[shard]
+        new_pool = [name for name in self.router.pools if name != old_pool][0]
+        resp = self.send('/c/a@b/x', method='POST', body=json.dumps([dict(id='1')]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['X-Node-Name'].startswith(old_pool + '-'))
+        before = self.send('/c/a@b/x').json
+        self.router.migrate_shard(shard, new_pool, root=self.app)
+        self.assertEqual(self.router.table.pools[shard], new_pool)
+        resp = self.send('/c/a@b/x')
+        self.assertTrue(resp.headers['X-Node-Name'].startswith(new_pool + '-'))
+        self.assertEqual(resp.json, before)
+        old_master = self.router.pools[old_pool].node_list('/c/a@b/x')[0]
+        self.assertEqual(self.send('/%s/c/a@b/x' % old_master).json['objects'], [])
+
+    def test_node_change_stays_in_pool(self):
+        pool = self.router.pools['pool-00']
+        other = self.router.pools['pool-01']
+        self.router.add_node('pool-00', 'pool-00-extra', create=True, root=self.app)
+        self.assertTrue('pool-00-extra' in pool.ring.nodes)
+        self.assertFalse('pool-00-extra' in other.ring.nodes)
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import socket
+import signal
+import shutil
+import httplib
+import subprocess
+from unittest2 import TestCase
+
+here = os.path.dirname(os.path.abspath(__file__))
+test_dir = os.path.join(here, 'test-server-dbs')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestServer(TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'cutout.server', '--port', str(self.port),
+             '--workers', '2', '--dir', test_dir, '--max-requests', '3'],
+            stdout=subprocess.PIPE)
+        self.proc.stdout.readline()
+
+    def tearDown(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+
+    def get(self, path):
+        for i in range(50):
+            try:
+                conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+                conn.request('GET', path)
+                return conn.getresponse()
+            except socket.error:
+                time.sleep(0.1)
+        raise AssertionError('Server never answered')
+
+    def test_serves_and_restarts(self):
+        # More requests than two workers can handle before restarting:
+        for i in range(10):
+            resp = self.get('/example.com/user/bucket')
+            self.assertEqual(resp.status, 401)
+        self.proc.send_signal(signal.SIGHUP)
+        self.assertEqual(self.get('/example.com/user/bucket').status, 401)
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(), 0)
+        self.assertTrue(os.path.exists(os.path.join(test_dir, 'clean-shutdown')))
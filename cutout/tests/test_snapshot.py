@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import time
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import Database, gc
+from cutout.snapshot import Snapshot
+from cutout.sync import Application
+from cutout.tests import set_remote_user, item
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.dir, 'database'))
+        self.snapshot = Snapshot(self.dir)
+        self.snapshot.max_lag = 3
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self, since=0, **kw):
+        items, complete = self.snapshot.read(self.db, since, **kw)
+        return [(count, json.loads(data)['id']) for count, data in items]
+
+    def test_latest(self):
+        self.db.extend([item('a'), item('b'), item('c'), item('a', v=2)])
+        ## The log is ahead by more than max_lag, so a snapshot is written:
+        self.assertEqual(self.read(), [(2, 'b'), (3, 'c'), (4, 'a')])
+        self.assertEqual(self.snapshot.read_meta()['position'], 4)
+        self.db.extend([item('b', deleted=True), item('d')])
+        ## b's tombstone is only interesting to clients that have b:
+        self.assertEqual(self.read(), [(3, 'c'), (4, 'a'), (6, 'd')])
+        self.assertEqual(self.read(3), [(4, 'a'), (5, 'b'), (6, 'd')])
+        self.assertEqual(self.read(max_bytes=30), [(3, 'c'), (4, 'a')])
+        self.assertEqual(self.snapshot.read_meta()['position'], 4)
+        self.db.extend([item('e'), item('f')])
+        self.assertEqual(self.read(), [(3, 'c'), (4, 'a'), (6, 'd'), (7, 'e'), (8, 'f')])
+        meta = self.snapshot.read_meta()
+        self.assertEqual((meta['position'], meta['name'], meta['previous']),
+                         (8, 'snapshot-8', 'snapshot-4'))
+        self.db.extend([item(str(i)) for i in range(4)])
+        self.read()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'snapshot-4')))
+        self.snapshot.clear()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'snapshot-8')))
+        self.assertEqual(len(self.read()), 9)
+
+    def test_replaced_log(self):
+        self.db.extend([item('a'), item('b'), item('c'), item('d')])
+        self.read()
+        self.db.clear()
+        self.db.extend([item('x')])
+        self.assertEqual(self.read(), [(1, 'x')])
+
+
+class TestSnapshotGet(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sync = Application(dir=self.dir)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def request(self, path, **kw):
+        resp = Request.blank('http://localhost' + path, **kw).send(self.app)
+        self.assertEqual(resp.status_code, 200, resp.body)
+        return resp
+
+    def test_get(self):
+        for i in range(3):
+            self.request('/c/a@b/x?since=%i' % (i * 2), method='POST', body=json.dumps(
+                [dict(id='a', version=i), dict(id='b', version=i)]))
+        resp = self.request('/c/a@b/x')
+        self.assertEqual(resp.json['objects'],
+                         [[5, dict(id='a', version=2)], [6, dict(id='b', version=2)]])
+        ## Later GETs read the log itself:
+        resp = self.request('/c/a@b/x?since=2')
+        self.assertEqual([count for count, obj in resp.json['objects']], [3, 4, 5, 6])
+        storage = self.sync.storage.for_user('c', 'a@b', '/x')
+        gc.collect(storage.db, snapshot=storage.snapshot)
+        self.assertEqual(storage.snapshot.compacted, 6)
+        self.assertEqual([count for count, data in storage.db.read(0)], [5, 6])
+        resp = self.request('/c/a@b/x?since=2')
+        self.assertEqual([count for count, obj in resp.json['objects']], [5, 6])
+
+    def test_expired(self):
+        self.request('/c/a@b/x', method='POST', body=json.dumps(
+            [dict(id='b', expire=time.time() + 1000), dict(id='a')]))
+        self.assertEqual(len(self.request('/c/a@b/x').json['objects']), 2)
+        storage = self.sync.storage.for_user('c', 'a@b', '/x')
+        storage.snapshot.update(storage.db)
+        storage.collect(expire_time=time.time() + 2000)
+        self.assertEqual(self.request('/c/a@b/x').json['objects'], [[2, dict(id='a')]])
+        ## Nor does it come back when the snapshot is next rewritten:
+        storage.snapshot.update(storage.db)
+        self.assertEqual(self.request('/c/a@b/x').json['objects'], [[2, dict(id='a')]])
+
+    def test_ends_deleted(self):
+        self.request('/c/a@b/x', method='POST', body=json.dumps(
+            [dict(id='a'), dict(id='b', deleted=True)]))
+        ## The deleted object isn't sent, but the response is complete:
+        resp = self.request('/c/a@b/x')
+        self.assertEqual(resp.json['objects'], [[1, dict(id='a')]])
+        self.assertFalse('incomplete' in resp.json)
+        self.assertTrue(resp.etag)
+        resp = self.request('/c/a@b/x?limit=1')
+        self.assertEqual(resp.json['objects'], [[1, dict(id='a')]])
+        self.assertFalse('incomplete' in resp.json)
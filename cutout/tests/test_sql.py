@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import simplejson as json
+from cStringIO import StringIO
+from unittest2 import TestCase
+from webob import Request
+from cutout import ExpectationFailed, gc
+from cutout.sql import SQLiteDatabase
+from cutout.sync import UserStorage, Application
+from cutout.tests import set_remote_user
+
+
+class TestSQLite(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_operations(self):
+        db = SQLiteDatabase(self.filename)
+        self.assertTrue(SQLiteDatabase.is_empty(self.filename))
+        self.assertEqual(db.length(), 0)
+        self.assertEqual(db.extend(['1', '2', '3']), 1)
+        self.assertEqual(db.extend(['4', '5', '6']), 4)
+        self.assertFalse(SQLiteDatabase.is_empty(self.filename))
+        self.assertEqual(list(db.read(4)), [(5, '5'), (6, '6')])
+        self.assertEqual(list(db.read(2, 4)), [(3, '3'), (4, '4')])
+        self.assertEqual(list(db.read(0, max_bytes=2)), [(1, '1'), (2, '2')])
+        self.assertEqual(list(db.read(5, max_bytes=0)), [(6, '6')])
+        self.assertRaises(ExpectationFailed, db.extend, ['y'], expect_last_counter=5)
+        self.assertRaises(ExpectationFailed, db.extend, ['y'], expect_latest=5)
+        self.assertEqual(db.length(), 6)
+        self.assertEqual(db.extend([(20, 'y')], with_counters=True), 20)
+        ## Another connection sees the same data:
+        other = SQLiteDatabase(self.filename, durability='batch')
+        self.assertEqual(other.length(), 20)
+        self.assertEqual(other.read_at(20, 1), 'y')
+        other.clear()
+        self.assertEqual(db.length(), 0)
+
+    def test_copy_overwrite(self):
+        db = SQLiteDatabase(self.filename)
+        db.extend(['a', 'b', 'c', 'd'])
+        dest = os.path.join(self.dir, 'copy.db')
+        db.copy(set([2, 3]), dest)
+        other = SQLiteDatabase(self.filename)
+        db.overwrite(dest)
+        self.assertEqual(list(other.read(0)), [(1, 'a'), (4, 'd')])
+        db.rename(os.path.join(self.dir, 'renamed.db'))
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (4, 'd')])
+        db.delete()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'renamed.db')))
+
+    def test_gc(self):
+        db = SQLiteDatabase(self.filename)
+        db.extend([json.dumps(dict(id='a')), json.dumps(dict(id='b')),
+                   json.dumps(dict(id='a', v=2))])
+        gc.collect(db)
+        self.assertEqual([count for count, data in db.read(0)], [2, 3])
+
+    def test_storage_copy(self):
+        ## Databases are copied in the stream format, so the engines
+        ## can copy to each other:
+        for source_engine, dest_engine in ('sqlite', 'stream'), ('stream', 'sqlite'), ('sqlite', 'sqlite'):
+            source = UserStorage(os.path.join(self.dir, source_engine), engine=source_engine)
+            dest = UserStorage(os.path.join(self.dir, dest_engine + '-dest'), engine=dest_engine)
+            db = source.for_user('example.com', 'user', 'bucket')
+            db.db.clear()
+            db.extend(['a', 'b', 'c'])
+            self.assertEqual(db.position, 3)
+            encoded = ''.join(db.encode_db(until=2))
+            self.assertEqual([name for name in os.listdir(db.dir) if name.startswith('export-')], [])
+            other = dest.for_user('example.com', 'user', 'bucket')
+            other.decode_db(StringIO(encoded))
+            self.assertEqual(list(other.db.read(0)), [(1, 'a'), (2, 'b')])
+            self.assertEqual(other.collection_id, db.collection_id)
+
+    def test_application(self):
+        app = set_remote_user(Application(dir=self.dir, engine='sqlite'), username='a@b/c')
+        resp = Request.blank('/c/a@b/x', method='POST', body=json.dumps(
+            [dict(id='a'), dict(id='b')])).send(app)
+        self.assertEqual(resp.json['object_counters'], [1, 2], resp.body)
+        resp = Request.blank('/c/a@b/x?since=1').send(app)
+        self.assertEqual(resp.json['objects'], [[2, dict(id='b')]])
+        resp = Request.blank('/c/a@b/x?id=a').send(app)
+        self.assertEqual(resp.json['objects'], [[1, dict(id='a')]])
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import Database
+from cutout import stats
+from cutout.stats import Registry, Histogram, bucket_of, bucket_bound
+from cutout.sync import Application
+from cutout.tests import set_remote_user
+
+
+class TestHistogram(TestCase):
+
+    def test_buckets(self):
+        for value in 1e-6, 0.001, 0.5, 1, 3, 1000, 123456789:
+            bucket = bucket_of(value)
+            self.assertTrue(bucket_bound(bucket - 1) < value <= bucket_bound(bucket), value)
+            self.assertTrue(bucket_bound(bucket) <= value * 1.125 + 1e-12, value)
+        self.assertEqual(bucket_bound(bucket_of(0)), 0)
+
+    def test_percentiles(self):
+        hist = Histogram()
+        for i in range(1, 1001):
+            hist.observe(i / 1000.0)
+        self.assertEqual(hist.count, 1000)
+        self.assertEqual(hist.max, 1.0)
+        for percent in 50, 90, 99:
+            value = hist.percentile(percent)
+            self.assertTrue(percent / 100.0 <= value <= percent / 100.0 * 1.125, (percent, value))
+        self.assertEqual(hist.percentile(100), 1.0)
+        self.assertEqual(hist.cumulative([0.25, 0.5, 1, 2]), [250, 500, 1000, 1000])
+
+
+class TestRegistry(TestCase):
+
+    def test_formats(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests', ('route',))
+        requests.labels(route='get').inc()
+        requests.labels(route='get').inc(2)
+        requests.labels(route='a"b').inc()
+        latency = registry.histogram('latency_seconds', 'Latency')
+        latency.observe(0.003)
+        latency.observe(0.3)
+        registry.gauge('things', 'Things').labels().set_function(lambda: 7)
+        ## Declaring a metric again gives the same metric:
+        self.assertTrue(registry.counter('requests_total', 'Requests', ('route',)) is requests)
+        self.assertRaises(ValueError, registry.histogram, 'requests_total', 'Requests')
+        self.assertRaises(TypeError, requests.labels, node='x')
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['pid'], os.getpid())
+        metrics = snapshot['metrics']
+        self.assertEqual(metrics['requests_total']['values'],
+                         [{'labels': {'route': 'a"b'}, 'value': 1},
+                          {'labels': {'route': 'get'}, 'value': 3}])
+        self.assertEqual(metrics['things']['values'][0]['value'], 7)
+        value = metrics['latency_seconds']['values'][0]
+        self.assertEqual(value['count'], 2)
+        self.assertEqual(value['max'], 0.3)
+        self.assertTrue(0.003 <= value['p50'] < 0.004)
+        self.assertEqual(value['p99'], 0.3)
+        text = registry.prometheus()
+        self.assertTrue('# TYPE requests_total counter\n' in text)
+        self.assertTrue('requests_total{route="get"} 3\n' in text)
+        self.assertTrue('requests_total{route="a\\"b"} 1\n' in text)
+        self.assertTrue('latency_seconds_bucket{le="0.00390625"} 1\n' in text)
+        self.assertTrue('latency_seconds_bucket{le="+Inf"} 2\n' in text)
+        self.assertTrue('latency_seconds_count 2\n' in text)
+        self.assertTrue('things 7\n' in text)
+        registry.clear()
+        self.assertEqual(registry.snapshot()['metrics']['requests_total']['values'], [])
+        self.assertEqual(registry.snapshot()['metrics']['things']['values'][0]['value'], 7)
+
+
+class TestInstrumentation(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        stats.registry.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def values(self, name):
+        return dict((tuple(sorted(value.pop('labels').items())), value)
+                    for value in stats.registry.snapshot()['metrics'][name]['values'])
+
+    def test_database(self):
+        open_before = self.values('cutout_open_databases')[(('engine', 'cutout'),)]['value']
+        db = Database(os.path.join(self.dir, 'db'))
+        self.assertEqual(self.values('cutout_open_databases')[(('engine', 'cutout'),)]['value'],
+                         open_before + 1)
+        db.extend(['a'])
+        db.extend(['b'])
+        self.assertEqual(self.values('cutout_lock_append_wait_seconds')[()]['count'], 2)
+        self.assertEqual(self.values('cutout_write_lock_wait_seconds')[()]['count'], 2)
+        db.close()
+        self.assertEqual(self.values('cutout_open_databases')[(('engine', 'cutout'),)]['value'],
+                         open_before)
+
+    def test_application(self):
+        app = set_remote_user(Application(dir=self.dir), username='a@b/c')
+        Request.blank('/c/a@b/x', method='POST', body=json.dumps([{'id': 'a', 'x': 'xxx'}])).send(app)
+        Request.blank('/c/a@b/x').send(app)
+        Request.blank('/c/a@b/x?copy').send(app)
+        self.assertEqual(Request.blank('/stats').send(app).status_code, 403)
+        req = Request.blank('/stats')
+        req.environ['cutout.internal'] = True
+        resp = req.send(app)
+        self.assertEqual(resp.content_type, 'application/json')
+        metrics = resp.json['metrics']
+        requests = dict((tuple(sorted(value['labels'].values())), value['value'])
+                        for value in metrics['cutout_requests_total']['values'])
+        self.assertEqual(requests, {('200', 'post'): 1, ('200', 'get'): 1,
+                                    ('403', 'copy'): 1, ('403', 'stats'): 1})
+        routes = sorted(value['labels']['route'] for value in metrics['cutout_request_seconds']['values'])
+        self.assertEqual(routes, ['copy', 'get', 'post', 'stats'])
+        self.assertEqual(metrics['cutout_get_bytes']['values'][0]['sum'],
+                         len(json.dumps({'id': 'a', 'x': 'xxx'})))
+        req = Request.blank('/stats?format=prometheus')
+        req.environ['cutout.internal'] = True
+        resp = req.send(app)
+        self.assertEqual(resp.content_type, 'text/plain')
+        self.assertTrue('cutout_requests_total{route="get",status="200"} 1\n' in resp.body)
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+from cutout import ExpectationFailed
+from cutout.streamdb import Database, CorruptRecord, SparseIndex
+from cutout.sync import UserStorage
+from unittest2 import TestCase
+
+
+class TestStreamDB(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_operations(self):
+        db = Database(self.filename)
+        self.assertEqual(db.length(), 0)
+        self.assertEqual(list(db.read(0)), [])
+        self.assertEqual(db.extend(['1', '2', '3']), 1)
+        self.assertEqual(db.extend(['4', '5', '6']), 4)
+        for i in range(100):
+            last = db.extend(['x' * i] * 10)
+        self.assertEqual(db.length(), 1006)
+        self.assertEqual(list(db.read(last + 8)), [(1006, 'x' * 99)])
+        self.assertEqual(list(db.read(last + 9)), [])
+        self.assertEqual(list(db.read(0))[:6], [(1, '1'), (2, '2'), (3, '3'), (4, '4'), (5, '5'), (6, '6')])
+        self.assertEqual(list(db.read(2, 4)), [(3, '3'), (4, '4')])
+        self.assertEqual(list(db.read(0, max_bytes=2)), [(1, '1'), (2, '2')])
+        self.assertEqual(list(db.read(16, max_bytes=0)), [(17, 'x')])
+        self.assertRaises(ExpectationFailed, db.extend, ['y'], expect_last_counter=5)
+        self.assertEqual(db.extend([(2000, 'y')], with_counters=True), 2000)
+        self.assertEqual(list(db.read(1006)), [(2000, 'y')])
+        ## Every record is one header plus its data, in one file:
+        self.assertFalse(os.path.exists(self.filename + '.index'))
+        self.assertEqual(os.path.getsize(self.filename),
+                         sum(12 + len(data) for count, data in db.read(0)))
+
+    def test_shared_index(self):
+        db = Database(self.filename)
+        other = Database(self.filename)
+        db.extend([str(i) for i in range(SparseIndex.every * 3)])
+        self.assertEqual(other.length(), SparseIndex.every * 3)
+        self.assertEqual(list(other.read(SparseIndex.every * 2 + 4, SparseIndex.every * 2 + 5)),
+                         [(SparseIndex.every * 2 + 5, str(SparseIndex.every * 2 + 4))])
+        other.clear()
+        self.assertEqual(db.length(), 0)
+        self.assertEqual(db.extend(['a']), 1)
+
+    def test_copy_overwrite(self):
+        db = Database(self.filename)
+        db.extend(['a', 'b', 'c', 'd'])
+        dest = os.path.join(self.dir, 'copy.db')
+        db.copy(set([2, 3]), dest)
+        db.overwrite(dest)
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (4, 'd')])
+        self.assertEqual(db.get_file_positions(None), (0, 26))
+        self.assertEqual(db.get_file_positions(4), (0, 26))
+        self.assertEqual(db.get_file_positions(3), (0, 13))
+        self.assertEqual(db.get_file_positions(1), (0, 13))
+
+    def test_recover(self):
+        db = Database(self.filename)
+        db.extend(['a', 'bb'])
+        db.close()
+        with open(self.filename, 'r+b') as fp:
+            fp.truncate(os.path.getsize(self.filename) - 1)
+        db = Database(self.filename)
+        self.assertEqual(list(db.read(0)), [(1, 'a')])
+        self.assertEqual(db.recover(), (1, 13))
+        self.assertEqual(db.extend(['c']), 2)
+        self.assertEqual(list(db.read(0)), [(1, 'a'), (2, 'c')])
+
+    def test_corrupt(self):
+        db = Database(self.filename)
+        db.extend(['abc'])
+        with open(self.filename, 'r+b') as fp:
+            fp.seek(12)
+            fp.write('x')
+        self.assertRaises(CorruptRecord, list, db.read(0))
+
+    def test_storage(self):
+        storage = UserStorage(self.dir, engine='stream')
+        db = storage.for_user('example.com', 'user', 'bucket')
+        self.assertTrue(db.empty)
+        db.db.extend(['a', 'b'])
+        self.assertFalse(db.empty)
+        self.assertEqual(db.position, 2)
+        encoded = ''.join(db.encode_db())
+        other = storage.for_user('example.com', 'user', 'other')
+        other.decode_db(StringIO(encoded))
+        self.assertEqual(list(other.db.read(0)), [(1, 'a'), (2, 'b')])
+        self.assertEqual(other.collection_id, db.collection_id)
+        db.deprecate()
+        self.assertEqual(list(db.deprecated_db.read(0)), [(1, 'a'), (2, 'b')])
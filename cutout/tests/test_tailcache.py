@@ -0,0 +1,116 @@
+import shutil
+import tempfile
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import heads
+from cutout import Database
+from cutout.heads import Head
+from cutout.tailcache import TailCache
+from cutout.sync import Application
+from cutout.tests import set_remote_user
+
+
+class TestTailCache(TestCase):
+
+    def test_extended(self):
+        cache = TailCache(records_per_db=3)
+        cache.extended('a', 0, [(1, '"x"'), (2, '"y"')])
+        self.assertEqual(cache.get('a', Head(0, '', 2, True), 0),
+                         ([(1, '[1,"x"]'), (2, '[2,"y"]')], True))
+        self.assertEqual(cache.get('a', Head(0, '', 2, True), 1), ([(2, '[2,"y"]')], True))
+        self.assertEqual(cache.get('a', Head(0, '', 2, True), 2), ([], True))
+        ## Another process wrote, or the database was replaced:
+        self.assertEqual(cache.get('a', Head(0, '', 3, True), 1), None)
+        self.assertEqual(cache.get('a', Head(1, '', 2, True), 1), None)
+        self.assertEqual(cache.get('a', Head(0, '', 2, False), 1), None)
+        cache.extended('a', 0, [(3, '"z"'), (4, '"w"')])
+        head = Head(0, '', 4, True)
+        self.assertEqual(cache.get('a', head, 0), None)
+        self.assertEqual([count for count, fragment in cache.get('a', head, 1)[0]], [2, 3, 4])
+        self.assertEqual(cache.get('a', head, 1, limit=2), ([(2, '[2,"y"]'), (3, '[3,"z"]')], False))
+        self.assertEqual(cache.get('a', head, 1, max_bytes=7), ([(2, '[2,"y"]'), (3, '[3,"z"]')], False))
+        self.assertEqual(cache.get('a', head, 1, max_bytes=1), ([(2, '[2,"y"]')], False))
+        ## Records that don't follow on start a new tail:
+        cache.extended('a', 0, [(6, '"v"')])
+        self.assertEqual(cache.get('a', Head(0, '', 6, True), 4), None)
+        self.assertEqual(cache.get('a', Head(0, '', 6, True), 5), ([(6, '[6,"v"]')], True))
+        cache.invalidate('a')
+        self.assertEqual(cache.get('a', Head(0, '', 6, True), 5), None)
+        self.assertEqual(cache.bytes, 0)
+
+    def test_budget(self):
+        cache = TailCache(max_bytes=20)
+        cache.read_all('a', 0, 0, [(1, '"aaaa"')])
+        cache.read_all('b', 0, 0, [(1, '"bbbb"')])
+        cache.get('a', Head(0, '', 1, True), 0)
+        cache.read_all('c', 0, 0, [(1, '"cccc"')])
+        self.assertEqual(cache._tails.keys(), ['a', 'c'])
+        self.assertEqual(cache.bytes, 20)
+
+
+class TestApplication(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sync = Application(dir=self.dir)
+        self.app = set_remote_user(self.sync, username='a@b/c')
+        self.reads = 0
+        self.real_read = Database.read
+
+        def read(db, *args, **kw):
+            self.reads += 1
+            return self.real_read(db, *args, **kw)
+        Database.read = read
+
+    def tearDown(self):
+        Database.read = self.real_read
+        heads._tables.pop(self.sync.storage.heads.filename).close()
+        shutil.rmtree(self.dir)
+
+    def get(self, path, **kw):
+        return Request.blank('http://localhost' + path, **kw).send(self.app)
+
+    def post(self, since, *ids):
+        resp = self.get('/c/a@b/x?since=%i' % since, method='POST',
+                        body=json.dumps([{'id': id, 'type': 't'} for id in ids]))
+        self.assertEqual(resp.status_code, 200, resp.body)
+
+    def test_get(self):
+        self.post(0, 'a', 'b', 'c')
+        reads = self.reads
+        resp = self.get('/c/a@b/x?since=1')
+        self.assertEqual(resp.json['objects'], [[2, {'id': 'b', 'type': 't'}], [3, {'id': 'c', 'type': 't'}]])
+        resp = self.get('/c/a@b/x?since=1&limit=1')
+        self.assertEqual(resp.json, {'objects': [[2, {'id': 'b', 'type': 't'}]], 'incomplete': True, 'next_since': 2})
+        self.assertEqual(self.reads, reads)
+        ## Filters still read the database:
+        self.assertEqual(len(self.get('/c/a@b/x?since=1&include=x').json['objects']), 0)
+        self.assertEqual(self.reads, reads + 1)
+        ## After a delete the tail is gone, and a read fills it again:
+        self.get('/c/a@b/x?delete', method='POST')
+        self.post(0, 'd')
+        self.sync.storage.tail_cache.clear()
+        self.assertEqual(self.get('/c/a@b/x?since=0').json['objects'], [[1, {'id': 'd', 'type': 't'}]])
+        self.post(1, 'e')
+        self.sync.storage.tail_cache.clear()
+        reads = self.reads
+        self.assertEqual(self.get('/c/a@b/x?since=1').json['objects'], [[2, {'id': 'e', 'type': 't'}]])
+        self.assertEqual(self.get('/c/a@b/x?since=1').json['objects'], [[2, {'id': 'e', 'type': 't'}]])
+        self.assertEqual(self.reads, reads + 1)
+
+    def test_backup_new_collection(self):
+        self.post(0, 'a')
+        ## A backup of the master's database, which has another
+        ## collection_id, replaces this one:
+        resp = self.get('/c/a@b/x?backup-from-pos=0&source=node&collection_id=other',
+                        method='POST', body=json.dumps([{'id': 'b', 'type': 't'},
+                                                        {'id': 'c', 'type': 't'}]),
+                        environ={'cutout.internal': True})
+        self.assertEqual(resp.status_code, 201, resp.body)
+        reads = self.reads
+        ## The tail was cached as the backup was written:
+        resp = self.get('/c/a@b/x?since=1')
+        self.assertEqual(resp.json['objects'], [[2, {'id': 'c', 'type': 't'}]])
+        self.assertEqual(resp.json['collection_id'], 'other')
+        self.assertEqual(self.reads, reads)
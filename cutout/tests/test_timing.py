@@ -0,0 +1,87 @@
+import os
+import shutil
+import logging
+import simplejson as json
+from unittest2 import TestCase
+from webob import Request
+from cutout import timing
+from cutout.balancer import Application
+from cutout.forwarder import rooted
+from cutout.tests import set_remote_user
+
+here = os.path.dirname(os.path.abspath(__file__))
+test_dir = os.path.join(here, 'test-timing-dbs')
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+class TestServerTiming(TestCase):
+
+    def test_header(self):
+        times = timing.Timings()
+        times.add('auth', 0.001)
+        times.add('backup', 0.004, 'node "1"')
+        times.add('auth', 0.002)
+        header = times.header()
+        self.assertEqual(header, 'auth;dur=3.000, backup;dur=4.000;desc="node \\"1\\""')
+        self.assertEqual(timing.parse_header(header),
+                         [('auth', 0.003, None), ('backup', 0.004, 'node "1"')])
+        other = timing.Timings()
+        other.merge(header + ', junk;dur=x, ', 'backup')
+        self.assertEqual([name for name, seconds, desc in other.phases],
+                         ['backup.auth', 'backup.backup', 'backup.junk'])
+
+
+class TestHops(TestCase):
+
+    def setUp(self):
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        self.balancer = Application(preload=3, preload_dir=test_dir, backups=1)
+        self.app = set_remote_user(rooted(self.balancer), username='a@b/c')
+        self.log = ListHandler()
+        timing.log.addHandler(self.log)
+        timing.log.setLevel(logging.INFO)
+
+    def tearDown(self):
+        timing.log.removeHandler(self.log)
+        timing.log.setLevel(logging.NOTSET)
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+
+    def test_post_with_backup(self):
+        master, backup = self.balancer.node_list('/c/a@b/x')
+        req = Request.blank('http://localhost/c/a@b/x', method='POST',
+                            body=json.dumps([dict(id='1')]))
+        req.headers['X-Request-Id'] = 'edge-id'
+        resp = req.send(self.app)
+        self.assertEqual(resp.status_code, 200, resp.body)
+        self.assertEqual(resp.headers['X-Request-Id'], 'edge-id')
+        phases = timing.parse_header(resp.headers['Server-Timing'])
+        names = [name for name, seconds, desc in phases]
+        ## (the backup node refuses the backup, as it isn't authenticated)
+        for name in 'auth', 'open', 'parse', 'extend', 'backup', 'backup.auth', 'send':
+            self.assertTrue(name in names, (name, names))
+        self.assertTrue(('backup', backup) in [(name, desc) for name, seconds, desc in phases])
+        self.assertTrue(('send', master) in [(name, desc) for name, seconds, desc in phases])
+        ## Each hop logs a line with the same ID:
+        self.assertEqual([(record['request_id'], record['hop'], record['route'])
+                          for record in self.log.records],
+                         [('edge-id', 'node', 'other'), ('edge-id', 'balancer', 'other'),
+                          ('edge-id', 'node', 'post'), ('edge-id', 'balancer', 'post')])
+        self.assertTrue('extend' in self.log.records[2]['timings'])
+
+    def test_new_id(self):
+        resp = Request.blank('http://localhost/c/a@b/x').send(self.app)
+        self.assertEqual(len(resp.headers['X-Request-Id']), 16)
+        self.assertTrue('read;dur=' in resp.headers['Server-Timing'])
+        self.assertEqual(set(record['request_id'] for record in self.log.records),
+                         set([resp.headers['X-Request-Id']]))
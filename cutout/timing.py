@@ -0,0 +1,162 @@
+"""Request IDs and per-phase timings, passed between hops
+
+Every request gets an ID where it enters the system (or keeps the
+``X-Request-Id`` it arrived with), and internal requests made while
+handling it carry the same ID (see `cutout.forwarder.inherit`).
+
+Each hop notes how long its phases take (auth, opening storage,
+extend, blob writes, backups, ...) in the request's `Timings`, and the
+response carries them in a ``Server-Timing`` header, in milliseconds::
+
+    Server-Timing: auth;dur=0.1, open;dur=0.3, extend;dur=1.2,
+        backup;dur=4.0;desc="node-001", backup.extend;dur=0.9
+
+The timings of an internal request (like the backup above) come back
+in its response's header, and are added to those of the request that
+made it, with the hop's name as a prefix.
+
+With logging configured for the ``cutout.requests`` logger each hop
+also logs one JSON line per request, with the request ID, so the
+lines of all the hops of a slow request can be found.
+"""
+import os
+import time
+import logging
+from contextlib import contextmanager
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+
+log = logging.getLogger('cutout.requests')
+## Only log if the server asks for it:
+log.addHandler(logging.NullHandler())
+log.propagate = False
+
+
+def request_id(environ):
+    """The ID of the request, from the ``X-Request-Id`` it arrived
+    with or newly made"""
+    try:
+        return environ['cutout.request_id']
+    except KeyError:
+        id = environ.get('HTTP_X_REQUEST_ID') or os.urandom(8).encode('hex')
+        environ['cutout.request_id'] = id
+        return id
+
+
+def timings(environ):
+    """The `Timings` of the request (shared by everything handling
+    this environ)"""
+    try:
+        return environ['cutout.timings']
+    except KeyError:
+        result = environ['cutout.timings'] = Timings()
+        return result
+
+
+class Timings(object):
+
+    def __init__(self):
+        ## [(name, seconds, description)]
+        self.phases = []
+
+    def add(self, name, seconds, desc=None):
+        self.phases.append((name, seconds, desc))
+
+    @contextmanager
+    def phase(self, name, desc=None):
+        """Notes the time the ``with`` block takes as `name`"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start, desc)
+
+    def merge(self, header, prefix):
+        """Adds the phases from another hop's ``Server-Timing`` header,
+        with their names prefixed"""
+        for name, seconds, desc in parse_header(header):
+            self.add(prefix + '.' + name, seconds, desc)
+
+    def totals(self):
+        """Returns ``[(name, seconds, desc)]``, adding up phases with
+        the same name and description (in the order first seen)"""
+        order = []
+        totals = {}
+        for name, seconds, desc in self.phases:
+            if (name, desc) not in totals:
+                order.append((name, desc))
+                totals[name, desc] = 0
+            totals[name, desc] += seconds
+        return [(name, totals[name, desc], desc) for name, desc in order]
+
+    def header(self):
+        parts = []
+        for name, seconds, desc in self.totals():
+            part = '%s;dur=%.3f' % (name, seconds * 1000)
+            if desc:
+                part += ';desc="%s"' % desc.replace('\\', '\\\\').replace('"', '\\"')
+            parts.append(part)
+        return ', '.join(parts)
+
+    def as_dict(self):
+        """The total milliseconds of each phase (for the log)"""
+        result = {}
+        for name, seconds, desc in self.totals():
+            result[name] = round(result.get(name, 0) + seconds * 1000, 3)
+        return result
+
+
+def parse_header(header):
+    """Parses a ``Server-Timing`` header into ``[(name, seconds,
+    desc)]``, ignoring anything it doesn't understand"""
+    result = []
+    if not header:
+        return result
+    for metric in header.split(','):
+        params = metric.strip().split(';')
+        name = params[0].strip()
+        if not name:
+            continue
+        seconds = 0
+        desc = None
+        for param in params[1:]:
+            key, sep, value = param.strip().partition('=')
+            if key == 'dur':
+                try:
+                    seconds = float(value) / 1000
+                except ValueError:
+                    pass
+            elif key == 'desc':
+                if value.startswith('"') and value.endswith('"') and len(value) > 1:
+                    value = value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                desc = value
+        result.append((name, seconds, desc))
+    return result
+
+
+def finish(req, resp, hop, start, status=None):
+    """Adds the request ID and ``Server-Timing`` to the response (if
+    there is one), and logs the request (which this hop started
+    handling at `start`)"""
+    id = request_id(req.environ)
+    times = timings(req.environ)
+    if resp is not None and hasattr(resp, 'headers'):
+        resp.headers[REQUEST_ID_HEADER] = id
+        resp.headers['Server-Timing'] = times.header()
+        if status is None:
+            status = resp.status_code
+    if log.isEnabledFor(logging.INFO):
+        log.info(json.dumps({
+            'request_id': id,
+            'hop': hop,
+            'method': req.method,
+            'path': req.path_info,
+            'route': req.environ.get('cutout.route'),
+            'status': status,
+            'ms': round((time.time() - start) * 1000, 3),
+            'timings': times.as_dict(),
+            }, sort_keys=True))
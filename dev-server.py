@@ -43,6 +43,20 @@ parser.add_option('--dir', metavar='DIRECTORY', default='./data',
                   help='Directory to store files in')
 parser.add_option('--clear', action='store_true',
                   help='Clear DIRECTORY on startup')
+parser.add_option('--durability', metavar='MODE', default='none',
+                  help='How writes are synced to disk: none, batch or group (default: %default)')
+parser.add_option('--engine', metavar='ENGINE', default='cutout',
+                  help='Database engine: cutout (data and index files), stream (one file) or sqlite (default: %default)')
+parser.add_option('--object-index', action='store_true',
+                  help='Update the (type, id) object index on every write, rather than when it is next used')
+parser.add_option('--event-loop', action='store_true',
+                  help='Use the event-loop server (cutout.evserver) instead of a thread per request')
+parser.add_option('--threads', metavar='COUNT', default='10',
+                  help='With --event-loop, the number of requests to run at once')
+parser.add_option('--max-connections', metavar='COUNT', default='5000',
+                  help='With --event-loop, the most connections to keep open')
+parser.add_option('--profile-sample', metavar='FRACTION', default='0',
+                  help='Profile this fraction of requests (see cutout.profiling)')
 
 from paste.urlmap import URLMap
 from paste.httpserver import serve
@@ -63,9 +77,18 @@ def main():
             path, dir = '/', arg
         mapper[path] = DirectoryApp(dir)
     from cutout.sync import Application
-    db_app = Application(dir=options.dir, include_syncclient=True)
-    mapper['/sync'] = db_app
-    serve(mapper, host=options.host, port=int(options.port))
+    db_app = Application(dir=options.dir, include_syncclient=True,
+                         durability=options.durability, engine=options.engine,
+                         object_index=options.object_index)
+    from cutout.profiling import Profiler
+    mapper['/sync'] = Profiler(db_app, sample=float(options.profile_sample))
+    if options.event_loop:
+        from cutout import evserver
+        evserver.serve(mapper, host=options.host, port=int(options.port),
+                       threads=int(options.threads),
+                       max_connections=int(options.max_connections))
+    else:
+        serve(mapper, host=options.host, port=int(options.port))
 
 
 if __name__ == '__main__':
@@ -19,4 +19,9 @@ setup(name='TheCutOut',
       install_requires=[
         'WebOb',
       ],
+      entry_points="""
+      [console_scripts]
+      cutout-server = cutout.server:main
+      cutout-admin = cutout.admin:main
+      """,
       )